@@ -2,10 +2,25 @@ from __future__ import annotations
 
 import logging
 import os
-from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, TypeGuard
+from time import monotonic
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Literal,
+    Optional,
+    Tuple,
+    TypedDict,
+    TypeGuard,
+)
 
 from app.config import (
+    BEDROCK_FALLBACK_MODELS,
+    BEDROCK_FALLBACK_REGIONS,
     BEDROCK_PRICING,
+    BEDROCK_PROMPT_CACHE_READ_PRICE_RATIO,
+    BEDROCK_PROMPT_CACHE_WRITE_PRICE_RATIO,
     DEFAULT_DEEP_SEEK_GENERATION_CONFIG,
     DEFAULT_GENERATION_CONFIG,
     DEFAULT_LLAMA_GENERATION_CONFIG,
@@ -13,6 +28,8 @@ from app.config import (
 )
 from app.repositories.models.custom_bot import GenerationParamsModel
 from app.repositories.models.custom_bot_guardrails import BedrockGuardrailsModel
+from app.endpoint_health import get_endpoint_health
+from app.rate_limiter import acquire
 from app.routes.schemas.conversation import type_model_name
 from app.utils import get_bedrock_runtime_client
 from botocore.exceptions import ClientError
@@ -30,6 +47,7 @@ if TYPE_CHECKING:
         InferenceConfigurationTypeDef,
         MessageTypeDef,
         SystemContentBlockTypeDef,
+        ToolTypeDef,
     )
 
 
@@ -40,6 +58,9 @@ BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "us-east-1")
 ENABLE_BEDROCK_CROSS_REGION_INFERENCE = (
     os.environ.get("ENABLE_BEDROCK_CROSS_REGION_INFERENCE", "false") == "true"
 )
+ENABLE_BEDROCK_PROMPT_CACHING = (
+    os.environ.get("ENABLE_BEDROCK_PROMPT_CACHING", "true") == "true"
+)
 
 client = get_bedrock_runtime_client()
 
@@ -81,6 +102,24 @@ def is_tooluse_supported(model: type_model_name) -> bool:
     ]
 
 
+def is_prompt_caching_supported(model: type_model_name) -> bool:
+    """Check if the model supports prompt caching with `cachePoint` blocks.
+    Ref: https://docs.aws.amazon.com/bedrock/latest/userguide/prompt-caching.html
+    """
+    return model in [
+        "claude-v3.5-haiku",
+        "claude-v3.7-sonnet",
+        "amazon-nova-pro",
+        "amazon-nova-lite",
+        "amazon-nova-micro",
+    ]
+
+
+def is_tool_caching_supported(model: type_model_name) -> bool:
+    # Nova models can cache system prompts and messages, but not tool specs.
+    return is_prompt_caching_supported(model) and not is_nova_model(model)
+
+
 def _prepare_deepseek_model_params(
     model: type_model_name, generation_params: Optional[GenerationParamsModel] = None
 ) -> Tuple[InferenceConfigurationTypeDef, None]:
@@ -253,57 +292,16 @@ def _prepare_nova_model_params(
     return inference_config, additional_fields
 
 
-def compose_args_for_converse_api(
-    messages: list[SimpleMessageModel],
+def _prepare_inference_params(
     model: type_model_name,
-    instructions: list[str] = [],
-    generation_params: GenerationParamsModel | None = None,
-    guardrail: BedrockGuardrailsModel | None = None,
-    grounding_source: GuardrailConverseContentBlockTypeDef | None = None,
-    tools: dict[str, AgentTool] | None = None,
-    stream: bool = True,
-    enable_reasoning: bool = False,
-) -> ConverseStreamRequestTypeDef:
-    def process_content(c: ContentModel, role: str) -> list[ContentBlockTypeDef]:
-        # Drop unsigned reasoning blocks only for DeepSeek R1
-        if (
-            is_deepseek_model(model)
-            and c.content_type == "reasoning"
-            and not getattr(c, "signature", None)
-        ):
-            return []
-
-        if c.content_type == "text":
-            if (
-                role == "user"
-                and guardrail
-                and guardrail.grounding_threshold > 0
-                and grounding_source
-            ):
-                return [
-                    {"guardContent": grounding_source},
-                    {
-                        "guardContent": {
-                            "text": {"text": c.body, "qualifiers": ["query"]}
-                        }
-                    },
-                ]
-
-        return c.to_contents_for_converse()
-
-    arg_messages: list[MessageTypeDef] = [
-        {
-            "role": message.role,
-            "content": [
-                block
-                for c in message.content
-                for block in process_content(c, message.role)
-            ],
-        }
-        for message in messages
-        if _is_conversation_role(message.role)
-    ]
-
+    instructions: list[str],
+    generation_params: GenerationParamsModel | None,
+    enable_reasoning: bool,
+) -> tuple[
+    InferenceConfigurationTypeDef,
+    dict[str, Any] | None,
+    list[SystemContentBlockTypeDef],
+]:
     # Prepare model-specific parameters
     inference_config: InferenceConfigurationTypeDef
     additional_model_request_fields: dict[str, Any] | None
@@ -457,40 +455,378 @@ def compose_args_for_converse_api(
             if len(instruction) > 0
         ]
 
-    # Construct the base arguments
-    args: ConverseStreamRequestTypeDef = {
-        "inferenceConfig": inference_config,
-        "modelId": get_model_id(model),
-        "messages": arg_messages,
-        "system": system_prompts,
-    }
+    return inference_config, additional_model_request_fields, system_prompts
+
 
-    if additional_model_request_fields is not None:
-        args["additionalModelRequestFields"] = additional_model_request_fields
+_CACHE_POINT: Any = {"cachePoint": {"type": "default"}}
 
-    if guardrail and guardrail.guardrail_arn and guardrail.guardrail_version:
-        args["guardrailConfig"] = {
-            "guardrailIdentifier": guardrail.guardrail_arn,
-            "guardrailVersion": guardrail.guardrail_version,
-            "trace": "enabled",
+
+class ConverseRequestBuilder:
+    """Stateful builder of Converse API requests for the agent tool loop.
+    Parts of the request which do not change during a turn (inference config, system prompts,
+    guardrail config and tool specs) are composed once in the constructor. Converted messages
+    are kept, so only the messages appended since the last `build` (tool use and tool result)
+    are converted again.
+    """
+
+    def __init__(
+        self,
+        model: type_model_name,
+        instructions: list[str] = [],
+        generation_params: GenerationParamsModel | None = None,
+        guardrail: BedrockGuardrailsModel | None = None,
+        tools: dict[str, AgentTool] | None = None,
+        stream: bool = True,
+        enable_reasoning: bool = False,
+    ):
+        self.model: type_model_name = model
+        self.guardrail = guardrail
+        self.enable_reasoning = enable_reasoning
+
+        # Insert cache points so that the stable prefix (system prompts, tool specs and the history)
+        # is read from the cache on following turns and tool use iterations.
+        # NOTE: A cache point is ignored if the prefix is shorter than the minimum tokens of the model.
+        self.enable_prompt_caching = (
+            ENABLE_BEDROCK_PROMPT_CACHING and is_prompt_caching_supported(model)
+        )
+
+        inference_config, additional_model_request_fields, system_prompts = (
+            _prepare_inference_params(
+                model, instructions, generation_params, enable_reasoning
+            )
+        )
+        if self.enable_prompt_caching and system_prompts:
+            system_prompts.append(_CACHE_POINT)
+
+        # Construct the base arguments
+        self.static_args: ConverseStreamRequestTypeDef = {
+            "inferenceConfig": inference_config,
+            "modelId": get_model_id(model),
+            "messages": [],
+            "system": system_prompts,
         }
 
-        if stream:
-            # https://docs.aws.amazon.com/bedrock/latest/userguide/guardrails-streaming.html
-            args["guardrailConfig"]["streamProcessingMode"] = "async"
+        if additional_model_request_fields is not None:
+            self.static_args["additionalModelRequestFields"] = (
+                additional_model_request_fields
+            )
+
+        if guardrail and guardrail.guardrail_arn and guardrail.guardrail_version:
+            self.static_args["guardrailConfig"] = {
+                "guardrailIdentifier": guardrail.guardrail_arn,
+                "guardrailVersion": guardrail.guardrail_version,
+                "trace": "enabled",
+            }
 
-    # NOTE: Some models doesn't support tool use. https://docs.aws.amazon.com/bedrock/latest/userguide/conversation-inference-supported-models-features.html
-    if tools:
-        args["toolConfig"] = {
-            "tools": [
+            if stream:
+                # https://docs.aws.amazon.com/bedrock/latest/userguide/guardrails-streaming.html
+                self.static_args["guardrailConfig"]["streamProcessingMode"] = "async"
+
+        # NOTE: Some models doesn't support tool use. https://docs.aws.amazon.com/bedrock/latest/userguide/conversation-inference-supported-models-features.html
+        if tools:
+            tool_specs: list[ToolTypeDef] = [
                 {
                     "toolSpec": tool.to_converse_spec(),
                 }
                 for tool in tools.values()
+            ]
+            if self.enable_prompt_caching and is_tool_caching_supported(model):
+                tool_specs.append(_CACHE_POINT)
+
+            self.static_args["toolConfig"] = {
+                "tools": tool_specs,
+            }
+
+        # Source messages and their converted forms, in the order of the last `build`
+        self._source_messages: list[SimpleMessageModel] = []
+        self._converted_messages: list[MessageTypeDef] = []
+        self._grounding_source: GuardrailConverseContentBlockTypeDef | None = None
+
+    def _process_content(
+        self,
+        c: ContentModel,
+        role: str,
+        grounding_source: GuardrailConverseContentBlockTypeDef | None,
+    ) -> list[ContentBlockTypeDef]:
+        # Drop unsigned reasoning blocks only for DeepSeek R1
+        if (
+            is_deepseek_model(self.model)
+            and c.content_type == "reasoning"
+            and not getattr(c, "signature", None)
+        ):
+            return []
+
+        if c.content_type == "text":
+            if (
+                role == "user"
+                and self.guardrail
+                and self.guardrail.grounding_threshold > 0
+                and grounding_source
+            ):
+                return [
+                    {"guardContent": grounding_source},
+                    {
+                        "guardContent": {
+                            "text": {"text": c.body, "qualifiers": ["query"]}
+                        }
+                    },
+                ]
+
+        return c.to_contents_for_converse()
+
+    def _convert_message(
+        self,
+        message: SimpleMessageModel,
+        grounding_source: GuardrailConverseContentBlockTypeDef | None,
+    ) -> MessageTypeDef:
+        return {
+            "role": message.role,  # type: ignore[typeddict-item]
+            "content": [
+                block
+                for c in message.content
+                for block in self._process_content(c, message.role, grounding_source)
             ],
         }
 
-    return args
+    def build(
+        self,
+        messages: list[SimpleMessageModel],
+        grounding_source: GuardrailConverseContentBlockTypeDef | None = None,
+    ) -> ConverseStreamRequestTypeDef:
+        messages = [
+            message for message in messages if _is_conversation_role(message.role)
+        ]
+
+        # Reuse the converted messages while the same message objects are at the same positions.
+        # Grounding source is embedded into user messages, so a change invalidates all of them.
+        reused = 0
+        if grounding_source is self._grounding_source:
+            for cached, message in zip(self._source_messages, messages):
+                if cached is not message:
+                    break
+                reused += 1
+
+        self._converted_messages = self._converted_messages[:reused] + [
+            self._convert_message(message, grounding_source)
+            for message in messages[reused:]
+        ]
+        self._source_messages = messages
+        self._grounding_source = grounding_source
+
+        arg_messages = list(self._converted_messages)
+        if self.enable_prompt_caching:
+            # Cache until the last user message, which is the end of the stable prefix
+            # (the last message may be the assistant message to continue).
+            # Copy the message not to leave the cache point in the converted messages.
+            index = next(
+                (
+                    i
+                    for i in reversed(range(len(arg_messages)))
+                    if arg_messages[i]["role"] == "user"
+                ),
+                None,
+            )
+            if index is not None:
+                arg_messages[index] = {
+                    "role": arg_messages[index]["role"],
+                    "content": [*arg_messages[index]["content"], _CACHE_POINT],
+                }
+
+        args: ConverseStreamRequestTypeDef = {
+            **self.static_args,
+            "messages": arg_messages,
+        }
+        return args
+
+
+def compose_args_for_converse_api(
+    messages: list[SimpleMessageModel],
+    model: type_model_name,
+    instructions: list[str] = [],
+    generation_params: GenerationParamsModel | None = None,
+    guardrail: BedrockGuardrailsModel | None = None,
+    grounding_source: GuardrailConverseContentBlockTypeDef | None = None,
+    tools: dict[str, AgentTool] | None = None,
+    stream: bool = True,
+    enable_reasoning: bool = False,
+) -> ConverseStreamRequestTypeDef:
+    return ConverseRequestBuilder(
+        model=model,
+        instructions=instructions,
+        generation_params=generation_params,
+        guardrail=guardrail,
+        tools=tools,
+        stream=stream,
+        enable_reasoning=enable_reasoning,
+    ).build(messages=messages, grounding_source=grounding_source)
+
+
+# Composes the arguments of a request for the given model
+ArgsComposer = Callable[[type_model_name], "ConverseStreamRequestTypeDef"]
+
+
+class BedrockEndpoint(TypedDict):
+    model: type_model_name
+    region: str
+    model_id: str
+
+
+# Errors on which the request fails over to the next endpoint
+_FAILOVER_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+# Errors meaning that a fallback endpoint cannot be used, e.g. the model is not enabled in the region
+_UNUSABLE_FALLBACK_ERROR_CODES = {
+    "AccessDeniedException",
+    "ResourceNotFoundException",
+    "ValidationException",
+}
+
+
+def get_candidate_endpoints(
+    model: type_model_name, allow_model_fallback: bool = True
+) -> list[BedrockEndpoint]:
+    """Endpoints to call the model on, in order of preference.
+    The first one is the configured endpoint, followed by the fallbacks.
+    """
+    candidates: list[BedrockEndpoint] = [
+        BedrockEndpoint(
+            model=model, region=BEDROCK_REGION, model_id=get_model_id(model)
+        )
+    ]
+    if not ENABLE_BEDROCK_CROSS_REGION_INFERENCE:
+        candidates.append(
+            BedrockEndpoint(
+                model=model,
+                region=BEDROCK_REGION,
+                model_id=get_model_id(model, enable_cross_region=True),
+            )
+        )
+    for region in BEDROCK_FALLBACK_REGIONS:
+        candidates.append(
+            BedrockEndpoint(
+                model=model,
+                region=region,
+                model_id=get_model_id(model, bedrock_region=region),
+            )
+        )
+    if allow_model_fallback:
+        for fallback_model in BEDROCK_FALLBACK_MODELS.get(model, []):
+            candidates.append(
+                BedrockEndpoint(
+                    model=fallback_model,  # type: ignore[typeddict-item]
+                    region=BEDROCK_REGION,
+                    model_id=get_model_id(fallback_model),  # type: ignore[arg-type]
+                )
+            )
+
+    endpoints: list[BedrockEndpoint] = []
+    for candidate in candidates:
+        if not any(
+            endpoint["region"] == candidate["region"]
+            and endpoint["model_id"] == candidate["model_id"]
+            for endpoint in endpoints
+        ):
+            endpoints.append(candidate)
+
+    return endpoints
+
+
+def _order_endpoints(endpoints: list[BedrockEndpoint]) -> list[BedrockEndpoint]:
+    """Healthy endpoints first, keeping the order of preference.
+    Fallbacks are ordered by their average latency.
+    """
+
+    def key(item: tuple[int, BedrockEndpoint]):
+        index, endpoint = item
+        health = get_endpoint_health(endpoint["region"], endpoint["model_id"])
+        latency = (health.latency or 0.0) if index > 0 else 0.0
+        return (
+            health.is_cooling_down(),
+            health.is_degraded(),
+            index > 0,
+            latency,
+            index,
+        )
+
+    return [endpoint for _, endpoint in sorted(enumerate(endpoints), key=key)]
+
+
+def _args_for_endpoint(
+    args: ConverseStreamRequestTypeDef,
+    model: type_model_name,
+    endpoint: BedrockEndpoint,
+    compose_args: ArgsComposer | None,
+    composed: dict[type_model_name, ConverseStreamRequestTypeDef],
+) -> ConverseStreamRequestTypeDef:
+    """Arguments for the endpoint. An equivalent model gets the arguments composed for it,
+    as the inference parameters, model-specific fields and cache points differ by model.
+    """
+    if endpoint["model"] != model:
+        assert compose_args is not None
+        if endpoint["model"] not in composed:
+            composed[endpoint["model"]] = compose_args(endpoint["model"])
+        args = composed[endpoint["model"]]
+
+    return {**args, "modelId": endpoint["model_id"]}
+
+
+def invoke_with_failover(
+    model: type_model_name,
+    args: ConverseStreamRequestTypeDef,
+    operation: Literal["converse", "converse_stream"],
+    compose_args: ArgsComposer | None = None,
+) -> tuple[Any, BedrockEndpoint]:
+    """Call the Converse API on the healthiest endpoint of the model.
+    If the endpoint throttles or is unavailable, the request fails over to the next one at once,
+    instead of waiting for the endpoint to recover.
+    Returns the response and the endpoint which served it.
+    :param compose_args: Compose the arguments of the same request for an equivalent model.
+        Without it, the request fails over to the other endpoints of the model only.
+    """
+    # Model-specific fields (e.g. reasoning) may not be accepted by the equivalent models
+    allow_model_fallback = compose_args is not None and "thinking" not in args.get(
+        "additionalModelRequestFields", {}
+    )
+    candidates = get_candidate_endpoints(model, allow_model_fallback)
+    composed: dict[type_model_name, ConverseStreamRequestTypeDef] = {}
+    last_error: ClientError | None = None
+    for endpoint in _order_endpoints(candidates):
+        health = get_endpoint_health(endpoint["region"], endpoint["model_id"])
+        client = get_bedrock_runtime_client(endpoint["region"])
+        start = monotonic()
+        try:
+            response = getattr(client, operation)(
+                **_args_for_endpoint(args, model, endpoint, compose_args, composed)
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in _FAILOVER_ERROR_CODES or (
+                endpoint is not candidates[0] and code in _UNUSABLE_FALLBACK_ERROR_CODES
+            ):
+                logger.warning(
+                    f"{code} on {endpoint['region']}/{endpoint['model_id']}. Failing over to the next endpoint."
+                )
+                health.record_failure()
+                last_error = e
+                continue
+            raise
+
+        health.record_success(monotonic() - start)
+        if endpoint is not candidates[0]:
+            logger.info(
+                f"Served by fallback endpoint: {endpoint['region']}/{endpoint['model_id']}"
+            )
+        return response, endpoint
+
+    assert last_error is not None
+    if last_error.response["Error"]["Code"] == "ThrottlingException":
+        raise BedrockThrottlingException(
+            "Bedrock API is throttling requests"
+        ) from last_error
+    raise last_error
 
 
 @retry(
@@ -503,16 +839,25 @@ def compose_args_for_converse_api(
 )
 def call_converse_api(
     args: ConverseStreamRequestTypeDef,
+    model: type_model_name,
+    user_id: str | None = None,
+    input_tokens: int = 0,
+    compose_args: ArgsComposer | None = None,
 ) -> ConverseResponseTypeDef:
-    client = get_bedrock_runtime_client()
+    """Call the Converse API within the client-side rate limit of the model.
+    :param input_tokens: Estimated input tokens, reserved on the rate limit with the max output tokens.
+    :param compose_args: Compose the arguments for an equivalent model to fail over to.
+    """
+    reservation = acquire(
+        model, user_id, input_tokens + args["inferenceConfig"].get("maxTokens", 0)
+    )
+    used_tokens = 0
     try:
-        return client.converse(**args)
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ThrottlingException":
-            raise BedrockThrottlingException(
-                "Bedrock API is throttling requests"
-            ) from e
-        raise
+        response, _ = invoke_with_failover(model, args, "converse", compose_args)
+        used_tokens = response["usage"]["totalTokens"]
+    finally:
+        reservation.settle(used_tokens)
+    return response
 
 
 def calculate_price(
@@ -520,7 +865,12 @@ def calculate_price(
     input_tokens: int,
     output_tokens: int,
     region: str = BEDROCK_REGION,
+    cache_read_input_tokens: int = 0,
+    cache_write_input_tokens: int = 0,
 ) -> float:
+    """Calculate the price of the request.
+    `input_tokens` does not include the tokens read from or written to the prompt cache.
+    """
     input_price = (
         BEDROCK_PRICING.get(region, {})
         .get(model, {})
@@ -531,8 +881,33 @@ def calculate_price(
         .get(model, {})
         .get("output", BEDROCK_PRICING["default"][model]["output"])
     )
+    cache_read_price = (
+        BEDROCK_PRICING.get(region, {})
+        .get(model, {})
+        .get(
+            "cache_read",
+            BEDROCK_PRICING["default"][model].get(
+                "cache_read", input_price * BEDROCK_PROMPT_CACHE_READ_PRICE_RATIO
+            ),
+        )
+    )
+    cache_write_price = (
+        BEDROCK_PRICING.get(region, {})
+        .get(model, {})
+        .get(
+            "cache_write",
+            BEDROCK_PRICING["default"][model].get(
+                "cache_write", input_price * BEDROCK_PROMPT_CACHE_WRITE_PRICE_RATIO
+            ),
+        )
+    )
 
-    return input_price * input_tokens / 1000.0 + output_price * output_tokens / 1000.0
+    return (
+        input_price * input_tokens / 1000.0
+        + output_price * output_tokens / 1000.0
+        + cache_read_price * cache_read_input_tokens / 1000.0
+        + cache_write_price * cache_write_input_tokens / 1000.0
+    )
 
 
 def get_model_id(
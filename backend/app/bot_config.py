@@ -0,0 +1,27 @@
+import hashlib
+import json
+
+from app.repositories.models.custom_bot import BotModel
+
+# Bot fields which change the behavior of the tools and the answers. Other fields, e.g.
+# usage stats, sharing or publication, change without affecting them.
+_BOT_CONFIG_FIELDS = {
+    "instruction",
+    "knowledge",
+    "bedrock_knowledge_base",
+    "agent",
+    "generation_params",
+    "bedrock_guardrails",
+    "sync_last_exec_id",
+}
+
+
+def compute_bot_config_hash(bot: BotModel | None) -> str:
+    """Hash of the bot configuration, which changes when the bot or its knowledge is updated."""
+    if bot is None:
+        return ""
+
+    config = bot.model_dump(mode="json", include=_BOT_CONFIG_FIELDS)
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
@@ -0,0 +1,16 @@
+import logging
+from typing import Any
+
+from app.repositories.bot_stats import roll_up_usage_counts
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def handler(event: dict, context: Any) -> None:
+    """Periodic roll-up of the sharded bot usage counters into `UsageStats` of the bot items,
+    which is used for sorting bots by popularity in the bot store.
+    This is invoked by a scheduled event.
+    """
+    logger.info("Rolling up bot usage counts")
+    roll_up_usage_counts()
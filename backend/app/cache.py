@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from collections.abc import Hashable
+from threading import Lock
+from time import monotonic
+from typing import Callable, Generic, TypedDict, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CacheStats(TypedDict):
+    hits: int
+    misses: int
+    hit_rate: float
+
+
+class TTLCache(Generic[K, V]):
+    """Thread-safe in-memory cache with per-entry TTL and LRU eviction.
+    Hits and misses are counted by the `label` given to `get`, e.g. tool name.
+    NOTE: The cache is per process (per Lambda execution environment).
+    """
+
+    def __init__(self, max_size: int, default_ttl: float):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._counts: dict[str, list[int]] = {}
+        self._lock = Lock()
+
+    def _count(self, label: str, hit: bool):
+        counts = self._counts.setdefault(label, [0, 0])
+        counts[0 if hit else 1] += 1
+
+    def get(self, key: K, label: str = "default") -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(label, hit=False)
+                return None
+
+            expires_at, value = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                self._count(label, hit=False)
+                return None
+
+            self._entries.move_to_end(key)
+            self._count(label, hit=True)
+            return value
+
+    def set(self, key: K, value: V, ttl: float | None = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[K], bool]) -> int:
+        """Remove the entries whose key matches the predicate. Returns the number removed."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, CacheStats]:
+        with self._lock:
+            return {
+                label: CacheStats(
+                    hits=hits,
+                    misses=misses,
+                    hit_rate=hits / (hits + misses) if hits + misses > 0 else 0.0,
+                )
+                for label, (hits, misses) in self._counts.items()
+            }
@@ -0,0 +1,59 @@
+from app.usecases.chat import ChatEvent
+
+
+def event_payloads(event: ChatEvent) -> list[dict]:
+    """Payloads notified to the client for the chat event.
+    Shared by the WebSocket notifications and the server-sent events of the streaming API.
+    """
+    if event["type"] == "text":
+        return [dict(status="STREAMING", completion=event["text"])]
+
+    elif event["type"] == "reasoning":
+        return [dict(status="REASONING", completion=event["text"])]
+
+    elif event["type"] == "tool_start":
+        tool_use = event["tool_use"]
+        return [
+            dict(
+                status="AGENT_THINKING",
+                log={
+                    tool_use["tool_use_id"]: {
+                        "name": tool_use["name"],
+                        "input": tool_use["input"],
+                    },
+                },
+            )
+        ]
+
+    elif event["type"] == "tool_result":
+        run_result = event["result"]
+        return [
+            dict(
+                status="AGENT_TOOL_RESULT",
+                result={
+                    "toolUseId": run_result["tool_use_id"],
+                    "status": run_result["status"],
+                },
+            ),
+            *(
+                dict(
+                    status="AGENT_RELATED_DOCUMENT",
+                    result={
+                        "toolUseId": run_result["tool_use_id"],
+                        "relatedDocument": related_document.to_schema().model_dump(
+                            by_alias=True
+                        ),
+                    },
+                )
+                for related_document in run_result["related_documents"]
+            ),
+        ]
+
+    else:
+        return [
+            dict(
+                status="STREAMING_END",
+                completion="",
+                stop_reason=event["result"]["stop_reason"],
+            )
+        ]
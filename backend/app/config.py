@@ -1,3 +1,5 @@
+import os
+
 from typing_extensions import NotRequired, TypedDict
 
 
@@ -10,6 +12,11 @@ class GenerationParams(TypedDict):
     reasoning_params: NotRequired[dict[str, int]]
 
 
+class BedrockRateLimit(TypedDict):
+    requests_per_minute: int
+    tokens_per_minute: int
+
+
 class EmbeddingConfig(TypedDict):
     model_id: str
     chunk_size: int
@@ -58,22 +65,167 @@ DEFAULT_LLAMA_GENERATION_CONFIG: GenerationParams = {
 }
 
 
+# Token budget of the conversation history sent to the model on each turn.
+# Older turns exceeding the budget are replaced with a rolling summary.
+CONTEXT_WINDOW_TOKEN_BUDGET: dict[str, int] = {
+    "mistral-7b-instruct": 16000,
+    "mixtral-8x7b-instruct": 16000,
+    "default": 64000,
+}
+# Ratio of the budget kept verbatim as the latest turns when a new summary is made.
+CONTEXT_WINDOW_RECENT_RATIO = 0.5
+# Model used to summarize older turns.
+CONTEXT_SUMMARY_MODEL = "claude-v3-haiku"
+
+# Model used to name conversations, and the token cap of the first exchange sent to it.
+TITLE_GENERATION_MODEL = "claude-v3-haiku"
+TITLE_GENERATION_MAX_INPUT_TOKENS = 1000
+# Events buffered between `chat` and a slow consumer of `chat_stream`.
+# When the buffer is full, the generation waits for the consumer.
+CHAT_STREAM_MAX_BUFFERED_EVENTS = 64
+
+
+# Start each tool as soon as its tool use block is streamed, instead of after the response ends.
+ENABLE_SPECULATIVE_TOOL_EXECUTION = (
+    os.environ.get("ENABLE_SPECULATIVE_TOOL_EXECUTION", "false") == "true"
+)
+# Maximum number of tools run concurrently in an agent step.
+AGENT_TOOL_MAX_CONCURRENCY = 4
+# Timeout of a tool run in seconds, by tool name.
+AGENT_TOOL_TIMEOUT_SECONDS: dict[str, float] = {
+    "default": 60,
+}
+
+# Successful tool results are cached per process, keyed by the tool name, the normalized input
+# and the bot configuration, and shared among the users of the bot. TTL in seconds by tool name;
+# caching is opt-in, so list only deterministic tools whose results depend on nothing but the bot
+# and the input (not on the user, the time or side effects).
+AGENT_TOOL_RESULT_CACHE_TTL_SECONDS: dict[str, float] = {
+    "default": 0,
+    "knowledge_base_tool": 300,
+}
+AGENT_TOOL_RESULT_CACHE_MAX_SIZE = 512
+
+
+# SQS queue to deliver the write-behind writes durably. If not set, writes are applied in background threads.
+WRITE_BEHIND_QUEUE_URL = os.environ.get("WRITE_BEHIND_QUEUE_URL", "")
+# Last used time of a bot is written at most once in this interval per user,
+# as it is only used to order the recently used bots.
+BOT_LAST_USED_TIME_UPDATE_INTERVAL_SECONDS = 300
+
+# Number of the counter items a bot's usage count is spread over. Must be less than 100,
+# the item limit of a DynamoDB transaction used by the roll-up.
+BOT_USAGE_COUNTER_SHARDS = 10
+# Popular bots ranking, ordered by the rolled-up usage counts, is cached for this period.
+BOT_USAGE_COUNT_CACHE_TTL_SECONDS = 60
+
+# Responses of the published API bots which enable the response cache are cached per process, keyed by
+# the bot configuration, the model and the normalized conversation. A question whose word Jaccard
+# similarity to a cached one reaches the threshold gets the cached response; 1 matches exact questions only.
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_MAX_SIZE = 1024
+RESPONSE_CACHE_NEAR_DUPLICATE_THRESHOLD = 0.9
+# Set in the published API of a bot when the response cache is enabled on its publication.
+PUBLISHED_API_ENABLE_RESPONSE_CACHE = (
+    os.environ.get("PUBLISHED_API_ENABLE_RESPONSE_CACHE", "false") == "true"
+)
+
+# Token budget of the search results inserted into the prompt for RAG.
+RAG_CONTEXT_TOKEN_BUDGET: dict[str, int] = {
+    "mistral-7b-instruct": 4000,
+    "mixtral-8x7b-instruct": 4000,
+    "default": 16000,
+}
+# A chunk crossing the budget is truncated only if at least this many tokens are left for it.
+RAG_CONTEXT_MIN_CHUNK_TOKENS = 100
+
+# Retrieved chunks are over-fetched by this factor, then near duplicates are removed and the rest
+# are reranked lexically down to the max results of the bot.
+KNOWLEDGE_BASE_RETRIEVAL_OVERFETCH_FACTOR = 2
+# Jaccard similarity of word shingles above which a chunk is a near duplicate of a higher one.
+RERANK_DUPLICATE_THRESHOLD = 0.8
+RERANK_SHINGLE_SIZE = 5
+# Knowledge base retrieval results are cached per process, keyed by the knowledge base, its sync
+# execution, the search parameters and the normalized query.
+KNOWLEDGE_BASE_RETRIEVAL_CACHE_TTL_SECONDS = 600
+KNOWLEDGE_BASE_RETRIEVAL_CACHE_MAX_SIZE = 256
+# Also match queries consisting of the same words in a different order or punctuation.
+KNOWLEDGE_BASE_RETRIEVAL_CACHE_NEAR_DUPLICATE = False
+
+
+# Price ratio of the tokens read from / written to the prompt cache against the input tokens,
+# used when the cache prices of the model are not listed in `BEDROCK_PRICING`.
+# See: https://docs.aws.amazon.com/bedrock/latest/userguide/prompt-caching.html
+BEDROCK_PROMPT_CACHE_READ_PRICE_RATIO = 0.1
+BEDROCK_PROMPT_CACHE_WRITE_PRICE_RATIO = 1.25
+
+# When Bedrock throttles or is unavailable, the request fails over to the next endpoint at once:
+# the cross-region inference profile of the model, the model in the following regions,
+# then the equivalent models. Equivalent models must be of the same model family.
+BEDROCK_FALLBACK_REGIONS: list[str] = []
+BEDROCK_FALLBACK_MODELS: dict[str, list[str]] = {}
+# Smoothing factor of the latency and error rate averages of each endpoint.
+BEDROCK_ENDPOINT_HEALTH_EWMA_ALPHA = 0.2
+# An endpoint is tried after the healthy ones for this period after it throttled.
+BEDROCK_ENDPOINT_COOLDOWN_SECONDS = 30
+# An endpoint whose error rate average reaches this value is tried after the healthy ones.
+BEDROCK_ENDPOINT_ERROR_RATE_THRESHOLD = 0.5
+
+# Client-side quotas of Bedrock by model name, which should match the service quotas of the account.
+# Requests over the quota wait in a queue served fairly among users. Models not listed are not limited.
+# e.g. {"claude-v3.5-sonnet-v2": {"requests_per_minute": 50, "tokens_per_minute": 400000}}
+# See: https://docs.aws.amazon.com/bedrock/latest/userguide/quotas.html
+BEDROCK_RATE_LIMITS: dict[str, BedrockRateLimit] = {}
+# A request is rejected at once if it is not expected to be sent within this period,
+# or if this many requests are already waiting for the model.
+BEDROCK_RATE_LIMIT_MAX_WAIT_SECONDS = 10
+BEDROCK_RATE_LIMIT_MAX_QUEUE_DEPTH = 32
+# Share the token buckets among containers through DynamoDB. If false, each process has its own buckets,
+# so the quotas in `BEDROCK_RATE_LIMITS` should be divided by the number of concurrent processes.
+ENABLE_SHARED_RATE_LIMIT = os.environ.get("ENABLE_SHARED_RATE_LIMIT", "false") == "true"
+
+
 # Used for price estimation.
 # NOTE: The following is based on 2024-03-07
 # See: https://aws.amazon.com/bedrock/pricing/
 BEDROCK_PRICING = {
     "us-east-1": {
         "claude-v3-haiku": {"input": 0.00025, "output": 0.00125},
-        "claude-v3.5-haiku": {"input": 0.001, "output": 0.005},
+        "claude-v3.5-haiku": {
+            "input": 0.001,
+            "output": 0.005,
+            "cache_read": 0.0001,
+            "cache_write": 0.00125,
+        },
         "claude-v3.5-sonnet": {"input": 0.00300, "output": 0.01500},
         "claude-v3.5-sonnet-v2": {"input": 0.00300, "output": 0.01500},
-        "claude-v3.7-sonnet": {"input": 0.00300, "output": 0.01500},
+        "claude-v3.7-sonnet": {
+            "input": 0.00300,
+            "output": 0.01500,
+            "cache_read": 0.0003,
+            "cache_write": 0.00375,
+        },
         "mistral-7b-instruct": {"input": 0.00015, "output": 0.0002},
         "mixtral-8x7b-instruct": {"input": 0.00045, "output": 0.0007},
         "mistral-large": {"input": 0.004, "output": 0.012},
-        "amazon-nova-pro": {"input": 0.0008, "output": 0.0032},
-        "amazon-nova-lite": {"input": 0.00006, "output": 0.00024},
-        "amazon-nova-micro": {"input": 0.000035, "output": 0.00014},
+        "amazon-nova-pro": {
+            "input": 0.0008,
+            "output": 0.0032,
+            "cache_read": 0.0002,
+            "cache_write": 0.0,
+        },
+        "amazon-nova-lite": {
+            "input": 0.00006,
+            "output": 0.00024,
+            "cache_read": 0.000015,
+            "cache_write": 0.0,
+        },
+        "amazon-nova-micro": {
+            "input": 0.000035,
+            "output": 0.00014,
+            "cache_read": 0.00000875,
+            "cache_write": 0.0,
+        },
         "deepseek-r1": {"input": 0.00135, "output": 0.0054},
         # Meta Llama 3 models (US region)
         "llama3-3-70b-instruct": {"input": 0.00072, "output": 0.00072},
@@ -103,18 +255,43 @@ BEDROCK_PRICING = {
     "ap-northeast-1": {},
     "default": {
         "claude-v3-haiku": {"input": 0.00025, "output": 0.00125},
-        "claude-v3.5-haiku": {"input": 0.001, "output": 0.005},
+        "claude-v3.5-haiku": {
+            "input": 0.001,
+            "output": 0.005,
+            "cache_read": 0.0001,
+            "cache_write": 0.00125,
+        },
         "claude-v3.5-sonnet": {"input": 0.00300, "output": 0.01500},
         "claude-v3.5-sonnet-v2": {"input": 0.00300, "output": 0.01500},
-        "claude-v3.7-sonnet": {"input": 0.00300, "output": 0.01500},
+        "claude-v3.7-sonnet": {
+            "input": 0.00300,
+            "output": 0.01500,
+            "cache_read": 0.0003,
+            "cache_write": 0.00375,
+        },
         "claude-v3-opus": {"input": 0.01500, "output": 0.07500},
         "mistral-7b-instruct": {"input": 0.00015, "output": 0.0002},
         "mixtral-8x7b-instruct": {"input": 0.00045, "output": 0.0007},
         "mistral-large": {"input": 0.004, "output": 0.012},
         "mistral-large-2": {"input": 0.002, "output": 0.06},
-        "amazon-nova-pro": {"input": 0.0008, "output": 0.0032},
-        "amazon-nova-lite": {"input": 0.00006, "output": 0.00024},
-        "amazon-nova-micro": {"input": 0.000035, "output": 0.00014},
+        "amazon-nova-pro": {
+            "input": 0.0008,
+            "output": 0.0032,
+            "cache_read": 0.0002,
+            "cache_write": 0.0,
+        },
+        "amazon-nova-lite": {
+            "input": 0.00006,
+            "output": 0.00024,
+            "cache_read": 0.000015,
+            "cache_write": 0.0,
+        },
+        "amazon-nova-micro": {
+            "input": 0.000035,
+            "output": 0.00014,
+            "cache_read": 0.00000875,
+            "cache_write": 0.0,
+        },
         "deepseek-r1": {"input": 0.00135, "output": 0.0054},
         # Meta Llama 3 models (US region)
         "llama3-3-70b-instruct": {"input": 0.00072, "output": 0.00072},
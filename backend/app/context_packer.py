@@ -0,0 +1,97 @@
+import logging
+import re
+
+from app.config import RAG_CONTEXT_MIN_CHUNK_TOKENS, RAG_CONTEXT_TOKEN_BUDGET
+from app.routes.schemas.conversation import type_model_name
+from app.token_estimator import calibrated, estimate_text_tokens
+from app.vector_search import SearchResult
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# End of a sentence, including Japanese and Chinese full stops, or a line break
+_SENTENCE_END_PATTERN = re.compile(r"[.!?。！？](?=\s|$)|[。！？]|\n")
+
+
+def _is_adjacent(previous: SearchResult, result: SearchResult) -> bool:
+    """Whether the chunks are from the same source and the same or the next page.
+    Chunks without a source or page numbers cannot be told adjacent, so they are kept apart.
+    """
+    if not previous["source_link"] or previous["source_link"] != result["source_link"]:
+        return False
+
+    if previous["page_number"] is None or result["page_number"] is None:
+        return False
+
+    return abs(previous["page_number"] - result["page_number"]) <= 1
+
+
+def _merge_adjacent(search_results: list[SearchResult]) -> list[SearchResult]:
+    """Merge consecutive results of adjacent chunks into one result,
+    which is cited by the rank of the first one.
+    """
+    merged: list[SearchResult] = []
+    for i, result in enumerate(search_results):
+        if merged and _is_adjacent(search_results[i - 1], result):
+            merged[-1] = SearchResult(
+                **{
+                    **merged[-1],
+                    "content": f"{merged[-1]['content']}\n{result['content']}",
+                }
+            )
+        else:
+            merged.append(result)
+
+    return merged
+
+
+def _truncate_on_sentence(text: str, max_chars: int) -> str:
+    """Cut the text at the last sentence end within `max_chars`."""
+    if len(text) <= max_chars:
+        return text
+
+    end = 0
+    for match in _SENTENCE_END_PATTERN.finditer(text, 0, max_chars):
+        end = match.end()
+
+    return text[:end].rstrip()
+
+
+def pack_search_results(
+    search_results: list[SearchResult],
+    model: type_model_name,
+    budget: int | None = None,
+) -> list[SearchResult]:
+    """Fit the search results into the token budget of the RAG context, in rank order.
+    Adjacent chunks of the same source are merged, and the chunk crossing the budget
+    is truncated on a sentence boundary.
+    """
+    if budget is None:
+        budget = RAG_CONTEXT_TOKEN_BUDGET.get(
+            model, RAG_CONTEXT_TOKEN_BUDGET["default"]
+        )
+
+    packed: list[SearchResult] = []
+    remaining = budget
+    for result in _merge_adjacent(search_results):
+        tokens = calibrated(estimate_text_tokens(result["content"], model), model)
+        if tokens <= remaining:
+            packed.append(result)
+            remaining -= tokens
+            continue
+
+        if remaining >= RAG_CONTEXT_MIN_CHUNK_TOKENS:
+            content = _truncate_on_sentence(
+                result["content"],
+                max_chars=len(result["content"]) * remaining // tokens,
+            )
+            if content:
+                packed.append(SearchResult(**{**result, "content": content}))
+
+        break
+
+    if len(packed) < len(search_results):
+        logger.info(
+            f"Packed {len(search_results)} search results into {len(packed)} within {budget} tokens"
+        )
+    return packed
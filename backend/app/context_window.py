@@ -0,0 +1,219 @@
+import logging
+from typing import TypedDict
+
+from app.bedrock import (
+    calculate_price,
+    call_converse_api,
+    compose_args_for_converse_api,
+)
+from app.config import (
+    CONTEXT_SUMMARY_MODEL,
+    CONTEXT_WINDOW_RECENT_RATIO,
+    CONTEXT_WINDOW_TOKEN_BUDGET,
+)
+from app.prompt import (
+    build_conversation_summary_prompt,
+    get_prompt_to_summarize_conversation,
+)
+from app.repositories.conversation import (
+    ContextSummary,
+    find_context_summaries_by_conversation_id,
+    get_token_count,
+    store_context_summary,
+)
+from app.repositories.models.conversation import (
+    MessageModel,
+    SimpleMessageModel,
+    TextContentModel,
+)
+from app.routes.schemas.conversation import type_model_name
+from app.token_estimator import calibrated, estimate_text_tokens
+from app.utils import get_current_time
+from mypy_boto3_bedrock_runtime.type_defs import ConverseStreamRequestTypeDef
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Message id of a node and the messages sent for it (the message itself and its tool logs)
+Turn = tuple[str, list[SimpleMessageModel]]
+
+
+class ContextWindow(TypedDict):
+    messages: list[SimpleMessageModel]
+    # Prompt including the summary of the omitted turns, to be appended to instructions
+    summary_prompt: str | None
+    # Price of summarization
+    price: float
+
+
+def _is_user_turn(turn: Turn) -> bool:
+    return turn[1][-1].role == "user"
+
+
+def _flatten(turns: list[Turn]) -> list[SimpleMessageModel]:
+    return [message for _, messages in turns for message in messages]
+
+
+def _summarize(
+    user_id: str, previous_summary: str, turns: list[Turn]
+) -> tuple[str, float]:
+    """Fold the turns into the rolling summary. Returns the new summary and its price."""
+    transcript = "\n\n".join(
+        f"{'User' if message.role == 'user' else 'Assistant'}: {content.body}"
+        for message in _flatten(turns)
+        for content in message.content
+        if isinstance(content, TextContentModel)
+    )
+    prompt = get_prompt_to_summarize_conversation(
+        previous_summary=previous_summary,
+        transcript=transcript,
+    )
+    messages = [
+        SimpleMessageModel(
+            role="user",
+            content=[
+                TextContentModel(
+                    content_type="text",
+                    body=prompt,
+                )
+            ],
+        )
+    ]
+
+    def compose_args(model: type_model_name) -> ConverseStreamRequestTypeDef:
+        return compose_args_for_converse_api(
+            messages=messages, model=model, stream=False
+        )
+
+    response = call_converse_api(
+        compose_args(CONTEXT_SUMMARY_MODEL),
+        model=CONTEXT_SUMMARY_MODEL,
+        user_id=user_id,
+        input_tokens=calibrated(
+            estimate_text_tokens(prompt, CONTEXT_SUMMARY_MODEL), CONTEXT_SUMMARY_MODEL
+        ),
+        compose_args=compose_args,
+    )
+    summary = (
+        response["output"]["message"]["content"][0]["text"]
+        if "message" in response["output"]
+        and len(response["output"]["message"]["content"]) > 0
+        and "text" in response["output"]["message"]["content"][0]
+        else ""
+    )
+    price = calculate_price(
+        CONTEXT_SUMMARY_MODEL,
+        response["usage"]["inputTokens"],
+        response["usage"]["outputTokens"],
+        cache_read_input_tokens=response["usage"].get("cacheReadInputTokens", 0),
+        cache_write_input_tokens=response["usage"].get("cacheWriteInputTokens", 0),
+    )
+    return summary, price
+
+
+def fit_to_context_window(
+    user_id: str,
+    conversation_id: str,
+    turns: list[Turn],
+    message_map: dict[str, MessageModel],
+    model: type_model_name,
+) -> ContextWindow:
+    """Fit the conversation history into the token budget of the model.
+    The latest turns are kept verbatim and the older turns are replaced with a rolling summary.
+    Summaries are stored per conversation keyed by the last message they cover, so a summary
+    is reused on following turns until the verbatim part exceeds the budget again.
+    """
+    budget = CONTEXT_WINDOW_TOKEN_BUDGET.get(
+        model, CONTEXT_WINDOW_TOKEN_BUDGET["default"]
+    )
+    # System and instruction nodes are not sent as messages
+    turns = [
+        turn for turn in turns if turn[1] and turn[1][-1].role in ["user", "assistant"]
+    ]
+    # Use the token counts cached on the conversation instead of re-tokenizing the history
+    token_counts = [
+        calibrated(get_token_count(message_map, turn[0]), model) for turn in turns
+    ]
+    if sum(token_counts) <= budget:
+        return ContextWindow(messages=_flatten(turns), summary_prompt=None, price=0.0)
+
+    summaries = find_context_summaries_by_conversation_id(user_id, conversation_id)
+    # Find the latest summary on the current branch
+    summarized = next(
+        (i + 1 for i in reversed(range(len(turns))) if turns[i][0] in summaries),
+        0,
+    )
+    summary = summaries[turns[summarized - 1][0]]["summary"] if summarized > 0 else ""
+    if (
+        summarized > 0
+        and calibrated(estimate_text_tokens(summary, model), model)
+        + sum(token_counts[summarized:])
+        <= budget
+    ):
+        return ContextWindow(
+            messages=_flatten(turns[summarized:]),
+            summary_prompt=build_conversation_summary_prompt(summary),
+            price=0.0,
+        )
+
+    # Keep the latest turns verbatim
+    recent_budget = int(budget * CONTEXT_WINDOW_RECENT_RATIO)
+    start = len(turns)
+    recent_tokens = 0
+    while (
+        start > summarized and recent_tokens + token_counts[start - 1] <= recent_budget
+    ):
+        start -= 1
+        recent_tokens += token_counts[start]
+    # The first message sent to the model must be the user's
+    while start < len(turns) and not _is_user_turn(turns[start]):
+        start += 1
+
+    if start <= summarized:
+        return ContextWindow(
+            messages=_flatten(turns[summarized:]),
+            summary_prompt=(
+                build_conversation_summary_prompt(summary) if summary else None
+            ),
+            price=0.0,
+        )
+
+    # Fold the turns going out of the window into the summary chunk by chunk,
+    # so that each summarization request also fits into the budget.
+    price = 0.0
+    try:
+        chunk_start = summarized
+        chunk_tokens = 0
+        for i in range(summarized, start):
+            if chunk_tokens + token_counts[i] > budget and i > chunk_start:
+                summary, chunk_price = _summarize(
+                    user_id, summary, turns[chunk_start:i]
+                )
+                price += chunk_price
+                chunk_start, chunk_tokens = i, 0
+            chunk_tokens += token_counts[i]
+        summary, chunk_price = _summarize(user_id, summary, turns[chunk_start:start])
+        price += chunk_price
+
+    except Exception as e:
+        logger.exception(f"Failed to summarize conversation: {e}")
+        return ContextWindow(messages=_flatten(turns), summary_prompt=None, price=price)
+
+    store_context_summary(
+        user_id=user_id,
+        conversation_id=conversation_id,
+        context_summary=ContextSummary(
+            message_id=turns[start - 1][0],
+            summary=summary,
+            create_time=get_current_time(),
+        ),
+    )
+    logger.info(
+        f"Summarized {start - summarized} turns until {turns[start - 1][0]} for conversation: {conversation_id}"
+    )
+
+    return ContextWindow(
+        messages=_flatten(turns[start:]),
+        summary_prompt=build_conversation_summary_prompt(summary),
+        price=price,
+    )
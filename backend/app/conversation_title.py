@@ -0,0 +1,92 @@
+import logging
+
+from app.bedrock import call_converse_api, compose_args_for_converse_api
+from app.config import TITLE_GENERATION_MAX_INPUT_TOKENS, TITLE_GENERATION_MODEL
+from app.prompt import get_prompt_to_propose_title
+from app.repositories.models.conversation import SimpleMessageModel, TextContentModel
+from app.routes.schemas.conversation import type_model_name
+from app.token_estimator import calibrated, estimate_text_tokens
+from mypy_boto3_bedrock_runtime.type_defs import ConverseStreamRequestTypeDef
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Title of a conversation until it is named
+DEFAULT_CONVERSATION_TITLE = "New conversation"
+
+
+def _truncate(text: str, max_tokens: int, model: type_model_name) -> str:
+    tokens = calibrated(estimate_text_tokens(text, model), model)
+    if tokens <= max_tokens:
+        return text
+    return text[: len(text) * max_tokens // tokens]
+
+
+def build_title_transcript(
+    messages: list[SimpleMessageModel], model: type_model_name = TITLE_GENERATION_MODEL
+) -> str:
+    """Transcript of the first user message and the answer to it, truncated to the token cap.
+    Later turns, tool use logs and non-text contents are not needed to name the conversation.
+    """
+    first_exchange: list[tuple[str, str]] = []
+    for message in messages:
+        expected_role = "assistant" if first_exchange else "user"
+        if message.role != expected_role:
+            continue
+
+        text = "\n".join(
+            content.body
+            for content in message.content
+            if isinstance(content, TextContentModel)
+        )
+        if text:
+            first_exchange.append(
+                ("User" if message.role == "user" else "Assistant", text)
+            )
+        if len(first_exchange) == 2:
+            break
+
+    if not first_exchange:
+        return ""
+
+    max_tokens = TITLE_GENERATION_MAX_INPUT_TOKENS // len(first_exchange)
+    return "\n\n".join(
+        f"{role}: {_truncate(text, max_tokens, model)}" for role, text in first_exchange
+    )
+
+
+def generate_title(
+    user_id: str, transcript: str, model: type_model_name = TITLE_GENERATION_MODEL
+) -> str:
+    prompt = get_prompt_to_propose_title(transcript)
+    messages = [
+        SimpleMessageModel(
+            role="user",
+            content=[
+                TextContentModel(
+                    content_type="text",
+                    body=prompt,
+                )
+            ],
+        )
+    ]
+
+    def compose_args(model: type_model_name) -> ConverseStreamRequestTypeDef:
+        return compose_args_for_converse_api(
+            messages=messages, model=model, stream=False
+        )
+
+    response = call_converse_api(
+        compose_args(model),
+        model=model,
+        user_id=user_id,
+        input_tokens=calibrated(estimate_text_tokens(prompt, model), model),
+        compose_args=compose_args,
+    )
+    return (
+        response["output"]["message"]["content"][0]["text"]
+        if "message" in response["output"]
+        and len(response["output"]["message"]["content"]) > 0
+        and "text" in response["output"]["message"]["content"][0]
+        else ""
+    )
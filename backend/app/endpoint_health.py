@@ -0,0 +1,62 @@
+from threading import Lock
+from time import monotonic
+
+from app.config import (
+    BEDROCK_ENDPOINT_COOLDOWN_SECONDS,
+    BEDROCK_ENDPOINT_ERROR_RATE_THRESHOLD,
+    BEDROCK_ENDPOINT_HEALTH_EWMA_ALPHA,
+)
+
+
+class EndpointHealth:
+    """Health of an endpoint (region and model ID) observed from this process.
+    Latency and error rate are exponentially weighted moving averages, so recent calls weigh more.
+    An endpoint which throttled is cooled down for a while, instead of being called again at once.
+    """
+
+    def __init__(self, alpha: float = BEDROCK_ENDPOINT_HEALTH_EWMA_ALPHA):
+        self.alpha = alpha
+        self.latency: float | None = None
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self._lock = Lock()
+
+    def _update_error_rate(self, error: bool):
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (
+            1.0 if error else 0.0
+        )
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.latency = (
+                latency
+                if self.latency is None
+                else (1 - self.alpha) * self.latency + self.alpha * latency
+            )
+            self._update_error_rate(error=False)
+
+    def record_failure(self, cooldown: float = BEDROCK_ENDPOINT_COOLDOWN_SECONDS):
+        with self._lock:
+            self._update_error_rate(error=True)
+            self.cooldown_until = max(self.cooldown_until, monotonic() + cooldown)
+
+    def is_cooling_down(self) -> bool:
+        return monotonic() < self.cooldown_until
+
+    def is_degraded(self) -> bool:
+        return (
+            self.is_cooling_down()
+            or self.error_rate >= BEDROCK_ENDPOINT_ERROR_RATE_THRESHOLD
+        )
+
+
+_health: dict[str, EndpointHealth] = {}
+_health_lock = Lock()
+
+
+def get_endpoint_health(region: str, model_id: str) -> EndpointHealth:
+    key = f"{region}/{model_id}"
+    with _health_lock:
+        if key not in _health:
+            _health[key] = EndpointHealth()
+        return _health[key]
@@ -1,9 +1,11 @@
 import logging
+import math
 import os
 import traceback
 from typing import Callable
 
 from app.dependencies import get_current_user
+from app.rate_limiter import RateLimitExceededError
 from app.repositories.common import (
     RecordAccessNotAllowedError,
     RecordNotFoundError,
@@ -85,6 +87,16 @@ def error_handler_factory(status_code: int) -> Callable[[Request, Exception], Re
     return error_handler  # type: ignore
 
 
+def rate_limit_error_handler(_: Request, exc: Exception) -> JSONResponse:
+    assert isinstance(exc, RateLimitExceededError)
+    logger.warning(exc)
+    return JSONResponse(
+        {"errors": [str(exc)]},
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
+
 app.add_exception_handler(RecordNotFoundError, error_handler_factory(404))
 app.add_exception_handler(FileNotFoundError, error_handler_factory(404))
 app.add_exception_handler(RecordAccessNotAllowedError, error_handler_factory(403))
@@ -94,6 +106,7 @@ app.add_exception_handler(AssertionError, error_handler_factory(400))
 app.add_exception_handler(PermissionError, error_handler_factory(403))
 app.add_exception_handler(ValidationError, error_handler_factory(422))
 app.add_exception_handler(ResourceConflictError, error_handler_factory(409))
+app.add_exception_handler(RateLimitExceededError, rate_limit_error_handler)
 app.add_exception_handler(Exception, error_handler_factory(500))
 
 
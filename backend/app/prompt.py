@@ -8,9 +8,10 @@ def build_rag_prompt(
     model: type_model_name,
     display_citation: bool = True,
 ) -> str:
-    context_prompt = ""
-    for result in search_results:
-        context_prompt += f"<search_result>\n<content>\n{result['content']}</content>\n<source>\n{result['rank']}\n</source>\n</search_result>"
+    context_prompt = "".join(
+        f"<search_result>\n<content>\n{result['content']}</content>\n<source>\n{result['rank']}\n</source>\n</search_result>"
+        for result in search_results
+    )
 
     # Prompt for RAG
     inserted_prompt = """To answer the user's question, you are given a set of search results. Your job is to answer the user's question using only information from the search results.
@@ -160,3 +161,58 @@ first answer [^aaa].
 """
 
     return inserted_prompt
+
+
+def build_conversation_summary_prompt(summary: str) -> str:
+    # Prompt to give the summary of the earlier turns omitted from the messages.
+    return f"""The earlier part of this conversation is omitted from the messages. Here is the summary of the omitted part:
+<conversation_summary>
+{summary}
+</conversation_summary>
+
+Use the summary only as background. Continue the conversation based on the latest messages.
+"""
+
+
+def get_prompt_to_summarize_conversation(previous_summary: str, transcript: str) -> str:
+    # Prompt to update the rolling summary with the turns going out of the context window.
+    inserted_prompt = ""
+    if previous_summary:
+        inserted_prompt += f"""Here is the summary of the conversation so far:
+<conversation_summary>
+{previous_summary}
+</conversation_summary>
+
+"""
+
+    inserted_prompt += f"""Here is the continuation of the conversation:
+<conversation>
+{transcript}
+</conversation>
+
+Write an updated summary of the whole conversation above. When writing the summary, please follow the rules below:
+<rules>
+- Keep facts, decisions, names, numbers and open questions needed to continue the conversation.
+- Keep the summary concise. Do NOT add information that is not in the conversation.
+- Write the summary in the same language as the conversation.
+- Return the summary only. DO NOT include any strings other than the summary.
+</rules>
+"""
+    return inserted_prompt
+
+
+def get_prompt_to_propose_title(transcript: str) -> str:
+    # Prompt to name the conversation from its first exchange.
+    return f"""Here is the beginning of a conversation:
+<conversation>
+{transcript}
+</conversation>
+
+Reading the conversation above, what is the appropriate title for the conversation? When answering the title, please follow the rules below:
+<rules>
+- Title length must be from 15 to 20 characters.
+- Prefer more specific title than general. Your title should always be distinct from others.
+- Return the conversation title only. DO NOT include any strings other than the title.
+- Title must be in the same language as the conversation.
+</rules>
+"""
@@ -0,0 +1,296 @@
+import logging
+import math
+from collections import OrderedDict, deque
+from threading import Condition, Lock
+from time import monotonic, time
+
+from app.config import (
+    BEDROCK_RATE_LIMIT_MAX_QUEUE_DEPTH,
+    BEDROCK_RATE_LIMIT_MAX_WAIT_SECONDS,
+    BEDROCK_RATE_LIMITS,
+    ENABLE_SHARED_RATE_LIMIT,
+    BedrockRateLimit,
+)
+from app.repositories.rate_limit import (
+    RateLimitState,
+    find_rate_limit_state,
+    update_rate_limit_state,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Attempts to update the shared buckets while other containers are updating them
+_MAX_SHARED_STATE_CONFLICTS = 3
+# Wait before consuming again after the attempts conflicted
+_SHARED_STATE_CONFLICT_WAIT_SECONDS = 0.1
+
+
+class RateLimitExceededError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _refill(
+    state: RateLimitState, limit: BedrockRateLimit, now: float
+) -> RateLimitState:
+    elapsed = max(0.0, now - state["updated_at"])
+    return RateLimitState(
+        request_level=min(
+            limit["requests_per_minute"],
+            state["request_level"] + limit["requests_per_minute"] * elapsed / 60,
+        ),
+        token_level=min(
+            limit["tokens_per_minute"],
+            state["token_level"] + limit["tokens_per_minute"] * elapsed / 60,
+        ),
+        updated_at=now,
+    )
+
+
+def _consume(
+    state: RateLimitState, limit: BedrockRateLimit, tokens: int, now: float
+) -> tuple[RateLimitState, float]:
+    """Refill the buckets and consume a request and the tokens.
+    Returns the new state, and 0 or the seconds to wait until the buckets have enough.
+    """
+    refilled = _refill(state, limit, now)
+    wait = max(
+        (1 - refilled["request_level"]) * 60 / limit["requests_per_minute"],
+        (tokens - refilled["token_level"]) * 60 / limit["tokens_per_minute"],
+        0.0,
+    )
+    if wait > 0:
+        return state, wait
+
+    return (
+        RateLimitState(
+            request_level=refilled["request_level"] - 1,
+            token_level=refilled["token_level"] - tokens,
+            updated_at=now,
+        ),
+        0.0,
+    )
+
+
+def _add_tokens(
+    state: RateLimitState, limit: BedrockRateLimit, tokens: int, now: float
+) -> RateLimitState:
+    """Refill the buckets and add (or take) the tokens, up to the capacity."""
+    refilled = _refill(state, limit, now)
+    refilled["token_level"] = min(
+        limit["tokens_per_minute"], refilled["token_level"] + tokens
+    )
+    return refilled
+
+
+class _LocalBuckets:
+    def __init__(self, limit: BedrockRateLimit):
+        self.limit = limit
+        self.state = RateLimitState(
+            request_level=limit["requests_per_minute"],
+            token_level=limit["tokens_per_minute"],
+            updated_at=monotonic(),
+        )
+
+    def try_consume(self, tokens: int) -> float:
+        self.state, wait = _consume(self.state, self.limit, tokens, monotonic())
+        return wait
+
+    def add_tokens(self, tokens: int):
+        self.state["token_level"] = min(
+            self.limit["tokens_per_minute"], self.state["token_level"] + tokens
+        )
+
+
+class _SharedBuckets:
+    def __init__(self, model: str, limit: BedrockRateLimit):
+        self.model = model
+        self.limit = limit
+
+    def try_consume(self, tokens: int) -> float:
+        for _ in range(_MAX_SHARED_STATE_CONFLICTS):
+            state = find_rate_limit_state(self.model)
+            previous_updated_at = state["updated_at"] if state else None
+            now = time()
+            new_state, wait = _consume(
+                state
+                or RateLimitState(
+                    request_level=self.limit["requests_per_minute"],
+                    token_level=self.limit["tokens_per_minute"],
+                    updated_at=now,
+                ),
+                self.limit,
+                tokens,
+                now,
+            )
+            if wait > 0:
+                return wait
+            if update_rate_limit_state(self.model, new_state, previous_updated_at):
+                return 0.0
+
+        return _SHARED_STATE_CONFLICT_WAIT_SECONDS
+
+    def add_tokens(self, tokens: int):
+        """Settled with the same conditional write as the consumption,
+        so that neither overwrites the other.
+        """
+        for _ in range(_MAX_SHARED_STATE_CONFLICTS):
+            state = find_rate_limit_state(self.model)
+            if state is None:
+                # Nothing consumed from the shared buckets yet
+                return
+            new_state = _add_tokens(state, self.limit, tokens, time())
+            if update_rate_limit_state(self.model, new_state, state["updated_at"]):
+                return
+
+        logger.warning(
+            f"Failed to settle {tokens} tokens of {self.model} with the shared buckets"
+        )
+
+
+class RateLimitReservation:
+    """Capacity reserved for a request. The token count is estimated before the request,
+    so the reservation is settled with the actual usage afterwards.
+    A request failed without reporting usage is settled with 0 tokens, returning the reservation.
+    """
+
+    def __init__(self, limiter: "ModelRateLimiter | None", tokens: int):
+        self.limiter = limiter
+        self.tokens = tokens
+
+    def settle(self, used_tokens: int):
+        if self.limiter is not None and used_tokens != self.tokens:
+            self.limiter.add_tokens(self.tokens - used_tokens)
+
+
+class ModelRateLimiter:
+    """Token buckets of the request and token quotas of a model, with a queue of waiting requests.
+    Waiting requests are queued per user and served round-robin among users,
+    so that a user sending many requests does not starve the others.
+    """
+
+    def __init__(self, model: str, limit: BedrockRateLimit):
+        self.model = model
+        self.limit = limit
+        self.buckets: _LocalBuckets | _SharedBuckets = (
+            _SharedBuckets(model, limit)
+            if ENABLE_SHARED_RATE_LIMIT
+            else _LocalBuckets(limit)
+        )
+        self._condition = Condition()
+        self._queues: OrderedDict[str, deque[object]] = OrderedDict()
+        self._depth = 0
+
+    def _head(self) -> object | None:
+        return next(iter(self._queues.values()))[0] if self._queues else None
+
+    def _dequeue(self, user_id: str, ticket: object, served: bool):
+        queue = self._queues[user_id]
+        queue.remove(ticket)
+        self._depth -= 1
+        if not queue:
+            del self._queues[user_id]
+        elif served:
+            # Next request of the user is served after the other users
+            self._queues.move_to_end(user_id)
+        self._condition.notify_all()
+
+    def _try_consume(self, tokens: int) -> float:
+        """Called with the condition held. Shared buckets are updated with the condition
+        released, so that the DynamoDB calls do not block the other requests.
+        Only the head of the queue consumes, so the queue is not changed meanwhile.
+        """
+        if isinstance(self.buckets, _LocalBuckets):
+            return self.buckets.try_consume(tokens)
+
+        self._condition.release()
+        try:
+            return self.buckets.try_consume(tokens)
+        finally:
+            self._condition.acquire()
+
+    def _reject(self, retry_after: float):
+        logger.warning(
+            f"Rate limit of {self.model} exceeded: {self._depth} requests waiting, retry after {retry_after:.1f}s"
+        )
+        raise RateLimitExceededError(
+            f"Too many requests to {self.model}. Retry after {math.ceil(retry_after)} seconds.",
+            retry_after=retry_after,
+        )
+
+    def acquire(self, user_id: str, tokens: int) -> RateLimitReservation:
+        """Wait until the request can be sent within the quotas.
+        Raises `RateLimitExceededError` if it is not expected to be sent within the max wait.
+        """
+        # A request larger than the bucket could never be sent
+        tokens = min(tokens, self.limit["tokens_per_minute"])
+        with self._condition:
+            # Requests served before this one in the round-robin among users
+            own = len(self._queues.get(user_id, ()))
+            ahead = own + sum(
+                min(len(queue), own + 1)
+                for other_user_id, queue in self._queues.items()
+                if other_user_id != user_id
+            )
+            expected_wait = ahead * 60 / self.limit["requests_per_minute"]
+            if (
+                self._depth >= BEDROCK_RATE_LIMIT_MAX_QUEUE_DEPTH
+                or expected_wait > BEDROCK_RATE_LIMIT_MAX_WAIT_SECONDS
+            ):
+                self._reject(expected_wait)
+
+            ticket = object()
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            self._depth += 1
+            deadline = monotonic() + BEDROCK_RATE_LIMIT_MAX_WAIT_SECONDS
+            while True:
+                remaining = deadline - monotonic()
+                if self._head() is ticket:
+                    wait = self._try_consume(tokens)
+                    if wait == 0:
+                        self._dequeue(user_id, ticket, served=True)
+                        return RateLimitReservation(self, tokens)
+                    if wait > remaining:
+                        self._dequeue(user_id, ticket, served=False)
+                        self._reject(wait)
+                    self._condition.wait(timeout=wait)
+
+                elif remaining <= 0:
+                    self._dequeue(user_id, ticket, served=False)
+                    self._reject(self._depth * 60 / self.limit["requests_per_minute"])
+
+                else:
+                    self._condition.wait(timeout=remaining)
+
+    def add_tokens(self, tokens: int):
+        if isinstance(self.buckets, _SharedBuckets):
+            # Not holding the condition during the DynamoDB call
+            self.buckets.add_tokens(tokens)
+            with self._condition:
+                self._condition.notify_all()
+        else:
+            with self._condition:
+                self.buckets.add_tokens(tokens)
+                self._condition.notify_all()
+
+
+_limiters: dict[str, ModelRateLimiter] = {}
+_limiters_lock = Lock()
+
+
+def acquire(model: str, user_id: str | None, tokens: int) -> RateLimitReservation:
+    """Reserve a request and the estimated tokens (input and max output) on the quotas of the model.
+    Models without a quota in `BEDROCK_RATE_LIMITS` are not limited.
+    """
+    limit = BEDROCK_RATE_LIMITS.get(model)
+    if limit is None:
+        return RateLimitReservation(None, 0)
+
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = ModelRateLimiter(model, limit)
+        limiter = _limiters[model]
+
+    return limiter.acquire(user_id or "", tokens)
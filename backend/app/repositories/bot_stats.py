@@ -0,0 +1,156 @@
+import logging
+import random
+
+from app.config import BOT_USAGE_COUNTER_SHARDS
+from app.repositories.common import (
+    BOT_TABLE_NAME,
+    compose_bot_stats_pk,
+    compose_bot_stats_shard_sk,
+    compose_sk,
+    decompose_bot_stats_pk,
+    get_bot_table_client,
+    get_dynamodb_client,
+)
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Sparse index of the shards with usage counts not rolled up yet.
+# Partition key is `PendingRollUp`, which holds the shard's own PK, and sort key is `SK`.
+PENDING_ROLL_UP_INDEX_NAME = "PendingRollUpIndex"
+
+
+def increment_bot_usage_count(owner_user_id: str, bot_id: str, increment: int):
+    """Increment the usage count on a random shard of the bot's counter.
+    Spreading the writes over shards avoids the bot item becoming a hot key for popular bots.
+    Shards are rolled up into `UsageStats.usage_count` of the bot item by `roll_up_usage_counts`.
+    The shard is marked pending in the same write, so that the roll-up finds it from the sparse index.
+    """
+    table = get_bot_table_client()
+    shard = random.randrange(BOT_USAGE_COUNTER_SHARDS)
+    pk = compose_bot_stats_pk(owner_user_id, bot_id)
+    logger.info(f"Incrementing usage count shard {shard} for bot: {bot_id}")
+
+    return table.update_item(
+        Key={"PK": pk, "SK": compose_bot_stats_shard_sk(shard)},
+        UpdateExpression="ADD UsageCount :val SET PendingRollUp = :pk",
+        ExpressionAttributeValues={":val": increment, ":pk": pk},
+    )
+
+
+def _find_pending_shards() -> dict[str, list[dict]]:
+    """Shards marked pending, by the PK of the bot's counter."""
+    table = get_bot_table_client()
+    shards_by_pk: dict[str, list[dict]] = {}
+    scan_params = {"IndexName": PENDING_ROLL_UP_INDEX_NAME}
+    while True:
+        response = table.scan(**scan_params)
+        for item in response["Items"]:
+            shards_by_pk.setdefault(item["PK"], []).append(item)
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return shards_by_pk
+
+
+def _unmark_rolled_up(shards: list[dict]):
+    """Remove the pending mark of the shards emptied by the roll-up.
+    A shard incremented meanwhile keeps the mark and is rolled up next time.
+    """
+    table = get_bot_table_client()
+    for shard in shards:
+        try:
+            table.update_item(
+                Key={"PK": shard["PK"], "SK": shard["SK"]},
+                UpdateExpression="REMOVE PendingRollUp",
+                ConditionExpression="UsageCount = :zero",
+                ExpressionAttributeValues={":zero": 0},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise e
+
+
+def _roll_up_bot(owner_user_id: str, bot_id: str, shards: list[dict]):
+    counts = {
+        shard["SK"]: int(shard["UsageCount"])
+        for shard in shards
+        if int(shard.get("UsageCount", 0)) > 0
+    }
+    if not counts:
+        _unmark_rolled_up(shards)
+        return
+
+    total = sum(counts.values())
+    client = get_dynamodb_client(table_type="bot")
+    try:
+        # Move the counts from the shards into the bot item atomically,
+        # so that increments made during the roll-up are kept on the shards.
+        client.transact_write_items(
+            TransactItems=[
+                {
+                    "Update": {
+                        "TableName": BOT_TABLE_NAME,
+                        "Key": {"PK": owner_user_id, "SK": compose_sk(bot_id, "bot")},
+                        "UpdateExpression": "SET UsageStats.usage_count = if_not_exists(UsageStats.usage_count, :zero) + :val",
+                        "ExpressionAttributeValues": {":zero": 0, ":val": total},
+                        "ConditionExpression": "attribute_exists(PK) AND attribute_exists(SK)",
+                    }
+                },
+                *[
+                    {
+                        "Update": {
+                            "TableName": BOT_TABLE_NAME,
+                            "Key": {
+                                "PK": compose_bot_stats_pk(owner_user_id, bot_id),
+                                "SK": sk,
+                            },
+                            "UpdateExpression": "ADD UsageCount :val",
+                            "ExpressionAttributeValues": {
+                                ":val": -count,
+                                ":count": count,
+                            },
+                            "ConditionExpression": "UsageCount >= :count",
+                        }
+                    }
+                    for sk, count in counts.items()
+                ],
+            ]
+        )
+        logger.info(f"Rolled up {total} usages for bot: {bot_id}")
+
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "TransactionCanceledException":
+            raise e
+
+        reasons = e.response.get("CancellationReasons", [])
+        if reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+            # The bot was removed. Its shards are not needed anymore.
+            logger.info(f"Bot {bot_id} not found. Deleting usage count shards.")
+            table = get_bot_table_client()
+            with table.batch_writer() as writer:
+                for shard in shards:
+                    writer.delete_item(Key={"PK": shard["PK"], "SK": shard["SK"]})
+        else:
+            # Still marked pending, so retried on the next roll-up
+            logger.warning(f"Roll-up for bot {bot_id} was cancelled: {reasons}")
+        return
+
+    _unmark_rolled_up(shards)
+
+
+def roll_up_usage_counts():
+    """Roll up the usage count shards marked pending into the bot items.
+    Only the shards used since the last roll-up are read, from the sparse index.
+    """
+    shards_by_pk = _find_pending_shards()
+    logger.info(f"Rolling up usage counts for {len(shards_by_pk)} bots")
+    for pk, shards in shards_by_pk.items():
+        owner_user_id, bot_id = decompose_bot_stats_pk(pk)
+        try:
+            _roll_up_bot(owner_user_id, bot_id, shards)
+        except Exception as e:
+            logger.exception(f"Failed to roll up usage counts for bot {bot_id}: {e}")
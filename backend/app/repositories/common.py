@@ -60,6 +60,19 @@ def decompose_related_document_source_id(composed_id: str):
     return composed_id.split("#")[-1]
 
 
+def compose_context_summary_id(
+    user_id: str,
+    conversation_id: str,
+    message_id: str,
+):
+    # Add user_id prefix for row level security to match with `LeadingKeys` condition
+    return f"{user_id}#CONTEXT_SUMMARY#{conversation_id}#{message_id}"
+
+
+def decompose_context_summary_id(composed_id: str):
+    return composed_id.split("#")[-1]
+
+
 def compose_item_type(user_id: str, item_type: Literal["bot", "alias"]):
     if item_type == "bot":
         return f"{user_id}#BOT"
@@ -79,6 +92,34 @@ def decompose_sk(sk: str):
     return sk.split("#")[-1]
 
 
+def compose_instruction_pk(bot_id: str):
+    return f"INSTRUCTION#{bot_id}"
+
+
+def compose_instruction_sk(content_hash: str):
+    return f"INSTRUCTION#{content_hash}"
+
+
+def compose_bot_stats_pk(owner_user_id: str, bot_id: str):
+    # NOTE: Must not start with "BOT#", which is used for bot items.
+    # Keyed by the owner too, as copied bots share the bot id under different owners.
+    return f"BOT_STATS#{owner_user_id}#{bot_id}"
+
+
+def decompose_bot_stats_pk(pk: str) -> tuple[str, str]:
+    """Owner user id and bot id of the usage count shard."""
+    _, owner_user_id, bot_id = pk.split("#", 2)
+    return owner_user_id, bot_id
+
+
+def compose_bot_stats_shard_sk(shard: int):
+    return f"STATS#SHARD#{shard}"
+
+
+def compose_rate_limit_pk(model: str):
+    return f"RATE_LIMIT#{model}"
+
+
 def _get_aws_resource(service_name, table_name: str, user_id: str | None = None):
     """Get AWS resource with optional row-level access control for DynamoDB.
     Ref: https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_examples_dynamodb_items.html
@@ -1,25 +1,36 @@
 import json
 import logging
 import os
+from collections.abc import ItemsView, Iterator, MutableMapping, ValuesView
 from decimal import Decimal as decimal
+from typing import Any, TypedDict, cast
 
 import boto3
-from typing import Dict
 from app.repositories.common import (
     TRANSACTION_BATCH_WRITE_SIZE,
     RecordNotFoundError,
+    compose_context_summary_id,
     compose_conv_id,
     compose_related_document_source_id,
+    decompose_context_summary_id,
     decompose_conv_id,
     decompose_related_document_source_id,
     get_conversation_table_client,
 )
+from app.repositories.instruction import (
+    compute_instruction_hash,
+    find_instruction_by_hash,
+    store_instruction,
+)
+from app.repositories.message_tree import MessageTreeIndex
+from app.token_estimator import estimate_turn_tokens
 from app.repositories.models.conversation import (
     ConversationMeta,
     ConversationModel,
     FeedbackModel,
     MessageModel,
     RelatedDocumentModel,
+    TextContentModel,
     ToolResultModel,
 )
 from boto3.dynamodb.conditions import Key
@@ -35,11 +46,231 @@ LARGE_MESSAGE_BUCKET = os.environ.get("LARGE_MESSAGE_BUCKET")
 BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "us-east-1")
 s3_client = boto3.client("s3", BEDROCK_REGION)
 
+_message_map_adapter = TypeAdapter(dict[str, MessageModel])
+
+
+class ContextSummary(TypedDict):
+    # Last message covered by the summary
+    message_id: str
+    summary: str
+    create_time: float
+
+
+class LazyMessageMap(MutableMapping[str, MessageModel]):
+    """Message map which keeps raw items loaded from the table and validates
+    each message only when it is accessed.
+    Untouched messages are written back as they were loaded, without re-serialization.
+    """
+
+    def __init__(
+        self,
+        raw_message_map: dict[str, Any],
+        tree_index: MessageTreeIndex | None = None,
+        token_counts: dict[str, int] | None = None,
+    ):
+        self._items: dict[str, MessageModel | dict[str, Any]] = dict(raw_message_map)
+        # Reference to the stored instruction the map was loaded with, i.e. `InstructionRef`
+        self.instruction_ref: dict[str, str] | None = None
+        # Estimated token counts of each message with its retained tool logs
+        self.token_counts: dict[str, int] = dict(token_counts or {})
+        # A persisted index is reused only if it covers exactly the loaded messages
+        self._tree_index = (
+            tree_index
+            if tree_index is not None and tree_index.ids == list(self._items)
+            else None
+        )
+
+    @property
+    def tree_index(self) -> MessageTreeIndex:
+        """Tree index of the map. Rebuilt from parent/children links after the map is modified."""
+        if self._tree_index is None:
+            self._tree_index = MessageTreeIndex.from_message_map(self._items)
+
+        return self._tree_index
+
+    def rebuild_tree_index(self) -> MessageTreeIndex:
+        """Rebuild the tree index from the current links, which may have been edited in place
+        (e.g. `children` of a message appended without replacing the message).
+        """
+        self._tree_index = MessageTreeIndex.from_message_map(self._items)
+        return self._tree_index
+
+    def __getitem__(self, key: str) -> MessageModel:
+        item = self._items[key]
+        if isinstance(item, MessageModel):
+            return item
+
+        message = MessageModel.model_validate(item)
+        self._items[key] = message
+        return message
+
+    def __setitem__(self, key: str, value: MessageModel):
+        self._items[key] = value
+        self._tree_index = None
+        self.token_counts.pop(key, None)
+        if key == "instruction":
+            self.instruction_ref = None
+
+    def __delitem__(self, key: str):
+        del self._items[key]
+        self._tree_index = None
+        self.token_counts.pop(key, None)
+        if key == "instruction":
+            self.instruction_ref = None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._items
+
+    def __repr__(self) -> str:
+        validated = sum(isinstance(v, MessageModel) for v in self._items.values())
+        return f"LazyMessageMap(size={len(self._items)}, validated={validated})"
+
+    def create_time_of(self, key: str) -> float:
+        """Creation time of the message, read without validating it."""
+        item = self._items[key]
+        if isinstance(item, MessageModel):
+            return item.create_time
+
+        return float(item["create_time"])
+
+    def validate_all(self):
+        """Validate all remaining raw items at once. Used by bulk access paths."""
+        raw_items = {k: v for k, v in self._items.items() if isinstance(v, dict)}
+        if raw_items:
+            self._items.update(_message_map_adapter.validate_python(raw_items))
+
+    def items(self) -> ItemsView[str, MessageModel]:
+        self.validate_all()
+        return cast(ItemsView[str, MessageModel], self._items.items())
+
+    def values(self) -> ValuesView[MessageModel]:
+        self.validate_all()
+        return cast(ValuesView[MessageModel], self._items.values())
+
+    def dump(self) -> dict[str, Any]:
+        return {
+            k: v.model_dump(by_alias=True) if isinstance(v, MessageModel) else v
+            for k, v in self._items.items()
+        }
+
+
+def get_tree_index(message_map: MutableMapping[str, MessageModel]) -> MessageTreeIndex:
+    """Get the tree index of the message map, reusing the one loaded with the conversation if possible."""
+    if isinstance(message_map, LazyMessageMap):
+        return message_map.tree_index
+
+    return MessageTreeIndex.from_message_map(message_map)
+
+
+def _build_tree_index(
+    message_map: MutableMapping[str, MessageModel],
+) -> MessageTreeIndex:
+    if isinstance(message_map, LazyMessageMap):
+        return message_map.rebuild_tree_index()
+
+    return MessageTreeIndex.from_message_map(message_map)
+
+
+def get_create_time(
+    message_map: MutableMapping[str, MessageModel], message_id: str
+) -> float:
+    """Get the creation time of the message, without validating it if it is not loaded yet."""
+    if isinstance(message_map, LazyMessageMap):
+        return message_map.create_time_of(message_id)
+
+    return message_map[message_id].create_time
+
+
+def get_token_count(
+    message_map: MutableMapping[str, MessageModel], message_id: str
+) -> int:
+    """Get the estimated token count of the message with its retained tool logs.
+    Counts are stored with the conversation, so estimating a branch is a sum of cached values.
+    """
+    if isinstance(message_map, LazyMessageMap):
+        count = message_map.token_counts.get(message_id)
+        if count is None:
+            message = message_map[message_id]
+            count = estimate_turn_tokens(message, message.model)
+            message_map.token_counts[message_id] = count
+
+        return count
+
+    message = message_map[message_id]
+    return estimate_turn_tokens(message, message.model)
+
+
+def _dump_message_map(message_map: MutableMapping[str, MessageModel]) -> dict[str, Any]:
+    if isinstance(message_map, LazyMessageMap):
+        return message_map.dump()
+
+    return {k: v.model_dump(by_alias=True) for k, v in message_map.items()}
+
+
+def _compose_message_map_item(
+    conversation: ConversationModel,
+) -> tuple[dict[str, Any], dict[str, str] | None]:
+    """Dump the message map for storing.
+    The bot instruction is stored in the instruction store and the message map keeps only
+    a reference to it, so long instructions are not rewritten on every turn.
+    """
+    message_map = _dump_message_map(conversation.message_map)
+    if conversation.bot_id is None or "instruction" not in conversation.message_map:
+        return message_map, None
+
+    instruction = conversation.message_map["instruction"]
+    if (
+        len(instruction.content) != 1
+        or not isinstance(instruction.content[0], TextContentModel)
+        or not instruction.content[0].body
+    ):
+        return message_map, None
+
+    instruction_ref = {
+        "BotId": conversation.bot_id,
+        "Hash": compute_instruction_hash(instruction.content[0].body),
+    }
+    if (
+        not isinstance(conversation.message_map, LazyMessageMap)
+        or conversation.message_map.instruction_ref != instruction_ref
+    ):
+        # Written only for a new conversation or a changed instruction
+        store_instruction(conversation.bot_id, instruction.content[0].body)
+
+    message_map["instruction"] = instruction.model_copy(
+        update={"content": [TextContentModel(content_type="text", body="")]}
+    ).model_dump(by_alias=True)
+    return message_map, instruction_ref
+
+
+def _resolve_instruction(message_map: LazyMessageMap, instruction_ref: dict[str, str]):
+    """Restore the instruction text referred by `InstructionRef`.
+    Raises `RecordNotFoundError` if the instruction is missing, as the conversation cannot
+    continue without it.
+    """
+    if "instruction" not in message_map:
+        return
+
+    body = find_instruction_by_hash(instruction_ref["BotId"], instruction_ref["Hash"])
+    message_map["instruction"].content = [
+        TextContentModel(
+            content_type="text",
+            body=body,
+        )
+    ]
+    message_map.instruction_ref = instruction_ref
+
 
 def store_conversation(
     user_id: str, conversation: ConversationModel, threshold=THRESHOLD_LARGE_MESSAGE
 ):
-    logger.info(f"Storing conversation: {conversation.model_dump_json()}")
+    logger.info(f"Storing conversation: {conversation.id}")
     table = get_conversation_table_client(user_id)
 
     item_params = {
@@ -57,12 +288,34 @@ def store_conversation(
     if conversation.bot_id:
         item_params["BotId"] = conversation.bot_id
 
-    message_map = {
-        k: v.model_dump(by_alias=True) for k, v in conversation.message_map.items()
-    }
+    # Persist the tree index so that the next load can traverse without rebuilding it.
+    # Rebuilt from the current links, so that in-place edits are never persisted stale.
+    tree_index = json.dumps(_build_tree_index(conversation.message_map).to_dict())
+    token_counts = json.dumps(
+        {
+            message_id: get_token_count(conversation.message_map, message_id)
+            for message_id in conversation.message_map
+        }
+    )
+
+    message_map, instruction_ref = _compose_message_map_item(conversation)
+    if instruction_ref:
+        item_params["InstructionRef"] = instruction_ref
+
     message_map_size = len(json.dumps(message_map).encode("utf-8"))
     logger.info(f"Message map size: {message_map_size}")
-    if message_map_size > threshold:
+    # The index and token counts are stored in the same item, so they count toward
+    # the item size limit. They are rebuilt on load if not stored.
+    index_size = 0
+    for name, value in (("TreeIndex", tree_index), ("TokenCounts", token_counts)):
+        size = len(value.encode("utf-8"))
+        if index_size + size <= threshold:
+            item_params[name] = value
+            index_size += size
+        else:
+            logger.info(f"{name} size {size} exceeds threshold {threshold}")
+
+    if message_map_size + index_size > threshold:
         logger.info(
             f"Message map size {message_map_size} exceeds threshold {threshold}"
         )
@@ -83,10 +336,33 @@ def store_conversation(
         item_params["IsLargeMessage"] = False
         item_params["MessageMap"] = json.dumps(message_map)
 
-    response = table.put_item(
+    try:
+        response = _put_keeping_title(table, item_params)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise e
+        # The title was changed after the conversation was loaded,
+        # e.g. generated in background or renamed by the user. Keep it.
+        current = table.get_item(
+            Key={"PK": item_params["PK"], "SK": item_params["SK"]},
+            ProjectionExpression="Title",
+            ConsistentRead=True,
+        )
+        item_params["Title"] = current["Item"]["Title"]
+        response = _put_keeping_title(table, item_params)
+
+    return response
+
+
+def _put_keeping_title(table, item_params: dict):
+    """Put the conversation item only if its title is still the one being written.
+    The title is changed only by `change_conversation_title`.
+    """
+    return table.put_item(
         Item=item_params,
+        ConditionExpression="attribute_not_exists(PK) OR Title = :title",
+        ExpressionAttributeValues={":title": item_params["Title"]},
     )
-    return response
 
 
 def find_conversation_by_user_id(user_id: str) -> list[ConversationMeta]:
@@ -169,16 +445,32 @@ def find_conversation_by_id(user_id: str, conversation_id: str) -> ConversationM
     else:
         message_map = json.loads(item["MessageMap"])
 
-    conv = ConversationModel(
+    # NOTE: Skip validation here so that messages are validated lazily on access.
+    conv = ConversationModel.model_construct(
         id=decompose_conv_id(item["SK"]),
         create_time=float(item["CreateTime"]),
         title=item["Title"],
-        total_price=item.get("TotalPrice", 0),
-        message_map={k: MessageModel.model_validate(v) for k, v in message_map.items()},
+        total_price=float(item.get("TotalPrice", 0)),
+        message_map=LazyMessageMap(
+            message_map,
+            tree_index=(
+                MessageTreeIndex.from_dict(json.loads(item["TreeIndex"]))
+                if "TreeIndex" in item
+                else None
+            ),
+            token_counts=(
+                json.loads(item["TokenCounts"]) if "TokenCounts" in item else None
+            ),
+        ),
         last_message_id=item["LastMessageId"],
         bot_id=item["BotId"] if "BotId" in item else None,
         should_continue=item.get("ShouldContinue", False),
     )
+    if "InstructionRef" in item:
+        _resolve_instruction(
+            cast(LazyMessageMap, conv.message_map), item["InstructionRef"]
+        )
+
     logger.info(f"Found conversation: {conv}")
     return conv
 
@@ -210,6 +502,10 @@ def delete_conversation_by_id(user_id: str, conversation_id: str):
             user_id=user_id,
             conversation_id=conversation_id,
         )
+        delete_context_summaries(
+            user_id=user_id,
+            conversation_id=conversation_id,
+        )
 
     except ClientError as e:
         if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
@@ -269,13 +565,22 @@ def delete_conversation_by_user_id(user_id: str):
             )
 
         delete_related_documents(user_id=user_id)
+        delete_context_summaries(user_id=user_id)
 
     except ClientError as e:
         logger.error(f"An error occurred: {e.response['Error']['Message']}")
         raise e
 
 
-def change_conversation_title(user_id: str, conversation_id: str, new_title: str):
+def change_conversation_title(
+    user_id: str,
+    conversation_id: str,
+    new_title: str,
+    expected_title: str | None = None,
+):
+    """Update the title. If `expected_title` is given, the title is updated only if it is unchanged,
+    e.g. not to overwrite the title renamed by the user with a generated one.
+    """
     logger.info(f"Updating conversation title: {conversation_id} to {new_title}")
     table = get_conversation_table_client(user_id)
 
@@ -286,14 +591,23 @@ def change_conversation_title(user_id: str, conversation_id: str, new_title: str
                 "SK": compose_conv_id(user_id, conversation_id),
             },
             UpdateExpression="set Title=:t",
-            ExpressionAttributeValues={":t": new_title},
+            ExpressionAttributeValues={
+                ":t": new_title,
+                **({":expected": expected_title} if expected_title is not None else {}),
+            },
             ReturnValues="UPDATED_NEW",
-            ConditionExpression="attribute_exists(PK) AND attribute_exists(SK)",
+            ConditionExpression="attribute_exists(PK) AND attribute_exists(SK)"
+            + (" AND Title = :expected" if expected_title is not None else ""),
         )
     except ClientError as e:
         if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
             raise RecordNotFoundError(
                 f"Conversation with id {conversation_id} not found"
+                + (
+                    f" with title {expected_title}"
+                    if expected_title is not None
+                    else ""
+                )
             )
         else:
             raise e
@@ -319,9 +633,7 @@ def update_feedback(
         },
         UpdateExpression="set MessageMap = :m",
         ExpressionAttributeValues={
-            ":m": json.dumps(
-                {k: v.model_dump(by_alias=True) for k, v in message_map.items()}
-            )
+            ":m": json.dumps(_compose_message_map_item(conv)[0])
         },
         ConditionExpression="attribute_exists(PK) AND attribute_exists(SK)",
         ReturnValues="UPDATED_NEW",
@@ -469,3 +781,104 @@ def delete_related_documents(user_id: str, conversation_id: str | None = None):
                     "SK": sort_key,
                 },
             )
+
+
+def store_context_summary(
+    user_id: str,
+    conversation_id: str,
+    context_summary: ContextSummary,
+):
+    table = get_conversation_table_client(user_id)
+    logger.info(
+        f"Storing context summary until {context_summary['message_id']} for conversation: {conversation_id}"
+    )
+    table.put_item(
+        Item={
+            "PK": user_id,
+            "SK": compose_context_summary_id(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                message_id=context_summary["message_id"],
+            ),
+            "Summary": context_summary["summary"],
+            "CreateTime": decimal(context_summary["create_time"]),
+        }
+    )
+
+
+def find_context_summaries_by_conversation_id(
+    user_id: str,
+    conversation_id: str,
+) -> dict[str, ContextSummary]:
+    """Find context summaries of the conversation, keyed by the last message covered."""
+    table = get_conversation_table_client(user_id)
+    context_summaries: dict[str, ContextSummary] = {}
+
+    last_evaluated_key = None
+    while True:
+        response = table.query(
+            KeyConditionExpression=(
+                Key("PK").eq(user_id)
+                & Key("SK").begins_with(f"{user_id}#CONTEXT_SUMMARY#{conversation_id}#")
+            ),
+            **(
+                {
+                    "ExclusiveStartKey": last_evaluated_key,
+                }
+                if last_evaluated_key is not None
+                else {}
+            ),
+        )
+        for item in response.get("Items") or []:
+            message_id = decompose_context_summary_id(composed_id=item["SK"])
+            context_summaries[message_id] = ContextSummary(
+                message_id=message_id,
+                summary=item["Summary"],
+                create_time=float(item["CreateTime"]),
+            )
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if last_evaluated_key is None:
+            break
+
+    return context_summaries
+
+
+def delete_context_summaries(user_id: str, conversation_id: str | None = None):
+    table = get_conversation_table_client(user_id)
+    sort_keys: list[str] = []
+
+    last_evaluated_key = None
+    while True:
+        response = table.query(
+            KeyConditionExpression=(
+                Key("PK").eq(user_id)
+                & Key("SK").begins_with(
+                    f"{user_id}#CONTEXT_SUMMARY#{conversation_id}#"
+                    if conversation_id
+                    else f"{user_id}#CONTEXT_SUMMARY#"
+                )
+            ),
+            ProjectionExpression="SK",
+            **(
+                {
+                    "ExclusiveStartKey": last_evaluated_key,
+                }
+                if last_evaluated_key is not None
+                else {}
+            ),
+        )
+        sort_keys.extend(item["SK"] for item in response.get("Items") or [])
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if last_evaluated_key is None:
+            break
+
+    with table.batch_writer() as writer:
+        for sort_key in sort_keys:
+            writer.delete_item(
+                Key={
+                    "PK": user_id,
+                    "SK": sort_key,
+                },
+            )
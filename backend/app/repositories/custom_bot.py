@@ -8,6 +8,7 @@ from typing import Union
 
 import boto3
 from app.config import DEFAULT_GENERATION_CONFIG
+from app.repositories.bot_stats import increment_bot_usage_count
 from app.repositories.common import (
     TRANSACTION_BATCH_READ_SIZE,
     RecordNotFoundError,
@@ -363,24 +364,9 @@ def update_alias_last_used_time(user_id: str, original_bot_id: str):
 def update_bot_stats(owner_user_id: str, bot_id: str, increment: int):
     """Update usage stats for bot.
     Currently only supports incrementing usage count.
+    NOTE: The count is written to a sharded counter and rolled up into `UsageStats` periodically.
     """
-    table = get_bot_table_client()
-    logger.info(f"Updating usage stats for bot: {bot_id}")
-
-    try:
-        response = table.update_item(
-            Key={"PK": owner_user_id, "SK": compose_sk(bot_id, "bot")},
-            UpdateExpression="SET UsageStats.usage_count = if_not_exists(UsageStats.usage_count, :zero) + :val",
-            ExpressionAttributeValues={":zero": 0, ":val": increment},
-            ConditionExpression="attribute_exists(PK) AND attribute_exists(SK)",
-            ReturnValues="ALL_NEW",
-        )
-        return response
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            raise RecordNotFoundError(f"Bot with id {bot_id} not found")
-        else:
-            raise e
+    return increment_bot_usage_count(owner_user_id, bot_id, increment)
 
 
 def update_bot_star_status(user_id: str, bot_id: str, starred: bool):
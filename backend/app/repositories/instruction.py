@@ -0,0 +1,63 @@
+import hashlib
+import logging
+from functools import lru_cache
+
+from app.repositories.common import (
+    RecordNotFoundError,
+    compose_instruction_pk,
+    compose_instruction_sk,
+    get_bot_table_client,
+)
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def compute_instruction_hash(instruction: str) -> str:
+    return hashlib.sha256(instruction.encode("utf-8")).hexdigest()
+
+
+def store_instruction(bot_id: str, instruction: str) -> str:
+    """Store bot instruction into the content-addressed instruction store.
+    Stored instructions are immutable, so conversations referring to a hash keep the
+    instruction as it was when the conversation started, even if the bot is edited later.
+    They are kept when the bot is removed, as the conversations still refer to them.
+    Returns the content hash.
+    """
+    content_hash = compute_instruction_hash(instruction)
+    table = get_bot_table_client()
+    logger.info(f"Storing instruction {content_hash} for bot: {bot_id}")
+    try:
+        table.put_item(
+            Item={
+                "PK": compose_instruction_pk(bot_id),
+                "SK": compose_instruction_sk(content_hash),
+                "Instruction": instruction,
+            },
+            ConditionExpression="attribute_not_exists(PK)",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise e
+        # Already stored
+
+    return content_hash
+
+
+@lru_cache(maxsize=256)
+def find_instruction_by_hash(bot_id: str, content_hash: str) -> str:
+    table = get_bot_table_client()
+    logger.info(f"Finding instruction {content_hash} for bot: {bot_id}")
+    response = table.get_item(
+        Key={
+            "PK": compose_instruction_pk(bot_id),
+            "SK": compose_instruction_sk(content_hash),
+        },
+    )
+    if "Item" not in response:
+        raise RecordNotFoundError(
+            f"Instruction {content_hash} not found for bot: {bot_id}"
+        )
+
+    return response["Item"]["Instruction"]
@@ -0,0 +1,140 @@
+from array import array
+from collections.abc import Mapping
+from typing import Any, TypedDict
+
+from app.repositories.models.conversation import MessageModel
+
+
+class MessageTreeIndexDict(TypedDict):
+    ids: list[str]
+    parents: list[int]
+    child_offsets: list[int]
+    children: list[int]
+
+
+def _links_of(item: MessageModel | dict[str, Any]) -> tuple[str | None, list[str]]:
+    if isinstance(item, MessageModel):
+        return item.parent, item.children
+
+    return item.get("parent"), item.get("children") or []
+
+
+class MessageTreeIndex:
+    """Compact index of the message tree.
+    Message ids are interned into integer positions and the tree is kept in parallel arrays:
+    `parents[i]` is the position of the parent of message `i` (-1 for the root), and the
+    children of message `i` are `children[child_offsets[i]:child_offsets[i + 1]]`.
+    Traversal never touches message payloads.
+    """
+
+    def __init__(
+        self,
+        ids: list[str],
+        parents: array,
+        child_offsets: array,
+        children: array,
+    ):
+        self.ids = ids
+        self.positions = {message_id: i for i, message_id in enumerate(ids)}
+        self.parents = parents
+        self.child_offsets = child_offsets
+        self.children = children
+
+    @classmethod
+    def from_links(
+        cls, links: Mapping[str, tuple[str | None, list[str]]]
+    ) -> "MessageTreeIndex":
+        ids = list(links.keys())
+        positions = {message_id: i for i, message_id in enumerate(ids)}
+
+        parents = array("i")
+        child_offsets = array("i", [0])
+        children = array("i")
+        for message_id in ids:
+            parent_id, child_ids = links[message_id]
+            parents.append(positions.get(parent_id, -1) if parent_id else -1)
+            children.extend(
+                positions[child_id] for child_id in child_ids if child_id in positions
+            )
+            child_offsets.append(len(children))
+
+        return cls(ids, parents, child_offsets, children)
+
+    @classmethod
+    def from_message_map(
+        cls, message_map: Mapping[str, MessageModel | dict[str, Any]]
+    ) -> "MessageTreeIndex":
+        return cls.from_links(
+            {message_id: _links_of(item) for message_id, item in message_map.items()}
+        )
+
+    @classmethod
+    def from_dict(cls, data: MessageTreeIndexDict) -> "MessageTreeIndex":
+        return cls(
+            ids=list(data["ids"]),
+            parents=array("i", data["parents"]),
+            child_offsets=array("i", data["child_offsets"]),
+            children=array("i", data["children"]),
+        )
+
+    def to_dict(self) -> MessageTreeIndexDict:
+        return {
+            "ids": self.ids,
+            "parents": self.parents.tolist(),
+            "child_offsets": self.child_offsets.tolist(),
+            "children": self.children.tolist(),
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, message_id: object) -> bool:
+        return message_id in self.positions
+
+    def parent_of(self, message_id: str) -> str | None:
+        parent = self.parents[self.positions[message_id]]
+        return self.ids[parent] if parent >= 0 else None
+
+    def children_of(self, message_id: str) -> list[str]:
+        i = self.positions[message_id]
+        return [
+            self.ids[child]
+            for child in self.children[
+                self.child_offsets[i] : self.child_offsets[i + 1]
+            ]
+        ]
+
+    def siblings_of(self, message_id: str) -> list[str]:
+        """Children of the parent, including the message itself."""
+        parent_id = self.parent_of(message_id)
+        return self.children_of(parent_id) if parent_id is not None else [message_id]
+
+    def path_to_root(self, message_id: str) -> list[str]:
+        """Message ids from `message_id` up to the root node."""
+        result: list[str] = []
+        i = self.positions.get(message_id, -1)
+        while i >= 0:
+            result.append(self.ids[i])
+            i = self.parents[i]
+
+        return result
+
+    def depth_of(self, message_id: str) -> int:
+        depth = 0
+        i = self.parents[self.positions[message_id]]
+        while i >= 0:
+            depth += 1
+            i = self.parents[i]
+
+        return depth
+
+    def latest_leaf_of(self, message_id: str) -> list[str]:
+        """Message ids from `message_id` down to the leaf, following the latest child."""
+        result: list[str] = []
+        i = self.positions.get(message_id, -1)
+        while i >= 0:
+            result.append(self.ids[i])
+            start, end = self.child_offsets[i], self.child_offsets[i + 1]
+            i = self.children[end - 1] if end > start else -1
+
+        return result
@@ -0,0 +1,72 @@
+import logging
+from decimal import Decimal
+from typing import TypedDict
+
+from app.repositories.common import compose_rate_limit_pk, get_bot_table_client
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RATE_LIMIT_SK = "STATE"
+
+
+class RateLimitState(TypedDict):
+    request_level: float
+    token_level: float
+    updated_at: float
+
+
+def find_rate_limit_state(model: str) -> RateLimitState | None:
+    """Token bucket levels of the model shared by all containers."""
+    table = get_bot_table_client()
+    response = table.get_item(
+        Key={"PK": compose_rate_limit_pk(model), "SK": RATE_LIMIT_SK},
+        ConsistentRead=True,
+    )
+    item = response.get("Item")
+    if item is None:
+        return None
+
+    return RateLimitState(
+        request_level=float(item["RequestLevel"]),
+        token_level=float(item["TokenLevel"]),
+        updated_at=float(item["UpdatedAt"]),
+    )
+
+
+def update_rate_limit_state(
+    model: str,
+    state: RateLimitState,
+    previous_updated_at: float | None,
+) -> bool:
+    """Write the bucket levels if no other container has written them since they were read.
+    Returns False on conflict.
+    """
+    table = get_bot_table_client()
+    try:
+        table.update_item(
+            Key={"PK": compose_rate_limit_pk(model), "SK": RATE_LIMIT_SK},
+            UpdateExpression="SET RequestLevel = :request_level, TokenLevel = :token_level, UpdatedAt = :updated_at",
+            ConditionExpression=(
+                "attribute_not_exists(PK)"
+                if previous_updated_at is None
+                else "UpdatedAt = :previous_updated_at"
+            ),
+            ExpressionAttributeValues={
+                ":request_level": Decimal(str(state["request_level"])),
+                ":token_level": Decimal(str(state["token_level"])),
+                ":updated_at": Decimal(str(state["updated_at"])),
+                **(
+                    {":previous_updated_at": Decimal(str(previous_updated_at))}
+                    if previous_updated_at is not None
+                    else {}
+                ),
+            },
+        )
+        return True
+
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise e
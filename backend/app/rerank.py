@@ -0,0 +1,135 @@
+import logging
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import TypeVar
+
+from app.config import RERANK_DUPLICATE_THRESHOLD, RERANK_SHINGLE_SIZE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+T = TypeVar("T")
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Constant of Reciprocal Rank Fusion used to combine the retrieval rank and the lexical rank
+RRF_K = 60
+
+_WORD_PATTERN = re.compile(r"\w+")
+# Hiragana, Katakana, CJK Unified Ideographs (and Extension A), Hangul and CJK Compatibility Ideographs
+_CJK_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]"
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Split the text into words. CJK runs, which have no spaces, are split into character bigrams."""
+    tokens: list[str] = []
+    for word in _WORD_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if _CJK_PATTERN.search(word) and len(word) > 1:
+            tokens.extend(word[i : i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+
+    return tokens
+
+
+def _shingles(tokens: list[str], size: int) -> set[tuple[str, ...]]:
+    if len(tokens) <= size:
+        return {tuple(tokens)}
+    return {tuple(tokens[i : i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def _jaccard(a: set[tuple[str, ...]], b: set[tuple[str, ...]]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def find_near_duplicates(
+    texts: list[str],
+    threshold: float = RERANK_DUPLICATE_THRESHOLD,
+    shingle_size: int = RERANK_SHINGLE_SIZE,
+) -> set[int]:
+    """Indices of the texts which are near duplicates of a preceding text,
+    by Jaccard similarity of their word shingles.
+    """
+    shingles = [_shingles(tokenize(text), shingle_size) for text in texts]
+    duplicates: set[int] = set()
+    for i in range(len(texts)):
+        for j in range(i):
+            if j not in duplicates and _jaccard(shingles[i], shingles[j]) >= threshold:
+                duplicates.add(i)
+                break
+
+    return duplicates
+
+
+def bm25_scores(query: str, texts: list[str]) -> list[float]:
+    """BM25 score of each text against the query, with the candidates as the corpus."""
+    documents = [Counter(tokenize(text)) for text in texts]
+    if not documents:
+        return []
+
+    lengths = [sum(document.values()) for document in documents]
+    average_length = sum(lengths) / len(lengths) or 1.0
+    document_frequency: Counter[str] = Counter()
+    for document in documents:
+        document_frequency.update(document.keys())
+
+    query_terms = set(tokenize(query))
+    idf = {
+        term: math.log(
+            1
+            + (len(documents) - document_frequency[term] + 0.5)
+            / (document_frequency[term] + 0.5)
+        )
+        for term in query_terms
+    }
+
+    return [
+        sum(
+            idf[term]
+            * document[term]
+            * (BM25_K1 + 1)
+            / (
+                document[term]
+                + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            )
+            for term in query_terms
+            if term in document
+        )
+        for document, length in zip(documents, lengths)
+    ]
+
+
+def rerank(query: str, candidates: list[T], texts: list[str], top_k: int) -> list[T]:
+    """Drop near-duplicate candidates and keep the top-k.
+    Candidates must be ordered by the retrieval rank, which is fused with the BM25 rank
+    so that lexical matches are promoted without discarding the semantic ranking.
+    """
+    duplicates = find_near_duplicates(texts)
+    indices = [i for i in range(len(candidates)) if i not in duplicates]
+
+    scores = bm25_scores(query, [texts[i] for i in indices])
+    lexical_rank = {
+        index: rank
+        for rank, (_, index) in enumerate(
+            sorted(zip(scores, indices), key=lambda x: x[0], reverse=True)
+        )
+    }
+    retrieval_rank = {index: rank for rank, index in enumerate(indices)}
+    fused = sorted(
+        indices,
+        key=lambda i: 1.0 / (RRF_K + retrieval_rank[i] + 1)
+        + 1.0 / (RRF_K + lexical_rank[i] + 1),
+        reverse=True,
+    )
+
+    logger.info(
+        f"Reranked {len(candidates)} candidates: {len(duplicates)} near duplicates removed, {min(top_k, len(fused))} kept"
+    )
+    return [candidates[i] for i in fused[:top_k]]
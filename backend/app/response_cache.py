@@ -0,0 +1,163 @@
+import logging
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+from typing import TypedDict
+
+from app.bot_config import compute_bot_config_hash
+from app.cache import TTLCache
+from app.config import (
+    RESPONSE_CACHE_MAX_SIZE,
+    RESPONSE_CACHE_NEAR_DUPLICATE_THRESHOLD,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+from app.repositories.models.conversation import (
+    ContentModel,
+    RelatedDocumentModel,
+    SimpleMessageModel,
+    TextContentModel,
+)
+from app.repositories.models.custom_bot import BotModel
+from app.rerank import tokenize
+from app.routes.schemas.conversation import type_model_name
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class CachedResponse(TypedDict):
+    # Id of the assistant message the response was generated for
+    message_id: str
+    content: list[ContentModel]
+    thinking_log: list[SimpleMessageModel] | None
+    related_documents: list[RelatedDocumentModel]
+
+
+# Bot id, bot configuration hash, model, reasoning and the normalized messages before the question
+ResponseCachePrefix = tuple[str, str, str, bool, tuple[str, ...]]
+# Prefix and the normalized question
+ResponseCacheKey = tuple[ResponseCachePrefix, str]
+
+_responses: TTLCache[ResponseCacheKey, CachedResponse] = TTLCache(
+    max_size=RESPONSE_CACHE_MAX_SIZE,
+    default_ttl=RESPONSE_CACHE_TTL_SECONDS,
+)
+# Tokens of the questions cached under each prefix, for near-duplicate matching
+_questions: OrderedDict[ResponseCachePrefix, OrderedDict[str, set[str]]] = OrderedDict()
+_questions_lock = Lock()
+
+
+def _normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def _jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def get_response_cache_key(
+    bot: BotModel,
+    model: type_model_name,
+    enable_reasoning: bool,
+    messages: list[SimpleMessageModel],
+) -> ResponseCacheKey | None:
+    """Key of the response to the last message of the conversation.
+    Returns None if the conversation cannot be cached, e.g. the user sent images or files.
+    """
+    texts: list[str] = []
+    for message in messages:
+        if message.role not in ("user", "assistant"):
+            continue
+
+        bodies: list[str] = []
+        for content in message.content:
+            if isinstance(content, TextContentModel):
+                bodies.append(content.body)
+            elif message.role == "user":
+                return None
+        texts.append(_normalize("\n".join(bodies)))
+
+    if not texts:
+        return None
+
+    prefix: ResponseCachePrefix = (
+        bot.id,
+        compute_bot_config_hash(bot),
+        model,
+        enable_reasoning,
+        tuple(texts[:-1]),
+    )
+    return prefix, texts[-1]
+
+
+def find_cached_response(key: ResponseCacheKey) -> CachedResponse | None:
+    """Response cached for the same question, or for a near duplicate of it by word Jaccard similarity."""
+    cached = _responses.get(key, label="exact")
+    if cached is not None or RESPONSE_CACHE_NEAR_DUPLICATE_THRESHOLD >= 1:
+        return cached
+
+    prefix, question = key
+    tokens = set(tokenize(question))
+    with _questions_lock:
+        candidates = list(_questions.get(prefix, {}).items())
+
+    score, nearest = max(
+        (
+            (_jaccard(tokens, candidate_tokens), candidate)
+            for candidate, candidate_tokens in candidates
+        ),
+        default=(0.0, ""),
+    )
+    if score < RESPONSE_CACHE_NEAR_DUPLICATE_THRESHOLD:
+        return None
+
+    cached = _responses.get((prefix, nearest), label="near_duplicate")
+    if cached is None:
+        # Expired or evicted
+        with _questions_lock:
+            _questions.get(prefix, OrderedDict()).pop(nearest, None)
+    else:
+        logger.info(f"Near-duplicate response cache hit: {question} ~ {nearest}")
+    return cached
+
+
+def store_cached_response(key: ResponseCacheKey, response: CachedResponse):
+    _responses.set(key, response)
+
+    prefix, question = key
+    with _questions_lock:
+        questions = _questions.setdefault(prefix, OrderedDict())
+        questions[question] = set(tokenize(question))
+        questions.move_to_end(question)
+        _questions.move_to_end(prefix)
+        while len(questions) > RESPONSE_CACHE_MAX_SIZE:
+            questions.popitem(last=False)
+        while len(_questions) > RESPONSE_CACHE_MAX_SIZE:
+            _questions.popitem(last=False)
+
+
+def copy_cached_response(cached: CachedResponse, message_id: str) -> CachedResponse:
+    """Copy the cached response for another assistant message, rewriting the source ids
+    of the related documents derived from the original message id.
+    """
+    original_id = cached["message_id"]
+    return CachedResponse(
+        message_id=message_id,
+        content=[content.model_copy(deep=True) for content in cached["content"]],
+        thinking_log=(
+            [log.model_copy(deep=True) for log in cached["thinking_log"]]
+            if cached["thinking_log"] is not None
+            else None
+        ),
+        related_documents=[
+            document.model_copy(
+                update={
+                    "source_id": document.source_id.replace(original_id, message_id, 1)
+                },
+                deep=True,
+            )
+            for document in cached["related_documents"]
+        ],
+    )
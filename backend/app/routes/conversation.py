@@ -1,3 +1,11 @@
+import json
+import logging
+import math
+from concurrent.futures import Future
+from typing import AsyncIterator
+
+from app.chat_notification import event_payloads
+from app.rate_limiter import RateLimitExceededError
 from app.repositories.conversation import (
     change_conversation_title,
     delete_conversation_by_id,
@@ -21,14 +29,23 @@ from app.routes.schemas.conversation import (
     RelatedDocument,
 )
 from app.usecases.chat import (
+    ChatEvent,
     chat,
     chat_output_from_message,
+    chat_stream,
     fetch_conversation,
+    fetch_conversation_branch,
+    fetch_conversation_delta,
     propose_conversation_title,
     search_conversations as search_conversations_usecase,
+    wait_background_tasks,
 )
 from app.user import User
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 router = APIRouter(tags=["conversation"])
 
@@ -40,15 +57,87 @@ def health():
 
 
 @router.post("/conversation", response_model=ChatOutput)
-def post_message(request: Request, chat_input: ChatInput):
+def post_message(
+    request: Request, chat_input: ChatInput, background_tasks: BackgroundTasks
+):
     """Send chat message"""
     current_user: User = request.state.current_user
 
-    conversation, message = chat(user=current_user, chat_input=chat_input)
+    title_tasks: list[Future] = []
+    conversation, message = chat(
+        user=current_user, chat_input=chat_input, title_tasks=title_tasks
+    )
+    # Not to make the response wait for the title model
+    background_tasks.add_task(wait_background_tasks, title_tasks)
     output = chat_output_from_message(conversation=conversation, message=message)
     return output
 
 
+def _format_server_sent_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+async def _stream_chat_events(
+    first_event: ChatEvent, events: AsyncIterator[ChatEvent]
+) -> AsyncIterator[str]:
+    try:
+        for payload in event_payloads(first_event):
+            yield _format_server_sent_event(payload)
+
+        async for event in events:
+            for payload in event_payloads(event):
+                yield _format_server_sent_event(payload)
+
+    except RateLimitExceededError as e:
+        yield _format_server_sent_event(
+            dict(
+                status="ERROR",
+                reason=str(e),
+                retryAfter=math.ceil(e.retry_after),
+            )
+        )
+
+    except Exception as e:
+        logger.exception(f"Failed to run stream handler: {e}")
+        yield _format_server_sent_event(
+            dict(
+                status="ERROR",
+                reason=f"Failed to run stream handler: {e}",
+            )
+        )
+
+    finally:
+        # Stop the generation if the client has disconnected
+        await events.aclose()
+
+
+@router.post("/conversation/stream")
+async def post_message_stream(request: Request, chat_input: ChatInput):
+    """Send chat message and stream the response as server-sent events.
+    Each event has the same payload as the notifications of the WebSocket API.
+    """
+    current_user: User = request.state.current_user
+
+    events = chat_stream(user=current_user, chat_input=chat_input)
+    # Errors before the response starts (e.g. bot not found, rate limit exceeded)
+    # are returned with their status code by the exception handlers.
+    try:
+        first_event = await anext(events)
+    except BaseException:
+        await events.aclose()
+        raise
+
+    return StreamingResponse(
+        _stream_chat_events(first_event, events),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Do not buffer the events in proxies
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
 @router.get(
     "/conversation/{conversation_id}/related-documents",
     response_model=list[RelatedDocument],
@@ -85,11 +174,41 @@ def get_related_document(
 
 
 @router.get("/conversation/{conversation_id}", response_model=Conversation)
-def get_conversation(request: Request, conversation_id: str):
-    """Get a conversation history"""
+def get_conversation(
+    request: Request, conversation_id: str, active_branch_only: bool = False
+):
+    """Get a conversation history.
+    If `active_branch_only` is true, only the path to the last message is returned.
+    """
     current_user: User = request.state.current_user
 
-    output = fetch_conversation(current_user.id, conversation_id)
+    output = fetch_conversation(
+        current_user.id, conversation_id, active_branch_only=active_branch_only
+    )
+    return output
+
+
+@router.get(
+    "/conversation/{conversation_id}/branch/{message_id}", response_model=Conversation
+)
+def get_conversation_branch(request: Request, conversation_id: str, message_id: str):
+    """Get the branch starting from the message, following the latest children"""
+    current_user: User = request.state.current_user
+
+    output = fetch_conversation_branch(current_user.id, conversation_id, message_id)
+    return output
+
+
+@router.get("/conversation/{conversation_id}/delta", response_model=Conversation)
+def get_conversation_delta(
+    request: Request, conversation_id: str, since_message_id: str
+):
+    """Get messages added after `since_message_id` with their updated tree links"""
+    current_user: User = request.state.current_user
+
+    output = fetch_conversation_delta(
+        current_user.id, conversation_id, since_message_id
+    )
     return output
 
 
@@ -1,5 +1,6 @@
 import json
 
+from app.config import PUBLISHED_API_ENABLE_RESPONSE_CACHE
 from app.routes.schemas.conversation import ChatInput
 from app.usecases.chat import chat, chat_output_from_message
 from app.user import User
@@ -17,7 +18,11 @@ def handler(event, context):
 
         user = User.from_published_api_id(chat_input.bot_id)
 
-        conversation, message = chat(user=user, chat_input=chat_input)
+        conversation, message = chat(
+            user=user,
+            chat_input=chat_input,
+            use_response_cache=PUBLISHED_API_ENABLE_RESPONSE_CACHE,
+        )
         chat_result = chat_output_from_message(
             conversation=conversation,
             message=message,
@@ -5,9 +5,12 @@ from typing import Callable, TypedDict, TypeGuard
 from app.agents.tools.agent_tool import AgentTool
 from app.bedrock import (
     BedrockThrottlingException,
+    ConverseRequestBuilder,
     calculate_price,
-    compose_args_for_converse_api,
+    invoke_with_failover,
 )
+from app.endpoint_health import get_endpoint_health
+from app.rate_limiter import RateLimitReservation, acquire
 from app.repositories.models.conversation import (
     ContentModel,
     MessageModel,
@@ -20,10 +23,18 @@ from app.repositories.models.conversation import (
 from app.repositories.models.custom_bot import GenerationParamsModel
 from app.repositories.models.custom_bot_guardrails import BedrockGuardrailsModel
 from app.routes.schemas.conversation import type_model_name
-from app.utils import get_bedrock_runtime_client, get_current_time
+from app.token_estimator import (
+    calibrated,
+    estimate_message_tokens,
+    estimate_text_tokens,
+)
+from app.utils import get_current_time
 from botocore.exceptions import ClientError
 from mypy_boto3_bedrock_runtime.literals import ConversationRoleType, StopReasonType
-from mypy_boto3_bedrock_runtime.type_defs import GuardrailConverseContentBlockTypeDef
+from mypy_boto3_bedrock_runtime.type_defs import (
+    ConverseStreamRequestTypeDef,
+    GuardrailConverseContentBlockTypeDef,
+)
 from pydantic import JsonValue
 from retry import retry
 
@@ -36,6 +47,9 @@ class OnStopInput(TypedDict):
     stop_reason: StopReasonType
     input_token_count: int
     output_token_count: int
+    # Tokens read from / written to the prompt cache, not included in `input_token_count`
+    cache_read_input_token_count: int
+    cache_write_input_token_count: int
     price: float
 
 
@@ -165,9 +179,11 @@ class ConverseApiStreamHandler:
         on_stream: Callable[[str], None] | None = None,
         on_thinking: Callable[[OnThinking], None] | None = None,
         on_reasoning: Callable[[str], None] | None = None,
+        user_id: str | None = None,
     ):
         """Base class for stream handlers.
         :param model: Model name.
+        :param user_id: User to queue the requests for on the rate limit of the model.
         :param on_stream: Callback function for streaming.
         :param on_stop: Callback function for stopping the stream.
         """
@@ -179,6 +195,10 @@ class ConverseApiStreamHandler:
         self.on_stream = on_stream
         self.on_thinking = on_thinking
         self.on_reasoning = on_reasoning
+        self.user_id = user_id
+        # Kept across `run` calls so that the static parts of the request and the converted
+        # history are reused in the tool use loop.
+        self.request_builder: ConverseRequestBuilder | None = None
 
     @retry(
         exceptions=(BedrockThrottlingException,),
@@ -195,29 +215,54 @@ class ConverseApiStreamHandler:
         message_for_continue_generate: SimpleMessageModel | None = None,
         enable_reasoning: bool = False,
     ) -> OnStopInput:
+        reservation: RateLimitReservation | None = None
+        used_token_count = 0
         try:
             # Create payload to invoke Bedrock
-            args = compose_args_for_converse_api(
+            if (
+                self.request_builder is None
+                or self.request_builder.enable_reasoning != enable_reasoning
+            ):
+                self.request_builder = ConverseRequestBuilder(
+                    model=self.model,
+                    instructions=self.instructions,
+                    generation_params=self.generation_params,
+                    guardrail=self.guardrail,
+                    tools=self.tools,
+                    enable_reasoning=enable_reasoning,
+                )
+            args = self.request_builder.build(
                 messages=messages,
-                model=self.model,
-                instructions=self.instructions,
-                generation_params=self.generation_params,
-                guardrail=self.guardrail,
                 grounding_source=grounding_source,
-                tools=self.tools,
-                enable_reasoning=enable_reasoning,
             )
             logger.info(f"args for converse_stream: {args}")
 
-            client = get_bedrock_runtime_client()
-            try:
-                response = client.converse_stream(**args)
-            except ClientError as e:
-                if e.response["Error"]["Code"] == "ThrottlingException":
-                    raise BedrockThrottlingException(
-                        "Bedrock API is throttling requests"
-                    ) from e
-                raise
+            input_tokens = calibrated(
+                sum(
+                    estimate_message_tokens(message, self.model) for message in messages
+                )
+                + estimate_text_tokens("\n\n".join(self.instructions), self.model),
+                self.model,
+            )
+            reservation = acquire(
+                self.model,
+                self.user_id,
+                input_tokens + args["inferenceConfig"].get("maxTokens", 0),
+            )
+
+            def compose_args(model: type_model_name) -> ConverseStreamRequestTypeDef:
+                return ConverseRequestBuilder(
+                    model=model,
+                    instructions=self.instructions,
+                    generation_params=self.generation_params,
+                    guardrail=self.guardrail,
+                    tools=self.tools,
+                    enable_reasoning=enable_reasoning,
+                ).build(messages=messages, grounding_source=grounding_source)
+
+            response, endpoint = invoke_with_failover(
+                self.model, args, "converse_stream", compose_args
+            )
 
             current_message = _PartialMessage(
                 role="assistant",
@@ -232,10 +277,12 @@ class ConverseApiStreamHandler:
                     else {}
                 ),
             )
-            current_errors: list[Exception] = []
+            current_errors: list[ClientError] = []
             stop_reason: StopReasonType = "end_turn"
             input_token_count = 0
             output_token_count = 0
+            cache_read_input_token_count = 0
+            cache_write_input_token_count = 0
             for event in response["stream"]:
                 logger.debug(f"event: {event}")
                 if "messageStart" in event:
@@ -345,6 +392,15 @@ class ConverseApiStreamHandler:
                     usage = metadata["usage"]
                     input_token_count = usage["inputTokens"]
                     output_token_count = usage["outputTokens"]
+                    used_token_count = usage["totalTokens"]
+                    cache_read_input_token_count = usage.get("cacheReadInputTokens", 0)
+                    cache_write_input_token_count = usage.get(
+                        "cacheWriteInputTokens", 0
+                    )
+                    if cache_read_input_token_count or cache_write_input_token_count:
+                        logger.info(
+                            f"Prompt cache: read={cache_read_input_token_count}, write={cache_write_input_token_count}"
+                        )
 
                 elif "modelStreamErrorException" in event:
                     exception = event["modelStreamErrorException"]
@@ -352,7 +408,7 @@ class ConverseApiStreamHandler:
                     original_status_code = exception.get("originalStatusCode")
                     original_message = exception.get("originalMessage")
                     current_errors.append(
-                        client.exceptions.ModelStreamErrorException(
+                        ClientError(
                             error_response={
                                 "Error": {
                                     "Code": "ModelStreamErrorException",
@@ -369,7 +425,7 @@ class ConverseApiStreamHandler:
                     exception = event["throttlingException"]
                     message = exception.get("message")
                     current_errors.append(
-                        client.exceptions.ThrottlingException(
+                        ClientError(
                             error_response={
                                 "Error": {
                                     "Code": "ThrottlingException",
@@ -384,7 +440,7 @@ class ConverseApiStreamHandler:
                     exception = event["internalServerException"]
                     message = exception.get("message")
                     current_errors.append(
-                        client.exceptions.InternalServerException(
+                        ClientError(
                             error_response={
                                 "Error": {
                                     "Code": "InternalServerException",
@@ -399,7 +455,7 @@ class ConverseApiStreamHandler:
                     exception = event["serviceUnavailableException"]
                     message = exception.get("message")
                     current_errors.append(
-                        client.exceptions.ServiceUnavailableException(
+                        ClientError(
                             error_response={
                                 "Error": {
                                     "Code": "ServiceUnavailableException",
@@ -414,7 +470,7 @@ class ConverseApiStreamHandler:
                     exception = event["validationException"]
                     message = exception.get("message")
                     current_errors.append(
-                        client.exceptions.ValidationException(
+                        ClientError(
                             error_response={
                                 "Error": {
                                     "Code": "ValidationException",
@@ -426,6 +482,17 @@ class ConverseApiStreamHandler:
                     )
 
             if len(current_errors) > 0:
+                if any(
+                    error.response["Error"]["Code"]
+                    in ("ThrottlingException", "ServiceUnavailableException")
+                    for error in current_errors
+                ):
+                    # The response is partially streamed, so it cannot fail over here.
+                    # Following requests go to the other endpoints while this one cools down.
+                    get_endpoint_health(
+                        endpoint["region"], endpoint["model_id"]
+                    ).record_failure()
+
                 if len(current_errors) == 1:
                     raise current_errors[0]
 
@@ -448,13 +515,22 @@ class ConverseApiStreamHandler:
                 thinking_log=None,
             )
 
-            price = calculate_price(self.model, input_token_count, output_token_count)
+            price = calculate_price(
+                endpoint["model"],
+                input_token_count,
+                output_token_count,
+                region=endpoint["region"],
+                cache_read_input_tokens=cache_read_input_token_count,
+                cache_write_input_tokens=cache_write_input_token_count,
+            )
 
             result = OnStopInput(
                 message=message,
                 stop_reason=stop_reason,
                 input_token_count=input_token_count,
                 output_token_count=output_token_count,
+                cache_read_input_token_count=cache_read_input_token_count,
+                cache_write_input_token_count=cache_write_input_token_count,
                 price=price,
             )
             return result
@@ -462,3 +538,7 @@ class ConverseApiStreamHandler:
         except Exception as e:
             logger.error(f"Error: {e}")
             raise e
+
+        finally:
+            if reservation is not None:
+                reservation.settle(used_token_count)
@@ -0,0 +1,151 @@
+import logging
+import re
+from threading import Lock
+from typing import Literal
+
+from app.bedrock import is_deepseek_model, is_llama_model, is_mistral, is_nova_model
+from app.repositories.models.conversation import (
+    ContentModel,
+    MessageModel,
+    SimpleMessageModel,
+    TextContentModel,
+    ToolResultContentModel,
+    ToolUseContentModel,
+)
+from app.routes.schemas.conversation import type_model_name
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+type_model_family = Literal["claude", "nova", "llama", "mistral", "deepseek"]
+
+# Approximate characters per token for non-CJK text, and tokens per CJK character.
+# NOTE: These are approximations and corrected by the observed token usage at runtime.
+_CHARS_PER_TOKEN: dict[type_model_family, float] = {
+    "claude": 3.5,
+    "nova": 4.0,
+    "llama": 4.0,
+    "mistral": 3.5,
+    "deepseek": 3.8,
+}
+_TOKENS_PER_CJK_CHAR: dict[type_model_family, float] = {
+    "claude": 1.0,
+    "nova": 1.0,
+    "llama": 0.9,
+    "mistral": 1.2,
+    "deepseek": 0.7,
+}
+# Images are resized by the model, so count them as a fixed size
+IMAGE_TOKENS = 1600
+# Per-message overhead for role and formatting
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Weight of the latest observation in the correction factor
+CALIBRATION_ALPHA = 0.2
+_CALIBRATION_BOUNDS = (0.5, 2.0)
+
+# Hiragana, Katakana, CJK Unified Ideographs (and Extension A), Hangul, CJK Compatibility Ideographs
+# and halfwidth Katakana
+_CJK_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff66-\uff9f]"
+)
+
+_correction: dict[type_model_family, float] = {}
+_correction_lock = Lock()
+
+
+def get_model_family(model: type_model_name) -> type_model_family:
+    if is_nova_model(model):
+        return "nova"
+    elif is_llama_model(model):
+        return "llama"
+    elif is_mistral(model):
+        return "mistral"
+    elif is_deepseek_model(model):
+        return "deepseek"
+    return "claude"
+
+
+def _estimate_raw_text_tokens(text: str, family: type_model_family) -> float:
+    cjk_chars = len(_CJK_PATTERN.findall(text))
+    other_chars = len(text) - cjk_chars
+    return (
+        other_chars / _CHARS_PER_TOKEN[family]
+        + cjk_chars * _TOKENS_PER_CJK_CHAR[family]
+    )
+
+
+def _estimate_raw_content_tokens(
+    content: ContentModel, family: type_model_family
+) -> float:
+    if isinstance(content, TextContentModel):
+        return _estimate_raw_text_tokens(content.body, family)
+
+    elif content.content_type == "image":
+        return IMAGE_TOKENS
+
+    elif isinstance(content, (ToolUseContentModel, ToolResultContentModel)):
+        return _estimate_raw_text_tokens(content.body.model_dump_json(), family)
+
+    return _estimate_raw_text_tokens(content.model_dump_json(), family)
+
+
+def estimate_text_tokens(text: str, model: type_model_name) -> int:
+    """Estimate token count of the text, without calibration."""
+    return int(_estimate_raw_text_tokens(text, get_model_family(model))) + 1
+
+
+def estimate_message_tokens(
+    message: SimpleMessageModel | MessageModel, model: type_model_name
+) -> int:
+    """Estimate token count of the message, without calibration."""
+    family = get_model_family(model)
+    return (
+        int(
+            sum(
+                _estimate_raw_content_tokens(content, family)
+                for content in message.content
+            )
+        )
+        + MESSAGE_OVERHEAD_TOKENS
+    )
+
+
+def estimate_turn_tokens(message: MessageModel, model: type_model_name) -> int:
+    """Estimate token count of the message and its retained tool use logs, as sent by `trace_to_root`."""
+    return estimate_message_tokens(message, model) + sum(
+        estimate_message_tokens(log, model)
+        for log in message.thinking_log or []
+        if any(
+            isinstance(content, (ToolUseContentModel, ToolResultContentModel))
+            for content in log.content
+        )
+    )
+
+
+def get_correction(model: type_model_name) -> float:
+    """Correction factor from the estimated to the observed token count."""
+    return _correction.get(get_model_family(model), 1.0)
+
+
+def calibrate(model: type_model_name, estimated_tokens: int, observed_tokens: int):
+    """Update the correction factor with the input token count observed by Bedrock."""
+    if estimated_tokens <= 0 or observed_tokens <= 0:
+        return
+
+    family = get_model_family(model)
+    ratio = min(
+        max(observed_tokens / estimated_tokens, _CALIBRATION_BOUNDS[0]),
+        _CALIBRATION_BOUNDS[1],
+    )
+    with _correction_lock:
+        current = _correction.get(family, 1.0)
+        _correction[family] = current + CALIBRATION_ALPHA * (ratio - current)
+
+    logger.debug(
+        f"Token estimation for {family}: estimated={estimated_tokens}, observed={observed_tokens}, correction={_correction[family]}"
+    )
+
+
+def calibrated(tokens: int, model: type_model_name) -> int:
+    return int(tokens * get_correction(model))
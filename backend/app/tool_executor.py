@@ -0,0 +1,277 @@
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import Event
+from time import monotonic
+from typing import Callable
+
+from app.agents.tools.agent_tool import AgentTool, ToolRunResult
+from app.bot_config import compute_bot_config_hash
+from app.cache import TTLCache
+from app.config import (
+    AGENT_TOOL_MAX_CONCURRENCY,
+    AGENT_TOOL_RESULT_CACHE_MAX_SIZE,
+    AGENT_TOOL_RESULT_CACHE_TTL_SECONDS,
+    AGENT_TOOL_TIMEOUT_SECONDS,
+)
+from app.repositories.models.conversation import (
+    RelatedDocumentModel,
+    TextToolResultModel,
+    ToolUseContentModel,
+)
+from app.repositories.models.custom_bot import BotModel
+from app.routes.schemas.conversation import type_model_name
+from pydantic import JsonValue
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def error_tool_run_result(tool_use_id: str, message: str) -> ToolRunResult:
+    return ToolRunResult(
+        tool_use_id=tool_use_id,
+        status="error",
+        related_documents=[
+            RelatedDocumentModel(
+                content=TextToolResultModel(text=message),
+                source_id=tool_use_id,
+            ),
+        ],
+    )
+
+
+# (tool name, normalized input, bot id, bot config hash) to the successful result
+_tool_result_cache: TTLCache[tuple[str, str, str, str], ToolRunResult] = TTLCache(
+    max_size=AGENT_TOOL_RESULT_CACHE_MAX_SIZE,
+    default_ttl=AGENT_TOOL_RESULT_CACHE_TTL_SECONDS["default"],
+)
+
+
+def _normalize_input(input: JsonValue) -> JsonValue:
+    if isinstance(input, str):
+        return " ".join(input.split())
+    elif isinstance(input, dict):
+        return {key: _normalize_input(value) for key, value in input.items()}
+    elif isinstance(input, list):
+        return [_normalize_input(value) for value in input]
+    return input
+
+
+def _rebind_tool_run_result(result: ToolRunResult, tool_use_id: str) -> ToolRunResult:
+    """Copy the cached result for another tool use, rewriting ids derived from the original."""
+    original_id = result["tool_use_id"]
+    return ToolRunResult(
+        tool_use_id=tool_use_id,
+        status=result["status"],
+        related_documents=[
+            document.model_copy(
+                update={
+                    "source_id": document.source_id.replace(original_id, tool_use_id, 1)
+                }
+            )
+            for document in result["related_documents"]
+        ],
+    )
+
+
+def get_tool_timeout(tool_name: str) -> float:
+    return AGENT_TOOL_TIMEOUT_SECONDS.get(
+        tool_name, AGENT_TOOL_TIMEOUT_SECONDS["default"]
+    )
+
+
+class ToolExecutor:
+    """Run the tool uses of an agent step concurrently on a bounded thread pool.
+    Results are returned in the order of the tool uses, so that they can be sent back as
+    the tool result message as is. `on_tool_result` is called on the caller's thread as
+    each tool finishes. A tool exceeding its timeout, or still running when `cancel` is
+    called, is reported as an error result; its thread is left to finish in background.
+
+    A tool use can be submitted with `submit` as soon as its block is streamed, before the
+    step is run. `run` then joins the started tool instead of starting it again, and
+    `close` cancels the submitted tools which were never joined.
+    """
+
+    def __init__(
+        self,
+        tools: dict[str, AgentTool],
+        model: type_model_name,
+        bot: BotModel | None,
+        max_workers: int = AGENT_TOOL_MAX_CONCURRENCY,
+        cancelled: Event | None = None,
+    ):
+        """
+        :param cancelled: Event set by the caller to cancel the tools, same as `cancel`.
+        """
+        self.tools = tools
+        self.model: type_model_name = model
+        self.bot = bot
+        self.max_workers = max_workers
+        self._cancelled = cancelled or Event()
+        self._bot_config_hash = compute_bot_config_hash(bot)
+        self._executor: ThreadPoolExecutor | None = None
+        # Tool use id to the future of the tool submitted in advance, and its start time
+        self._submitted: dict[str, tuple[Future[ToolRunResult], float]] = {}
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def close(self):
+        """Cancel the tools not joined by `run` and release the thread pool."""
+        for tool_use_id, (future, _) in self._submitted.items():
+            if future.cancel():
+                logger.info(f"Cancelled unused tool: {tool_use_id}")
+        self._submitted.clear()
+
+        if self._executor is not None:
+            # Do not block on tools left running after timeout or cancellation
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run_tool(
+        self, tool_use_id: str, name: str, input: dict[str, JsonValue]
+    ) -> ToolRunResult:
+        ttl = AGENT_TOOL_RESULT_CACHE_TTL_SECONDS.get(
+            name, AGENT_TOOL_RESULT_CACHE_TTL_SECONDS["default"]
+        )
+        if ttl <= 0:
+            return self.tools[name].run(
+                tool_use_id=tool_use_id,
+                input=input,
+                model=self.model,
+                bot=self.bot,
+            )
+
+        key = (
+            name,
+            json.dumps(_normalize_input(input), sort_keys=True, ensure_ascii=False),
+            self.bot.id if self.bot else "",
+            self._bot_config_hash,
+        )
+        cached = _tool_result_cache.get(key, label=name)
+        if cached is not None:
+            stats = _tool_result_cache.stats()[name]
+            logger.info(
+                f"Tool result cache hit for {name} (hit rate: {stats['hit_rate']:.2f})"
+            )
+            return _rebind_tool_run_result(cached, tool_use_id)
+
+        result = self.tools[name].run(
+            tool_use_id=tool_use_id,
+            input=input,
+            model=self.model,
+            bot=self.bot,
+        )
+        if result["status"] == "success":
+            _tool_result_cache.set(key, result, ttl=ttl)
+
+        return result
+
+    def submit(self, tool_use_id: str, name: str, input: dict[str, JsonValue]):
+        """Start the tool in advance of `run`."""
+        if (
+            name not in self.tools
+            or tool_use_id in self._submitted
+            or self._cancelled.is_set()
+        ):
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="tool",
+            )
+
+        logger.info(f"Started tool {name} in advance: {tool_use_id}")
+        self._submitted[tool_use_id] = (
+            self._executor.submit(self._run_tool, tool_use_id, name, input),
+            monotonic(),
+        )
+
+    def run(
+        self,
+        tool_use_contents: list[ToolUseContentModel],
+        on_tool_result: Callable[[ToolRunResult], None] | None = None,
+    ) -> list[ToolRunResult]:
+        results: dict[str, ToolRunResult] = {}
+
+        def complete(tool_use_id: str, result: ToolRunResult):
+            results[tool_use_id] = result
+            if on_tool_result:
+                on_tool_result(result)
+
+        # Future of each tool, with its tool use and start time
+        pending: dict[Future[ToolRunResult], tuple[ToolUseContentModel, float]] = {}
+        for content in tool_use_contents:
+            tool_use_id = content.body.tool_use_id
+            if content.body.name not in self.tools:
+                complete(
+                    tool_use_id,
+                    error_tool_run_result(
+                        tool_use_id, f"Tool not found: {content.body.name}"
+                    ),
+                )
+                continue
+
+            self.submit(tool_use_id, content.body.name, content.body.input)
+            if tool_use_id not in self._submitted:
+                # Cancelled before the tool is started
+                break
+
+            future, started = self._submitted.pop(tool_use_id)
+            pending[future] = (content, started)
+
+        while pending and not self._cancelled.is_set():
+            now = monotonic()
+            next_deadline = min(
+                started + get_tool_timeout(content.body.name)
+                for content, started in pending.values()
+            )
+            done, _ = wait(
+                pending.keys(),
+                # Wake up periodically to notice cancellation
+                timeout=min(max(0.0, next_deadline - now), 1.0),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                content, _ = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception(
+                        f"Tool {content.body.name} failed: {content.body.tool_use_id}"
+                    )
+                    result = error_tool_run_result(content.body.tool_use_id, str(e))
+
+                complete(content.body.tool_use_id, result)
+
+            # NOTE: Deadlines are measured from the submission, as queued tools are bounded
+            # by the pool size.
+            now = monotonic()
+            for future, (content, started) in list(pending.items()):
+                timeout = get_tool_timeout(content.body.name)
+                if now >= started + timeout:
+                    future.cancel()
+                    del pending[future]
+                    logger.warning(
+                        f"Tool {content.body.name} timed out: {content.body.tool_use_id}"
+                    )
+                    complete(
+                        content.body.tool_use_id,
+                        error_tool_run_result(
+                            content.body.tool_use_id,
+                            f"Tool execution timed out after {timeout} seconds.",
+                        ),
+                    )
+
+        for content in tool_use_contents:
+            tool_use_id = content.body.tool_use_id
+            if tool_use_id not in results:
+                complete(
+                    tool_use_id,
+                    error_tool_run_result(tool_use_id, "Tool execution was cancelled."),
+                )
+        for future in pending.keys():
+            future.cancel()
+
+        return [results[content.body.tool_use_id] for content in tool_use_contents]
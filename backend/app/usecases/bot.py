@@ -29,7 +29,7 @@ from app.repositories.custom_bot import (
     update_bot_shared_status,
     update_bot_star_status,
     update_bot_stats,
-    find_all_shared_bots # 新規追加
+    find_all_shared_bots,  # 新規追加
 )
 from app.repositories.models.custom_bot import (
     ActiveModelsModel,
@@ -70,7 +70,7 @@ from app.routes.schemas.bot import (
     Tool,
     type_shared_scope,
     type_sync_status,
-    BotMetaOutputWithOwnerId #新規追加
+    BotMetaOutputWithOwnerId,  # 新規追加
 )
 from app.routes.schemas.bot_guardrails import BedrockGuardrailsOutput
 from app.routes.schemas.bot_kb import BedrockKnowledgeBaseOutput
@@ -86,6 +86,7 @@ from app.utils import (
     move_file_in_s3,
     store_api_key_to_secret_manager,
 )
+from app.vector_search import invalidate_retrieval_cache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -273,6 +274,14 @@ def modify_owned_bot(
         ),
     )
 
+    if (
+        sync_status == "QUEUED"
+        and current_bot_kb is not None
+        and current_bot_kb.knowledge_base_id is not None
+    ):
+        # Results retrieved in this process are stale once the knowledge is re-synced
+        invalidate_retrieval_cache(current_bot_kb.knowledge_base_id)
+
     return BotModifyOutput(
         id=bot_id,
         title=modify_input.title,
@@ -349,6 +358,7 @@ def fetch_bot(user: User, bot_id: str) -> tuple[bool, BotModel]:
 
     return owned, bot
 
+
 # 修正 ---
 def fetch_all_bots(
     user: User,
@@ -386,7 +396,7 @@ def fetch_all_bots(
         else:
             # Fetch recently used bots
             bots = find_recently_used_bots_by_user_id(user.id, limit=limit)
-    
+
     # kind が private,mixed の場合、所有しているボットと共有されたボットを取得
     elif kind == "private,mixed":
         bots = find_all_shared_bots(user, limit=limit)
@@ -399,6 +409,8 @@ def fetch_all_bots(
     for bot in bots:
         bot_metas.append(bot.to_output())
     return bot_metas
+
+
 # 修正 ---
 
 
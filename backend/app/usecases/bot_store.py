@@ -1,5 +1,7 @@
 import logging
 
+from app.cache import TTLCache
+from app.config import BOT_USAGE_COUNT_CACHE_TTL_SECONDS
 from app.repositories.bot_store import (
     find_bots_by_query,
     find_bots_sorted_by_usage_count,
@@ -14,6 +16,11 @@ from app.user import User
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# (user id, user groups, limit) to the popular bots accessible by the user
+_popular_bots_cache: TTLCache[tuple[str, tuple[str, ...], int], list[BotMetaOutput]] = (
+    TTLCache(max_size=256, default_ttl=BOT_USAGE_COUNT_CACHE_TTL_SECONDS)
+)
+
 # 修正 ---
 def search_bots(
     user: User,
@@ -49,6 +56,12 @@ def fetch_popular_bots(
     """Search bots sorted by usage count.
     This method is used for bot-store functionality (Popular bots).
     """
+    # Usage counts change only on each roll-up, so the ranking is cached for a short time
+    cache_key = (user.id, tuple(sorted(user.groups)), limit)
+    cached = _popular_bots_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     bots = find_bots_sorted_by_usage_count(
         user,
         limit=limit,
@@ -56,6 +69,8 @@ def fetch_popular_bots(
     bot_metas = []
     for bot in bots:
         bot_metas.append(bot.to_output())
+
+    _popular_bots_cache.set(cache_key, bot_metas)
     return bot_metas
 
 
@@ -1,18 +1,35 @@
+import asyncio
+import json
 import logging
-from typing import Callable, Dict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Event, Thread
+from typing import AsyncIterator, Callable, Dict, Literal, TypedDict
 
 from app.agents.tools.agent_tool import AgentTool, ToolRunResult
 from app.agents.tools.knowledge import create_knowledge_tool
 from app.agents.utils import get_tools
-from app.bedrock import (
-    call_converse_api,
-    compose_args_for_converse_api,
-    is_tooluse_supported,
+from app.bedrock import is_tooluse_supported
+from app.config import (
+    CHAT_STREAM_MAX_BUFFERED_EVENTS,
+    CONTEXT_WINDOW_TOKEN_BUDGET,
+    ENABLE_SPECULATIVE_TOOL_EXECUTION,
+    TITLE_GENERATION_MODEL,
+)
+from app.context_packer import pack_search_results
+from app.context_window import Turn, fit_to_context_window
+from app.conversation_title import (
+    DEFAULT_CONVERSATION_TITLE,
+    build_title_transcript,
+    generate_title,
 )
 from app.prompt import build_rag_prompt, get_prompt_to_cite_tool_results
 from app.repositories.conversation import (
     RecordNotFoundError,
     find_conversation_by_id,
+    get_create_time,
+    get_token_count,
+    get_tree_index,
     store_conversation,
     store_related_documents,
 )
@@ -46,8 +63,23 @@ from app.routes.schemas.conversation import (
     SearchHighlight,
     type_model_name,
 )
+from app.response_cache import (
+    CachedResponse,
+    ResponseCacheKey,
+    copy_cached_response,
+    find_cached_response,
+    get_response_cache_key,
+    store_cached_response,
+)
 from app.stream import ConverseApiStreamHandler, OnStopInput, OnThinking
-from app.usecases.bot import fetch_bot, modify_bot_last_used_time, modify_bot_stats
+from app.token_estimator import (
+    calibrate,
+    calibrated,
+    estimate_message_tokens,
+    estimate_text_tokens,
+)
+from app.tool_executor import ToolExecutor
+from app.usecases.bot import fetch_bot
 from app.user import User
 from app.utils import get_current_time
 from app.vector_search import (
@@ -56,18 +88,85 @@ from app.vector_search import (
     search_result_to_related_document,
     to_guardrails_grounding_source,
 )
+from app.write_behind import WriteBehindBuffer
 from ulid import ULID
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Runs independent steps of the pre-processing (conversation and bot loads, retrieval)
+# concurrently, and bookkeeping in background.
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chat")
+
+
+class TextDeltaEvent(TypedDict):
+    type: Literal["text"]
+    text: str
+
+
+class ReasoningEvent(TypedDict):
+    type: Literal["reasoning"]
+    text: str
+
+
+class ToolStartEvent(TypedDict):
+    type: Literal["tool_start"]
+    tool_use: OnThinking
+
+
+class ToolResultEvent(TypedDict):
+    type: Literal["tool_result"]
+    result: ToolRunResult
+
+
+class StopEvent(TypedDict):
+    type: Literal["stop"]
+    result: OnStopInput
+
+
+ChatEvent = (
+    TextDeltaEvent | ReasoningEvent | ToolStartEvent | ToolResultEvent | StopEvent
+)
+
+
+class ChatStreamCancelledError(Exception):
+    """Raised in the callbacks of `chat` to stop it when the consumer of `chat_stream` has gone."""
+
+
+def _ensure_alias(user: User, bot_id: str, bot: BotModel):
+    try:
+        # Check alias is already created
+        alias_exists(user.id, bot_id)
+    except RecordNotFoundError:
+        logger.info("Bot is not owned by the user. Creating alias to shared bot.")
+        # Create alias item
+        store_alias(user.id, BotAliasModel.from_bot_for_initial_alias(bot))
+
+
+def wait_background_tasks(background_tasks: list[Future]):
+    for task in background_tasks:
+        try:
+            task.result()
+        except Exception as e:
+            logger.exception(f"Background task failed: {e}")
+
 
 def prepare_conversation(
     user: User,
     chat_input: ChatInput,
+    background_tasks: list[Future] | None = None,
 ) -> tuple[str, ConversationModel, BotModel | None]:
+    """Load or create the conversation and append the user message.
+    The conversation and the bot are loaded concurrently. Bookkeeping not needed to answer
+    (e.g. alias creation) is submitted to `background_tasks` for the caller to wait later.
+    """
     current_time = get_current_time()
     bot = None
+    bot_future: Future[tuple[bool, BotModel]] | None = (
+        _executor.submit(fetch_bot, user, chat_input.bot_id)
+        if chat_input.bot_id
+        else None
+    )
 
     try:
         # Fetch existing conversation
@@ -79,9 +178,9 @@ def prepare_conversation(
             parent_id = "instruction"
         elif chat_input.message.parent_message_id is None:
             parent_id = conversation.last_message_id
-        if chat_input.bot_id:
+        if bot_future is not None:
             logger.info("Bot id is provided. Fetching bot.")
-            owned, bot = fetch_bot(user, chat_input.bot_id)
+            owned, bot = bot_future.result()
     except RecordNotFoundError:
         # The case for new conversation. Note that editing first user message is not considered as new conversation.
         logger.info(
@@ -108,11 +207,11 @@ def prepare_conversation(
             )
         }
         parent_id = "system"
-        if chat_input.bot_id:
+        if chat_input.bot_id and bot_future is not None:
             logger.info("Bot id is provided. Fetching bot.")
             parent_id = "instruction"
             # Fetch bot and append instruction
-            owned, bot = fetch_bot(user, chat_input.bot_id)
+            owned, bot = bot_future.result()
             initial_message_map["instruction"] = MessageModel(
                 role="instruction",
                 content=[
@@ -132,20 +231,17 @@ def prepare_conversation(
             initial_message_map["system"].children.append("instruction")
 
             if not owned:
-                try:
-                    # Check alias is already created
-                    alias_exists(user.id, chat_input.bot_id)
-                except RecordNotFoundError:
-                    logger.info(
-                        "Bot is not owned by the user. Creating alias to shared bot."
-                    )
-                    # Create alias item
-                    store_alias(user.id, BotAliasModel.from_bot_for_initial_alias(bot))
+                # Alias is not needed to answer, so keep it off the critical path
+                alias_task = _executor.submit(
+                    _ensure_alias, user, chat_input.bot_id, bot
+                )
+                if background_tasks is not None:
+                    background_tasks.append(alias_task)
 
         # Create new conversation
         conversation = ConversationModel(
             id=chat_input.conversation_id,
-            title="New conversation",
+            title=DEFAULT_CONVERSATION_TITLE,
             total_price=0.0,
             create_time=current_time,
             message_map=initial_message_map,
@@ -178,36 +274,164 @@ def prepare_conversation(
     return (message_id, conversation, bot)
 
 
-def trace_to_root(
+def trace_turns_to_root(
     node_id: str | None, message_map: dict[str, MessageModel]
-) -> list[SimpleMessageModel]:
-    """Trace message map from leaf node to root node."""
-    result: list[SimpleMessageModel] = []
+) -> list[Turn]:
+    """Trace message map from leaf node to root node.
+    Each turn consists of the message id and the messages sent for it, i.e. the retained
+    tool use and its result logs followed by the message itself. Turns are ordered from the root.
+    """
+    result: list[Turn] = []
     if not node_id or node_id == "system":
         node_id = "instruction" if "instruction" in message_map else "system"
 
-    current_node = message_map.get(node_id)
-    while current_node:
-        result.append(SimpleMessageModel.from_message_model(message=current_node))
-        if current_node.thinking_log:
-            result.extend(
-                log
-                for log in reversed(current_node.thinking_log)
-                if any(
-                    isinstance(content, ToolUseContentModel)
-                    or isinstance(content, ToolResultContentModel)
-                    for content in log.content
-                )
+    # Walk the tree index so that only the messages on the path are loaded
+    for message_id in get_tree_index(message_map).path_to_root(node_id):
+        current_node = message_map[message_id]
+        messages = [
+            log
+            for log in current_node.thinking_log or []
+            if any(
+                isinstance(content, ToolUseContentModel)
+                or isinstance(content, ToolResultContentModel)
+                for content in log.content
             )
-
-        parent_id = current_node.parent
-        if parent_id is None:
-            break
-        current_node = message_map.get(parent_id)
+        ]
+        messages.append(SimpleMessageModel.from_message_model(message=current_node))
+        result.append((message_id, messages))
 
     return result[::-1]
 
 
+def trace_to_root(
+    node_id: str | None, message_map: dict[str, MessageModel]
+) -> list[SimpleMessageModel]:
+    """Trace message map from leaf node to root node."""
+    return [
+        message
+        for _, messages in trace_turns_to_root(node_id, message_map)
+        for message in messages
+    ]
+
+
+def _finish_chat(
+    user: User,
+    user_msg_id: str,
+    conversation: ConversationModel,
+    bot: BotModel | None,
+    related_documents: list[RelatedDocumentModel],
+    result: OnStopInput,
+    on_stop: Callable[[OnStopInput], None] | None,
+    background_tasks: list[Future],
+    title_tasks: list[Future] | None = None,
+):
+    # Store conversation before finish streaming so that front-end can avoid 404 issue
+    store_conversation(user.id, conversation)
+    store_related_documents(
+        user_id=user.id,
+        conversation_id=conversation.id,
+        related_documents=related_documents,
+    )
+
+    # Writes not read right after the response are buffered and flushed after `on_stop`
+    write_behind = WriteBehindBuffer()
+    user_message = conversation.message_map[user_msg_id]
+    if (
+        conversation.title == DEFAULT_CONVERSATION_TITLE
+        and user_message.parent in ("system", "instruction")
+        and not user.is_published_api()
+    ):
+        # Name the conversation after its first exchange
+        write_behind.generate_title(
+            user_id=user.id,
+            conversation_id=conversation.id,
+            first_exchange=[
+                SimpleMessageModel.from_message_model(message=user_message),
+                SimpleMessageModel.from_message_model(message=result["message"]),
+            ],
+        )
+    if bot:
+        logger.info("Bot is provided. Updating bot last used time.")
+        # Update bot last used time
+        write_behind.update_bot_last_used_time(user, bot)
+        # Update bot stats
+        write_behind.update_bot_stats(user, bot, increment=1)
+
+    if on_stop:
+        on_stop(result)
+
+    flush_task, title_task = write_behind.flush()
+    if flush_task is not None:
+        background_tasks.append(flush_task)
+    if title_task is not None:
+        if title_tasks is not None:
+            # Waited for by the caller after responding
+            title_tasks.append(title_task)
+        else:
+            background_tasks.append(title_task)
+
+    # Not to leave the tasks frozen with the Lambda execution environment
+    wait_background_tasks(background_tasks)
+
+
+def _answer_from_cache(
+    user: User,
+    chat_input: ChatInput,
+    user_msg_id: str,
+    conversation: ConversationModel,
+    bot: BotModel,
+    cached: CachedResponse,
+    on_stream: Callable[[str], None] | None,
+    on_stop: Callable[[OnStopInput], None] | None,
+    background_tasks: list[Future],
+    title_tasks: list[Future] | None,
+) -> tuple[ConversationModel, MessageModel]:
+    """Write the cached response into the conversation as if it were generated."""
+    assistant_msg_id = str(ULID())
+    cached = copy_cached_response(cached, assistant_msg_id)
+    message = MessageModel(
+        role="assistant",
+        content=cached["content"],
+        model=chat_input.message.model,
+        children=[],
+        parent=user_msg_id,
+        create_time=get_current_time(),
+        feedback=None,
+        used_chunks=None,
+        thinking_log=cached["thinking_log"],
+    )
+    conversation.message_map[assistant_msg_id] = message
+    conversation.message_map[user_msg_id].children.append(assistant_msg_id)
+    conversation.last_message_id = assistant_msg_id
+    conversation.should_continue = False
+
+    if on_stream:
+        for content in message.content:
+            if isinstance(content, TextContentModel):
+                on_stream(content.body)
+
+    _finish_chat(
+        user=user,
+        user_msg_id=user_msg_id,
+        conversation=conversation,
+        bot=bot,
+        related_documents=cached["related_documents"],
+        result=OnStopInput(
+            message=message,
+            stop_reason="end_turn",
+            input_token_count=0,
+            output_token_count=0,
+            cache_read_input_token_count=0,
+            cache_write_input_token_count=0,
+            price=0.0,
+        ),
+        on_stop=on_stop,
+        background_tasks=background_tasks,
+        title_tasks=title_tasks,
+    )
+    return conversation, message
+
+
 def chat(
     user: User,
     chat_input: ChatInput,
@@ -216,8 +440,68 @@ def chat(
     on_thinking: Callable[[OnThinking], None] | None = None,
     on_tool_result: Callable[[ToolRunResult], None] | None = None,
     on_reasoning: Callable[[str], None] | None = None,
+    use_response_cache: bool = False,
+    cancelled: Event | None = None,
+    title_tasks: list[Future] | None = None,
 ) -> tuple[ConversationModel, MessageModel]:
-    user_msg_id, conversation, bot = prepare_conversation(user, chat_input)
+    """Answer the user message.
+    :param use_response_cache: Answer from the responses cached for the same bot and conversation,
+        instead of calling the model. Used by the published API bots which enable it.
+    :param cancelled: Event set to cancel the running tools, e.g. when the client has gone.
+    :param title_tasks: If given, the title generation is appended to it for the caller to wait
+        after responding. Otherwise it is waited for with the other background tasks.
+    """
+    background_tasks: list[Future] = []
+    user_msg_id, conversation, bot = prepare_conversation(
+        user, chat_input, background_tasks=background_tasks
+    )
+
+    response_cache_key: ResponseCacheKey | None = None
+    if use_response_cache and bot is not None and not chat_input.continue_generate:
+        response_cache_key = get_response_cache_key(
+            bot=bot,
+            model=chat_input.message.model,
+            enable_reasoning=chat_input.enable_reasoning,
+            messages=[
+                turn_messages[-1]
+                for _, turn_messages in trace_turns_to_root(
+                    node_id=user_msg_id, message_map=conversation.message_map
+                )
+            ],
+        )
+        cached = (
+            find_cached_response(response_cache_key)
+            if response_cache_key is not None
+            else None
+        )
+        if cached is not None:
+            logger.info("Answering from the response cache.")
+            return _answer_from_cache(
+                user=user,
+                chat_input=chat_input,
+                user_msg_id=user_msg_id,
+                conversation=conversation,
+                bot=bot,
+                cached=cached,
+                on_stream=on_stream,
+                on_stop=on_stop,
+                background_tasks=background_tasks,
+                title_tasks=title_tasks,
+            )
+
+    # Start retrieval for the models without tool use as soon as the user message is known
+    search_future: Future[list[SearchResult]] | None = None
+    if (
+        bot is not None
+        and bot.has_knowledge()
+        and not is_tooluse_supported(chat_input.message.model)
+    ):
+        # NOTE: Currently embedding not support multi-modal. For now, use the last content.
+        query_content = conversation.message_map[user_msg_id].content[-1]
+        if isinstance(query_content, TextContentModel):
+            search_future = _executor.submit(
+                search_related_docs, bot=bot, query=query_content.body
+            )
 
     # # Set tools only when tooluse is supported
     tools: Dict[str, AgentTool] = {}
@@ -271,7 +555,15 @@ def chat(
                         }
                     )
 
-                search_results = search_related_docs(bot=bot, query=content.body)
+                # Fit the results into the context budget, used for both the prompt and citations
+                search_results = pack_search_results(
+                    search_results=(
+                        search_future.result()
+                        if search_future is not None
+                        else search_related_docs(bot=bot, query=content.body)
+                    ),
+                    model=chat_input.message.model,
+                )
                 logger.info(f"Search results from vector store: {search_results}")
 
                 if on_tool_result:
@@ -308,10 +600,35 @@ def chat(
     if node_id is None:
         raise ValueError("parent_message_id or parent is None")
 
-    messages = trace_to_root(
-        node_id=node_id,
+    # Reject a message which can never fit into the budget before any model is called
+    model = chat_input.message.model
+    if not chat_input.continue_generate:
+        user_message_tokens = calibrated(
+            get_token_count(message_map, user_msg_id), model
+        )
+        budget = CONTEXT_WINDOW_TOKEN_BUDGET.get(
+            model, CONTEXT_WINDOW_TOKEN_BUDGET["default"]
+        )
+        if user_message_tokens > budget:
+            raise ValueError(
+                f"The message is too long. Estimated {user_message_tokens} tokens exceeds the limit of {budget} tokens."
+            )
+
+    # Fit the history into the token budget, summarizing older turns if needed
+    context_window = fit_to_context_window(
+        user_id=user.id,
+        conversation_id=conversation.id,
+        turns=trace_turns_to_root(
+            node_id=node_id,
+            message_map=message_map,
+        ),
         message_map=message_map,
+        model=chat_input.message.model,
     )
+    messages = context_window["messages"]
+    if context_window["summary_prompt"]:
+        instructions.append(context_window["summary_prompt"])
+    conversation.total_price += context_window["price"]
 
     continue_generate = chat_input.continue_generate
 
@@ -326,6 +643,19 @@ def chat(
         )
         message_for_continue_generate = None
 
+    # Estimate input tokens before calling the model, to calibrate the estimator afterwards
+    estimated_input_tokens = (
+        sum(estimate_message_tokens(message, model) for message in messages)
+        + estimate_text_tokens("\n\n".join(instructions), model)
+        + sum(
+            estimate_text_tokens(
+                json.dumps(tool.to_converse_spec(), default=str), model
+            )
+            for tool in tools.values()
+        )
+    )
+    logger.info(f"Estimated input tokens: {calibrated(estimated_input_tokens, model)}")
+
     generation_params = bot.generation_params if bot else None
 
     # Guardrails
@@ -334,6 +664,25 @@ def chat(
     if guardrail and guardrail.is_guardrail_enabled:
         grounding_source = to_guardrails_grounding_source(search_results)
 
+    tool_executor = ToolExecutor(
+        tools=tools,
+        model=chat_input.message.model,
+        bot=bot,
+        cancelled=cancelled,
+    )
+
+    def on_tool_use(tool_use: OnThinking):
+        if on_thinking:
+            on_thinking(tool_use)
+
+        if ENABLE_SPECULATIVE_TOOL_EXECUTION:
+            # Start the tool while the model is still streaming the following blocks
+            tool_executor.submit(
+                tool_use_id=tool_use["tool_use_id"],
+                name=tool_use["name"],
+                input=tool_use["input"],
+            )
+
     stream_handler = ConverseApiStreamHandler(
         model=chat_input.message.model,
         instructions=instructions,
@@ -341,161 +690,266 @@ def chat(
         guardrail=guardrail,
         tools=tools,
         on_stream=on_stream,
-        on_thinking=on_thinking,
+        on_thinking=on_tool_use,
         on_reasoning=on_reasoning,
+        user_id=user.id,
     )
 
     thinking_log: list[SimpleMessageModel] = []
-    while True:
-        result = stream_handler.run(
-            messages=messages,
-            grounding_source=grounding_source,
-            message_for_continue_generate=message_for_continue_generate,
-            enable_reasoning=chat_input.enable_reasoning,
-        )
-
-        message = result["message"]
-        stop_reason = result["stop_reason"]
-
-        conversation.total_price += result["price"]
-        conversation.should_continue = stop_reason == "max_tokens"
+    try:
+        while True:
+            result = stream_handler.run(
+                messages=messages,
+                grounding_source=grounding_source,
+                message_for_continue_generate=message_for_continue_generate,
+                enable_reasoning=chat_input.enable_reasoning,
+            )
+            if not thinking_log:
+                # Calibrate the estimator with the observed usage of the first request
+                calibrate(
+                    model,
+                    estimated_input_tokens,
+                    result["input_token_count"]
+                    + result["cache_read_input_token_count"]
+                    + result["cache_write_input_token_count"],
+                )
 
-        if stop_reason != "tool_use":  # Tool use converged
-            message.parent = user_msg_id
+            message = result["message"]
+            stop_reason = result["stop_reason"]
+
+            conversation.total_price += result["price"]
+            conversation.should_continue = stop_reason == "max_tokens"
+
+            if stop_reason != "tool_use":  # Tool use converged
+                message.parent = user_msg_id
+
+                # If there is a thinking_log that includes reasoning, add it to the beginning of the content.
+                reasoning_log = next(
+                    (
+                        log
+                        for log in thinking_log
+                        if any(
+                            isinstance(content, ReasoningContentModel)
+                            for content in log.content
+                        )
+                    ),
+                    None,
+                )
+                if reasoning_log:
+                    reasoning_content = next(
+                        content
+                        for content in reasoning_log.content
+                        if isinstance(content, ReasoningContentModel)
+                    )
+                    message.content.insert(0, reasoning_content)
 
-            # If there is a thinking_log that includes reasoning, add it to the beginning of the content.
-            reasoning_log = next(
-                (
+                # Retain tool use and its result logs
+                tool_logs = [
                     log
                     for log in thinking_log
                     if any(
-                        isinstance(content, ReasoningContentModel)
+                        isinstance(
+                            content, (ToolUseContentModel, ToolResultContentModel)
+                        )
                         for content in log.content
                     )
-                ),
-                None,
-            )
-            if reasoning_log:
-                reasoning_content = next(
-                    content
-                    for content in reasoning_log.content
-                    if isinstance(content, ReasoningContentModel)
-                )
-                message.content.insert(0, reasoning_content)
-
-            # Retain tool use and its result logs
-            tool_logs = [
-                log
-                for log in thinking_log
-                if any(
-                    isinstance(content, (ToolUseContentModel, ToolResultContentModel))
-                    for content in log.content
-                )
-            ]
-            if tool_logs:
-                message.thinking_log = tool_logs
-
-            if chat_input.continue_generate:
-                # For continue generate
-                if len(thinking_log) == 0:
-                    assistant_msg_id = conversation.last_message_id
-                    conversation.message_map[assistant_msg_id] = message
-                    break
-
-                else:
-                    old_assistant_msg_id = conversation.last_message_id
-                    conversation.message_map[user_msg_id].children.remove(
-                        old_assistant_msg_id
+                ]
+                if tool_logs:
+                    message.thinking_log = tool_logs
+
+                if chat_input.continue_generate:
+                    # For continue generate
+                    if len(thinking_log) == 0:
+                        assistant_msg_id = conversation.last_message_id
+                        conversation.message_map[assistant_msg_id] = message
+                        break
+
+                    else:
+                        old_assistant_msg_id = conversation.last_message_id
+                        conversation.message_map[user_msg_id].children.remove(
+                            old_assistant_msg_id
+                        )
+                        del conversation.message_map[old_assistant_msg_id]
+
+                # Issue id for new assistant message
+                assistant_msg_id = str(ULID())
+                conversation.message_map[assistant_msg_id] = message
+
+                # Append children to parent
+                conversation.message_map[user_msg_id].children.append(assistant_msg_id)
+                conversation.last_message_id = assistant_msg_id
+
+                search_results_as_related_documents = [
+                    search_result_to_related_document(
+                        search_result=result,
+                        source_id_base=assistant_msg_id,
                     )
-                    del conversation.message_map[old_assistant_msg_id]
-
-            # Issue id for new assistant message
-            assistant_msg_id = str(ULID())
-            conversation.message_map[assistant_msg_id] = message
+                    for result in search_results
+                ]
+                related_documents.extend(search_results_as_related_documents)
+                break
 
-            # Append children to parent
-            conversation.message_map[user_msg_id].children.append(assistant_msg_id)
-            conversation.last_message_id = assistant_msg_id
+            tool_use_message = SimpleMessageModel.from_message_model(message=message)
+            if continue_generate:
+                messages[-1] = tool_use_message
 
-            search_results_as_related_documents = [
-                search_result_to_related_document(
-                    search_result=result,
-                    source_id_base=assistant_msg_id,
-                )
-                for result in search_results
-            ]
-            related_documents.extend(search_results_as_related_documents)
-            break
+                continue_generate = False
+                message_for_continue_generate = None
 
-        tool_use_message = SimpleMessageModel.from_message_model(message=message)
-        if continue_generate:
-            messages[-1] = tool_use_message
+            else:
+                messages.append(tool_use_message)
 
-            continue_generate = False
-            message_for_continue_generate = None
-
-        else:
-            messages.append(tool_use_message)
+            thinking_log.append(tool_use_message)
 
-        thinking_log.append(tool_use_message)
-
-        tool_use_contents = [
-            content
-            for content in tool_use_message.content
-            if isinstance(content, ToolUseContentModel)
-        ]
+            tool_use_contents = [
+                content
+                for content in tool_use_message.content
+                if isinstance(content, ToolUseContentModel)
+            ]
 
-        run_results: list[ToolRunResult] = []
-        for content in tool_use_contents:
-            tool = tools[content.body.name]
-            run_result = tool.run(
-                tool_use_id=content.body.tool_use_id,
-                input=content.body.input,
-                model=chat_input.message.model,
-                bot=bot,
+            run_results = tool_executor.run(
+                tool_use_contents=tool_use_contents,
+                on_tool_result=on_tool_result,
             )
-            run_results.append(run_result)
-
-            if run_result["status"] == "success":
-                related_documents.extend(run_result["related_documents"])
+            for run_result in run_results:
+                if run_result["status"] == "success":
+                    related_documents.extend(run_result["related_documents"])
 
-            if on_tool_result:
-                on_tool_result(run_result)
-
-        tool_result_message = SimpleMessageModel(
-            role="user",
-            content=[
-                ToolResultContentModel.from_tool_run_result(
-                    run_result=result,
-                    model=chat_input.message.model,
-                    display_citation=display_citation,
-                )
-                for result in run_results
-            ],
+            tool_result_message = SimpleMessageModel(
+                role="user",
+                content=[
+                    ToolResultContentModel.from_tool_run_result(
+                        run_result=result,
+                        model=chat_input.message.model,
+                        display_citation=display_citation,
+                    )
+                    for result in run_results
+                ],
+            )
+            messages.append(tool_result_message)
+            thinking_log.append(tool_result_message)
+
+    except BaseException:
+        # Stop waiting for the running tools, e.g. when a callback raised on cancellation
+        tool_executor.cancel()
+        raise
+
+    finally:
+        # Cancel the tools started in advance but not used, and release the pool
+        # even if the agent loop failed
+        tool_executor.close()
+
+    if response_cache_key is not None and stop_reason == "end_turn":
+        store_cached_response(
+            response_cache_key,
+            CachedResponse(
+                message_id=conversation.last_message_id,
+                content=message.content,
+                thinking_log=message.thinking_log,
+                related_documents=related_documents,
+            ),
         )
-        messages.append(tool_result_message)
-        thinking_log.append(tool_result_message)
 
-    # Store conversation before finish streaming so that front-end can avoid 404 issue
-    store_conversation(user.id, conversation)
-    store_related_documents(
-        user_id=user.id,
-        conversation_id=conversation.id,
+    _finish_chat(
+        user=user,
+        user_msg_id=user_msg_id,
+        conversation=conversation,
+        bot=bot,
         related_documents=related_documents,
+        result=result,
+        on_stop=on_stop,
+        background_tasks=background_tasks,
+        title_tasks=title_tasks,
     )
+    return conversation, message
 
-    if on_stop:
-        on_stop(result)
 
-    # Update bot last used time
-    if bot:
-        logger.info("Bot is provided. Updating bot last used time.")
-        # Update bot last used time
-        modify_bot_last_used_time(user, bot)
-        # Update bot stats
-        modify_bot_stats(user, bot, increment=1)
+async def chat_stream(
+    user: User,
+    chat_input: ChatInput,
+    use_response_cache: bool = False,
+) -> AsyncIterator[ChatEvent]:
+    """Answer the user message as an async iterator of events.
+    `chat` runs on a worker thread and waits while `CHAT_STREAM_MAX_BUFFERED_EVENTS` events
+    are not consumed yet. Closing the iterator stops the generation at the next event,
+    and the answer is not stored unless it has already finished. Running tools are
+    cancelled without waiting for the next event.
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue[ChatEvent | None] = asyncio.Queue(
+        maxsize=CHAT_STREAM_MAX_BUFFERED_EVENTS
+    )
+    cancelled = Event()
+    errors: list[Exception] = []
+
+    def put(event: ChatEvent | None):
+        if cancelled.is_set():
+            raise ChatStreamCancelledError()
+
+        future = asyncio.run_coroutine_threadsafe(events.put(event), loop)
+        while True:
+            try:
+                future.result(timeout=1.0)
+                return
+            except FutureTimeoutError:
+                # Wake up periodically to notice the consumer has gone
+                if cancelled.is_set():
+                    future.cancel()
+                    raise ChatStreamCancelledError()
+
+    def on_stop(result: OnStopInput):
+        try:
+            put(StopEvent(type="stop", result=result))
+        except ChatStreamCancelledError:
+            # The answer is already stored, finish the bookkeeping
+            pass
+
+    def run():
+        try:
+            chat(
+                user=user,
+                chat_input=chat_input,
+                on_stream=lambda text: put(TextDeltaEvent(type="text", text=text)),
+                on_stop=on_stop,
+                on_thinking=lambda tool_use: put(
+                    ToolStartEvent(type="tool_start", tool_use=tool_use)
+                ),
+                on_tool_result=lambda result: put(
+                    ToolResultEvent(type="tool_result", result=result)
+                ),
+                on_reasoning=lambda text: put(
+                    ReasoningEvent(type="reasoning", text=text)
+                ),
+                use_response_cache=use_response_cache,
+                cancelled=cancelled,
+            )
+        except ChatStreamCancelledError:
+            logger.info(f"Chat stream cancelled: {chat_input.conversation_id}")
+            return
+        except Exception as e:
+            errors.append(e)
+
+        try:
+            put(None)
+        except ChatStreamCancelledError:
+            pass
+
+    Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
 
-    return conversation, message
+        if errors:
+            raise errors[0]
+
+    finally:
+        cancelled.set()
+        # Release the worker waiting for the buffer
+        while not events.empty():
+            events.get_nowait()
 
 
 def chat_output_from_message(
@@ -538,110 +992,102 @@ def chat_output_from_message(
 def propose_conversation_title(
     user_id: str,
     conversation_id: str,
-    model: type_model_name = "claude-v3-haiku",
+    model: type_model_name = TITLE_GENERATION_MODEL,
 ) -> str:
-    PROMPT = """Reading the conversation above, what is the appropriate title for the conversation? When answering the title, please follow the rules below:
-<rules>
-- Title length must be from 15 to 20 characters.
-- Prefer more specific title than general. Your title should always be distinct from others.
-- Return the conversation title only. DO NOT include any strings other than the title.
-- Title must be in the same language as the conversation.
-</rules>
-"""
+    """Title of the conversation. If it is not named yet (e.g. its title is being generated
+    in background), propose one from the first exchange.
+    """
     # Fetch existing conversation
     conversation = find_conversation_by_id(user_id, conversation_id)
+    if conversation.title != DEFAULT_CONVERSATION_TITLE:
+        return conversation.title
 
     messages = trace_to_root(
         node_id=conversation.last_message_id,
         message_map=conversation.message_map,
     )
-
-    # Append message to generate title
-    new_message = SimpleMessageModel(
-        role="user",
-        content=[
-            TextContentModel(
-                content_type="text",
-                body=PROMPT,
-            )
-        ],
-    )
-    messages.append(new_message)
-
-    # Invoke Bedrock
-    args = compose_args_for_converse_api(
-        messages=[
-            message
-            for message in messages
-            if not any(
-                isinstance(content, ToolUseContentModel)
-                or isinstance(content, ToolResultContentModel)
-                or isinstance(content, ReasoningContentModel)
-                for content in message.content
+    return generate_title(user_id, build_title_transcript(messages, model), model)
+
+
+def _message_output_from_model(message: MessageModel) -> MessageOutput:
+    return MessageOutput(
+        role=message.role,
+        content=[c.to_content() for c in message.content],
+        model=message.model,
+        children=message.children,
+        parent=message.parent,
+        feedback=(
+            FeedbackOutput(
+                thumbs_up=message.feedback.thumbs_up,
+                category=message.feedback.category,
+                comment=message.feedback.comment,
             )
-        ],
-        model=model,
-        stream=False,
-    )
-    response = call_converse_api(args)
-    reply_txt = (
-        response["output"]["message"]["content"][0]["text"]
-        if "message" in response["output"]
-        and len(response["output"]["message"]["content"]) > 0
-        and "text" in response["output"]["message"]["content"][0]
-        else ""
+            if message.feedback
+            else None
+        ),
+        used_chunks=(
+            [
+                Chunk(
+                    content=c.content,
+                    content_type=c.content_type,
+                    source=c.source,
+                    rank=c.rank,
+                )
+                for c in message.used_chunks
+            ]
+            if message.used_chunks
+            else None
+        ),
+        thinking_log=(
+            [m.to_schema() for m in message.thinking_log]
+            if message.thinking_log
+            else None
+        ),
     )
 
-    return reply_txt
+
+def _omit_instruction(
+    message_map: dict[str, MessageOutput], instruction: MessageModel | None
+):
+    """Hide the instruction node from the client by linking its children to `system`."""
+    if instruction is None:
+        return
+
+    for c in instruction.children:
+        if c in message_map:
+            message_map[c].parent = "system"
+    if "system" in message_map:
+        message_map["system"].children = instruction.children
+
+    message_map.pop("instruction", None)
 
 
-def fetch_conversation(user_id: str, conversation_id: str) -> Conversation:
+def fetch_conversation(
+    user_id: str, conversation_id: str, active_branch_only: bool = False
+) -> Conversation:
+    """Fetch a conversation.
+    If `active_branch_only` is True, only the messages on the path from the root to
+    `last_message_id` are returned. Sibling branches remain reachable through the
+    `children` of each message and can be loaded by `fetch_conversation_branch`.
+    """
     conversation = find_conversation_by_id(user_id, conversation_id)
 
+    messages = (
+        {
+            message_id: conversation.message_map[message_id]
+            for message_id in get_tree_index(conversation.message_map).path_to_root(
+                conversation.last_message_id
+            )
+        }
+        if active_branch_only
+        else conversation.message_map
+    )
     message_map = {
-        message_id: MessageOutput(
-            role=message.role,
-            content=[c.to_content() for c in message.content],
-            model=message.model,
-            children=message.children,
-            parent=message.parent,
-            feedback=(
-                FeedbackOutput(
-                    thumbs_up=message.feedback.thumbs_up,
-                    category=message.feedback.category,
-                    comment=message.feedback.comment,
-                )
-                if message.feedback
-                else None
-            ),
-            used_chunks=(
-                [
-                    Chunk(
-                        content=c.content,
-                        content_type=c.content_type,
-                        source=c.source,
-                        rank=c.rank,
-                    )
-                    for c in message.used_chunks
-                ]
-                if message.used_chunks
-                else None
-            ),
-            thinking_log=(
-                [m.to_schema() for m in message.thinking_log]
-                if message.thinking_log
-                else None
-            ),
-        )
-        for message_id, message in conversation.message_map.items()
+        message_id: _message_output_from_model(message)
+        for message_id, message in messages.items()
     }
     # Omit instruction
-    if "instruction" in message_map:
-        for c in message_map["instruction"].children:
-            message_map[c].parent = "system"
-        message_map["system"].children = message_map["instruction"].children
-
-        del message_map["instruction"]
+    _omit_instruction(message_map, conversation.message_map.get("instruction"))
 
     output = Conversation(
         id=conversation_id,
@@ -655,6 +1101,97 @@ def fetch_conversation(user_id: str, conversation_id: str) -> Conversation:
     return output
 
 
+def fetch_conversation_delta(
+    user_id: str, conversation_id: str, since_message_id: str
+) -> Conversation:
+    """Fetch only the messages added after `since_message_id`.
+    The returned `message_map` contains the new messages and the existing messages
+    whose `children` were changed by them, so the client can merge it into its local tree.
+    Only these messages are validated; the others are filtered by their raw creation time
+    and tree index. If `since_message_id` is unknown, the whole message map is returned.
+    NOTE: Feedback updates do not change message creation time and are not included.
+    Clients must fetch the whole conversation (or keep their own copy of the feedback)
+    to see feedback given after the cursor.
+    """
+    conversation = find_conversation_by_id(user_id, conversation_id)
+    message_map = conversation.message_map
+
+    if since_message_id not in message_map:
+        logger.info(
+            f"Message {since_message_id} not found. Returning the whole conversation."
+        )
+        changed_ids = set(message_map.keys())
+    else:
+        since = get_create_time(message_map, since_message_id)
+        new_ids = {
+            message_id
+            for message_id in message_map
+            if get_create_time(message_map, message_id) > since
+        }
+        # Parents of the new messages have new children links
+        tree_index = get_tree_index(message_map)
+        changed_ids = new_ids | {
+            parent_id
+            for parent_id in (
+                tree_index.parent_of(message_id) for message_id in new_ids
+            )
+            if parent_id is not None
+        }
+        if "instruction" in changed_ids:
+            changed_ids.add("system")
+
+    delta_map = {
+        message_id: _message_output_from_model(message_map[message_id])
+        for message_id in changed_ids
+    }
+    # Omit instruction
+    _omit_instruction(delta_map, message_map.get("instruction"))
+
+    return Conversation(
+        id=conversation_id,
+        title=conversation.title,
+        create_time=conversation.create_time,
+        last_message_id=conversation.last_message_id,
+        message_map=delta_map,
+        bot_id=conversation.bot_id,
+        should_continue=conversation.should_continue,
+    )
+
+
+def fetch_conversation_branch(
+    user_id: str, conversation_id: str, message_id: str
+) -> Conversation:
+    """Fetch the branch starting from `message_id`.
+    The branch follows the latest child of each message down to the leaf.
+    This is used to lazily load a sibling branch of a conversation fetched with `active_branch_only`.
+    """
+    conversation = find_conversation_by_id(user_id, conversation_id)
+    if message_id not in conversation.message_map:
+        raise RecordNotFoundError(
+            f"Message {message_id} not found in conversation {conversation_id}"
+        )
+
+    branch_ids = get_tree_index(conversation.message_map).latest_leaf_of(message_id)
+    message_map = {
+        branch_id: _message_output_from_model(conversation.message_map[branch_id])
+        for branch_id in branch_ids
+    }
+
+    # Omit instruction
+    _omit_instruction(message_map, conversation.message_map.get("instruction"))
+
+    return Conversation(
+        id=conversation_id,
+        title=conversation.title,
+        create_time=conversation.create_time,
+        # Leaf of the requested branch
+        last_message_id=branch_ids[-1],
+        message_map=message_map,
+        bot_id=conversation.bot_id,
+        should_continue=conversation.should_continue,
+    )
+
+
 def search_conversations(query: str, user: User) -> list[ConversationSearchResult]:
     """Search conversations by keyword"""
     conversations = find_conversations_by_query(query, user)
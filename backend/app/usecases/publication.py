@@ -95,6 +95,9 @@ def create_bot_publication(user: User, bot_id: str, bot_publish_input: BotPublis
         environment_variables["PUBLISHED_API_ALLOWED_ORIGINS"] = (
             str(bot_publish_input.allowed_origins).replace(" ", "").replace("'", '"')
         )
+    if bot_publish_input.enable_response_cache:
+        # Answer the questions asked before from the cache, without calling the model
+        environment_variables["PUBLISHED_API_ENABLE_RESPONSE_CACHE"] = "true"
 
     # Create `ApiPublishmentStack` by CodeBuild
     try:
@@ -34,6 +34,9 @@ class User(UserWithoutGroups):
     def is_publish_allowed(self) -> bool:
         return self.is_admin() or "PublishAllowed" in self.groups
 
+    def is_published_api(self) -> bool:
+        return self.id.startswith("PUBLISHED_API#")
+
     @classmethod
     def from_decoded_token(cls, token: dict) -> Self:
         return cls(
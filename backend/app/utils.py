@@ -2,6 +2,7 @@ import json
 import logging
 import os
 from datetime import datetime
+from threading import Lock
 from typing import Any, Literal
 
 import boto3
@@ -41,9 +42,18 @@ def get_bedrock_client(region=BEDROCK_REGION):
     return client
 
 
+# Runtime clients by region. Clients are thread-safe and costly to create, so they are reused.
+_bedrock_runtime_clients: dict[str, Any] = {}
+_bedrock_runtime_clients_lock = Lock()
+
+
 def get_bedrock_runtime_client(region=BEDROCK_REGION):
-    client = boto3.client("bedrock-runtime", region_name=region)
-    return client
+    with _bedrock_runtime_clients_lock:
+        if region not in _bedrock_runtime_clients:
+            _bedrock_runtime_clients[region] = boto3.client(
+                "bedrock-runtime", region_name=region
+            )
+        return _bedrock_runtime_clients[region]
 
 
 def get_bedrock_agent_client(region=BEDROCK_REGION):
@@ -1,7 +1,17 @@
 import logging
+import re
+import unicodedata
 from typing import TypedDict, Any
 from urllib.parse import urlparse
 
+from app.cache import TTLCache
+from app.config import (
+    KNOWLEDGE_BASE_RETRIEVAL_CACHE_MAX_SIZE,
+    KNOWLEDGE_BASE_RETRIEVAL_CACHE_NEAR_DUPLICATE,
+    KNOWLEDGE_BASE_RETRIEVAL_CACHE_TTL_SECONDS,
+    KNOWLEDGE_BASE_RETRIEVAL_OVERFETCH_FACTOR,
+)
+from app.rerank import rerank
 from app.repositories.models.conversation import (
     RelatedDocumentModel,
     TextToolResultModel,
@@ -18,6 +28,15 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 agent_client = get_bedrock_agent_runtime_client()
 
+# (knowledge base id, knowledge version, search type, max results, query key) to retrieval results.
+# Results are shared by the bots referring to the same knowledge base.
+_retrieval_cache: TTLCache[
+    tuple[str, str, str, int, str], list[KnowledgeBaseRetrievalResultTypeDef]
+] = TTLCache(
+    max_size=KNOWLEDGE_BASE_RETRIEVAL_CACHE_MAX_SIZE,
+    default_ttl=KNOWLEDGE_BASE_RETRIEVAL_CACHE_TTL_SECONDS,
+)
+
 
 class SearchResult(TypedDict):
     bot_id: str
@@ -60,6 +79,70 @@ def to_guardrails_grounding_source(
     )
 
 
+def _normalize_query(query: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+
+def _query_cache_key(query: str) -> str:
+    normalized = _normalize_query(query)
+    if KNOWLEDGE_BASE_RETRIEVAL_CACHE_NEAR_DUPLICATE:
+        # Match queries differing only in punctuation, word order or repeated words
+        return " ".join(sorted(set(re.findall(r"\w+", normalized))))
+    return normalized
+
+
+def invalidate_retrieval_cache(knowledge_base_id: str) -> int:
+    """Drop the cached retrieval results of the knowledge base, e.g. when its sync is started."""
+    count = _retrieval_cache.invalidate(lambda key: key[0] == knowledge_base_id)
+    logger.info(
+        f"Invalidated {count} cached retrieval results of knowledge base: {knowledge_base_id}"
+    )
+    return count
+
+
+def _retrieve(
+    knowledge_base_id: str,
+    knowledge_version: str | None,
+    search_type: str,
+    limit: int,
+    query: str,
+) -> list[KnowledgeBaseRetrievalResultTypeDef]:
+    """Call Retrieve API, using the cached results if the same query was retrieved recently.
+    Results are cached only when the knowledge version is known (i.e. the sync has succeeded).
+    """
+    cache_key = (
+        knowledge_base_id,
+        knowledge_version or "",
+        search_type,
+        limit,
+        _query_cache_key(query),
+    )
+    if knowledge_version is not None:
+        cached = _retrieval_cache.get(cache_key, label=knowledge_base_id)
+        if cached is not None:
+            stats = _retrieval_cache.stats()[knowledge_base_id]
+            logger.info(
+                f"Retrieval cache hit for knowledge base {knowledge_base_id} (hit rate: {stats['hit_rate']:.2f})"
+            )
+            return cached
+
+    response = agent_client.retrieve(
+        knowledgeBaseId=knowledge_base_id,
+        retrievalQuery={"text": query},
+        retrievalConfiguration={
+            "vectorSearchConfiguration": {
+                "numberOfResults": limit,
+                "overrideSearchType": search_type,
+            }
+        },
+    )
+    retrieval_results = response.get("retrievalResults", [])
+    if knowledge_version is not None:
+        _retrieval_cache.set(cache_key, retrieval_results)
+
+    return retrieval_results
+
+
 def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResult]:
     assert bot.bedrock_knowledge_base is not None
     assert (
@@ -82,16 +165,26 @@ def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResu
         else bot.bedrock_knowledge_base.knowledge_base_id
     )
 
+    # Knowledge base created by this app changes on each sync, so the last sync execution is
+    # part of the cache key. Externally managed knowledge base relies on the cache TTL.
+    knowledge_version = (
+        "external"
+        if bot.bedrock_knowledge_base.exist_knowledge_base_id is not None
+        else (
+            bot.sync_last_exec_id
+            if bot.sync_status == "SUCCEEDED" and bot.sync_last_exec_id
+            else None
+        )
+    )
+
     try:
-        response = agent_client.retrieve(
-            knowledgeBaseId=knowledge_base_id,
-            retrievalQuery={"text": query},
-            retrievalConfiguration={
-                "vectorSearchConfiguration": {
-                    "numberOfResults": limit,
-                    "overrideSearchType": search_type,
-                }
-            },
+        retrieval_results = _retrieve(
+            knowledge_base_id=knowledge_base_id,
+            knowledge_version=knowledge_version,
+            search_type=search_type,
+            # Over-fetch candidates for reranking (Retrieve API returns at most 100 results)
+            limit=min(limit * KNOWLEDGE_BASE_RETRIEVAL_OVERFETCH_FACTOR, 100),
+            query=query,
         )
 
         def extract_source_from_retrieval_result(
@@ -129,7 +222,7 @@ def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResu
             return None
 
         search_results = []
-        for i, retrieval_result in enumerate(response.get("retrievalResults", [])):
+        for i, retrieval_result in enumerate(retrieval_results):
             content = retrieval_result.get("content", {}).get("text", "")
             source = extract_source_from_retrieval_result(retrieval_result)
 
@@ -157,7 +250,17 @@ def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResu
                     )
                 )
 
-        return search_results
+        # Drop near duplicates and keep the top results, ranked again from 0
+        reranked_results = rerank(
+            query=query,
+            candidates=search_results,
+            texts=[search_result["content"] for search_result in search_results],
+            top_k=limit,
+        )
+        for rank, search_result in enumerate(reranked_results):
+            search_result["rank"] = rank
+
+        return reranked_results
 
     except ClientError as e:
         logger.error(f"Error querying Bedrock Knowledge Base: {e}")
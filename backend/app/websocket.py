@@ -1,5 +1,6 @@
 import json
 import logging
+import math
 import os
 import traceback
 from datetime import datetime
@@ -12,10 +13,20 @@ from typing import BinaryIO, Literal, TypedDict
 import boto3
 from app.agents.tools.agent_tool import ToolRunResult
 from app.auth import verify_token
+from app.chat_notification import event_payloads
+from app.rate_limiter import RateLimitExceededError
 from app.repositories.conversation import RecordNotFoundError
 from app.routes.schemas.conversation import ChatInput
 from app.stream import OnStopInput, OnThinking
-from app.usecases.chat import chat
+from app.usecases.chat import (
+    ChatEvent,
+    ReasoningEvent,
+    StopEvent,
+    TextDeltaEvent,
+    ToolResultEvent,
+    ToolStartEvent,
+    chat,
+)
 from app.user import User
 from boto3.dynamodb.conditions import Attr, Key
 
@@ -93,79 +104,25 @@ class NotificationSender:
             }
         )
 
+    def notify_event(self, event: ChatEvent):
+        for payload in event_payloads(event):
+            self.notify(payload=json.dumps(payload).encode("utf-8"))
+
     def on_stream(self, token: str):
         # Send completion
-        payload = json.dumps(
-            dict(
-                status="STREAMING",
-                completion=token,
-            )
-        ).encode("utf-8")
-
-        self.notify(payload=payload)
+        self.notify_event(TextDeltaEvent(type="text", text=token))
 
     def on_stop(self, arg: OnStopInput):
-        payload = json.dumps(
-            dict(
-                status="STREAMING_END",
-                completion="",
-                stop_reason=arg["stop_reason"],
-            )
-        ).encode("utf-8")
-
-        self.notify(payload=payload)
+        self.notify_event(StopEvent(type="stop", result=arg))
 
     def on_agent_thinking(self, tool_use: OnThinking):
-        payload = json.dumps(
-            dict(
-                status="AGENT_THINKING",
-                log={
-                    tool_use["tool_use_id"]: {
-                        "name": tool_use["name"],
-                        "input": tool_use["input"],
-                    },
-                },
-            )
-        ).encode("utf-8")
-
-        self.notify(payload=payload)
+        self.notify_event(ToolStartEvent(type="tool_start", tool_use=tool_use))
 
     def on_agent_tool_result(self, run_result: ToolRunResult):
-        self.notify(
-            payload=json.dumps(
-                dict(
-                    status="AGENT_TOOL_RESULT",
-                    result={
-                        "toolUseId": run_result["tool_use_id"],
-                        "status": run_result["status"],
-                    },
-                )
-            ).encode("utf-8")
-        )
-
-        for related_document in run_result["related_documents"]:
-            self.notify(
-                payload=json.dumps(
-                    dict(
-                        status="AGENT_RELATED_DOCUMENT",
-                        result={
-                            "toolUseId": run_result["tool_use_id"],
-                            "relatedDocument": related_document.to_schema().model_dump(
-                                by_alias=True
-                            ),
-                        },
-                    )
-                ).encode("utf-8")
-            )
+        self.notify_event(ToolResultEvent(type="tool_result", result=run_result))
 
     def on_reasoning(self, token: str):
-        payload = json.dumps(
-            dict(
-                status="REASONING",
-                completion=token,
-            )
-        ).encode("utf-8")
-        self.notify(payload=payload)
+        self.notify_event(ReasoningEvent(type="reasoning", text=token))
 
 
 def process_chat_input(
@@ -221,6 +178,18 @@ def process_chat_input(
                 ),
             }
 
+    except RateLimitExceededError as e:
+        return {
+            "statusCode": 429,
+            "body": json.dumps(
+                dict(
+                    status="ERROR",
+                    reason=str(e),
+                    retryAfter=math.ceil(e.retry_after),
+                )
+            ),
+        }
+
     except Exception as e:
         logger.exception(f"Failed to run stream handler: {e}")
         return {
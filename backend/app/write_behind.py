@@ -0,0 +1,287 @@
+import json
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Literal, TypedDict
+
+import boto3
+from app.cache import TTLCache
+from app.config import (
+    BOT_LAST_USED_TIME_UPDATE_INTERVAL_SECONDS,
+    WRITE_BEHIND_QUEUE_URL,
+)
+from app.conversation_title import (
+    DEFAULT_CONVERSATION_TITLE,
+    build_title_transcript,
+    generate_title,
+)
+from app.repositories.common import RecordNotFoundError
+from app.repositories.conversation import change_conversation_title
+from app.repositories.custom_bot import (
+    update_alias_last_used_time,
+    update_bot_last_used_time,
+    update_bot_stats,
+)
+from app.repositories.models.conversation import SimpleMessageModel
+from app.repositories.models.custom_bot import BotModel
+from app.user import User
+from app.utils import get_current_time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Maximum number of entries in a SendMessageBatch request
+_SQS_BATCH_SIZE = 10
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="write-behind")
+
+# Last time the last used time was written from this process, by (user id, bot id).
+# Entries expire after the update interval, when the time can be written again.
+_last_used_time_written: TTLCache[tuple[str, str], int] = TTLCache(
+    max_size=4096,
+    default_ttl=BOT_LAST_USED_TIME_UPDATE_INTERVAL_SECONDS,
+)
+_last_used_time_lock = Lock()
+
+
+class LastUsedTimeWrite(TypedDict):
+    type: Literal["last_used_time"]
+    user_id: str
+    bot_id: str
+    is_alias: bool
+    time: int
+
+
+class BotStatsWrite(TypedDict):
+    type: Literal["bot_stats"]
+    owner_user_id: str
+    bot_id: str
+    increment: int
+
+
+class TitleWrite(TypedDict):
+    type: Literal["title"]
+    user_id: str
+    conversation_id: str
+    # Truncated first exchange of the conversation
+    transcript: str
+
+
+Write = LastUsedTimeWrite | BotStatsWrite | TitleWrite
+
+
+def _item_key(write: Write) -> tuple:
+    """Key of the item the write goes to. Writes with the same key are coalesced."""
+    if write["type"] == "last_used_time":
+        return (write["type"], write["user_id"], write["bot_id"], write["is_alias"])
+    elif write["type"] == "bot_stats":
+        return (write["type"], write["owner_user_id"], write["bot_id"])
+    else:
+        return (write["type"], write["user_id"], write["conversation_id"])
+
+
+def coalesce(writes: list[Write]) -> list[Write]:
+    """Merge the writes to the same item: the latest last used time wins,
+    stats increments are summed and the first title wins.
+    """
+    coalesced: dict[tuple, Write] = {}
+    for write in writes:
+        key = _item_key(write)
+        previous = coalesced.get(key)
+        if previous is None:
+            coalesced[key] = write
+
+        elif write["type"] == "last_used_time" and previous["type"] == write["type"]:
+            if previous["time"] < write["time"]:
+                coalesced[key] = write
+
+        elif write["type"] == "bot_stats" and previous["type"] == write["type"]:
+            coalesced[key] = BotStatsWrite(
+                **{**previous, "increment": previous["increment"] + write["increment"]}
+            )
+
+    return list(coalesced.values())
+
+
+def apply_writes(writes: list[Write]) -> list[Write]:
+    """Apply the writes after coalescing them. A failed write does not stop the others.
+    Returns the coalesced writes that failed.
+    """
+    failed: list[Write] = []
+    for write in coalesce(writes):
+        try:
+            if write["type"] == "last_used_time":
+                if write["is_alias"]:
+                    update_alias_last_used_time(write["user_id"], write["bot_id"])
+                else:
+                    update_bot_last_used_time(write["user_id"], write["bot_id"])
+
+            elif write["type"] == "bot_stats":
+                update_bot_stats(
+                    write["owner_user_id"], write["bot_id"], write["increment"]
+                )
+
+            elif write["type"] == "title":
+                try:
+                    title = generate_title(write["user_id"], write["transcript"])
+                except Exception as e:
+                    # Not to retry the other writes of the batch. The title can be proposed again.
+                    logger.exception(f"Failed to generate title: {e}")
+                    continue
+                if title:
+                    change_conversation_title(
+                        write["user_id"],
+                        write["conversation_id"],
+                        title,
+                        expected_title=DEFAULT_CONVERSATION_TITLE,
+                    )
+
+        except RecordNotFoundError:
+            # The bot, alias or conversation was deleted (or renamed) in the meantime
+            logger.warning(f"Skipped write to a removed item: {write}")
+
+        except Exception as e:
+            logger.exception(f"Failed to apply write {write}: {e}")
+            failed.append(write)
+
+    return failed
+
+
+def _send_to_queue(writes: list[Write]):
+    sqs_client = boto3.client("sqs")
+    for i in range(0, len(writes), _SQS_BATCH_SIZE):
+        batch = writes[i : i + _SQS_BATCH_SIZE]
+        try:
+            response = sqs_client.send_message_batch(
+                QueueUrl=WRITE_BEHIND_QUEUE_URL,
+                Entries=[
+                    {"Id": str(j), "MessageBody": json.dumps(write)}
+                    for j, write in enumerate(batch)
+                ],
+            )
+            failed = [batch[int(entry["Id"])] for entry in response.get("Failed", [])]
+        except Exception as e:
+            logger.exception(f"Failed to send writes to the queue: {e}")
+            failed = batch
+
+        if failed:
+            # Do not lose the writes even if the queue rejects them
+            logger.warning(
+                f"Failed to enqueue {len(failed)} writes. Applying directly."
+            )
+            apply_writes(failed)
+
+
+class WriteBehindBuffer:
+    """Buffer of the writes nothing reads right after the response, flushed after it.
+    Last used time is skipped if it was written recently, and writes to the same item
+    are coalesced. Flushed writes go through SQS if `WRITE_BEHIND_QUEUE_URL` is set, and are
+    applied by `handler`; otherwise they are applied in a background thread.
+    """
+
+    def __init__(self):
+        self.writes: list[Write] = []
+
+    def update_bot_last_used_time(self, user: User, bot: BotModel):
+        now = get_current_time()
+        interval = BOT_LAST_USED_TIME_UPDATE_INTERVAL_SECONDS * 1000
+        is_alias = not bot.is_owned_by_user(user)
+        with _last_used_time_lock:
+            if _last_used_time_written.get((user.id, bot.id)) is not None:
+                return
+            if (
+                not is_alias
+                and bot.last_used_time
+                and now - int(bot.last_used_time) < interval
+            ):
+                return
+            _last_used_time_written.set((user.id, bot.id), now)
+
+        self.writes.append(
+            LastUsedTimeWrite(
+                type="last_used_time",
+                user_id=user.id,
+                bot_id=bot.id,
+                is_alias=is_alias,
+                time=now,
+            )
+        )
+
+    def update_bot_stats(self, user: User, bot: BotModel, increment: int):
+        self.writes.append(
+            BotStatsWrite(
+                type="bot_stats",
+                owner_user_id=(
+                    user.id if bot.is_owned_by_user(user) else bot.owner_user_id
+                ),
+                bot_id=bot.id,
+                increment=increment,
+            )
+        )
+
+    def generate_title(
+        self,
+        user_id: str,
+        conversation_id: str,
+        first_exchange: list[SimpleMessageModel],
+    ):
+        """Name the conversation from its first exchange, without blocking the response."""
+        transcript = build_title_transcript(first_exchange)
+        if transcript:
+            self.writes.append(
+                TitleWrite(
+                    type="title",
+                    user_id=user_id,
+                    conversation_id=conversation_id,
+                    transcript=transcript,
+                )
+            )
+
+    def _flush(self, writes: list[Write]):
+        if WRITE_BEHIND_QUEUE_URL:
+            _send_to_queue(writes)
+        else:
+            apply_writes(writes)
+
+    def flush(self) -> tuple[Future | None, Future | None]:
+        """Start writing the buffered items in background. Returns the futures to wait for:
+        the writes, and the title generation if it runs in this process (without the queue).
+        The title is separate so that the caller can wait for it after responding.
+        """
+        writes = coalesce(self.writes)
+        title_task: Future | None = None
+        if not WRITE_BEHIND_QUEUE_URL:
+            titles = [write for write in writes if write["type"] == "title"]
+            if titles:
+                title_task = _executor.submit(apply_writes, titles)
+                writes = [write for write in writes if write["type"] != "title"]
+
+        if not writes:
+            return None, title_task
+
+        logger.info(f"Flushing {len(writes)} writes")
+        return _executor.submit(self._flush, writes), title_task
+
+
+def handler(event, context):
+    """SQS consumer applying the writes enqueued by `WriteBehindBuffer`.
+    Writes in a batch are coalesced before being applied. Only the messages merged into
+    a failed write are reported as failures, so that a retry does not apply the
+    succeeded stats increments again.
+    NOTE: The event source mapping must enable `ReportBatchItemFailures`.
+    """
+    message_ids_by_key: dict[tuple, list[str]] = {}
+    writes: list[Write] = []
+    for record in event["Records"]:
+        write: Write = json.loads(record["body"])
+        message_ids_by_key.setdefault(_item_key(write), []).append(record["messageId"])
+        writes.append(write)
+
+    failed = apply_writes(writes)
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id}
+            for write in failed
+            for message_id in message_ids_by_key[_item_key(write)]
+        ]
+    }
@@ -0,0 +1,65 @@
+"""Benchmark of building the RAG prompt from 50 search results,
+with plain concatenation of every result and with the token-budgeted context packer.
+
+Usage (from the backend directory):
+    python -m benchmarks.context_packer [--chunks 50] [--chunk-chars 4000] [--repeat 100]
+"""
+
+import argparse
+import timeit
+
+from app.context_packer import pack_search_results
+from app.prompt import build_rag_prompt
+from app.token_estimator import estimate_text_tokens
+from app.vector_search import SearchResult
+
+MODEL = "claude-v3.5-sonnet"
+
+
+def build_search_results(chunks: int, chunk_chars: int) -> list[SearchResult]:
+    sentence = "The quick brown fox jumps over the lazy dog. "
+    return [
+        SearchResult(
+            bot_id="bot",
+            content=(sentence * (chunk_chars // len(sentence) + 1))[:chunk_chars],
+            source_name=f"document{i // 3}.pdf",
+            source_link=f"s3://bucket/document{i // 3}.pdf",
+            rank=i,
+            metadata={},
+            page_number=i % 3 + 1,
+        )
+        for i in range(chunks)
+    ]
+
+
+def concatenate(search_results: list[SearchResult]) -> str:
+    """Context as built before the packer, by repeated string concatenation."""
+    context_prompt = ""
+    for result in search_results:
+        context_prompt += f"<search_result>\n<content>\n{result['content']}</content>\n<source>\n{result['rank']}\n</source>\n</search_result>"
+    return context_prompt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--chunk-chars", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    search_results = build_search_results(args.chunks, args.chunk_chars)
+
+    for name, func in (
+        ("concatenate", lambda: concatenate(search_results)),
+        (
+            "packed",
+            lambda: build_rag_prompt(pack_search_results(search_results, MODEL), MODEL),
+        ),
+    ):
+        seconds = timeit.timeit(func, number=args.repeat) / args.repeat
+        tokens = estimate_text_tokens(func(), MODEL)
+        print(f"{name:>11}: {seconds * 1000:.2f} ms, {tokens} estimated prompt tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark of loading a long conversation and tracing its active path,
+with eager validation of the whole message map and with `LazyMessageMap`.
+
+Usage (from the backend directory):
+    python -m benchmarks.lazy_message_map [--turns 500] [--branches 4] [--repeat 20]
+"""
+
+import argparse
+import json
+import timeit
+
+from app.repositories.conversation import LazyMessageMap, get_tree_index
+from app.repositories.message_tree import MessageTreeIndex
+from app.repositories.models.conversation import MessageModel, TextContentModel
+from pydantic import TypeAdapter
+
+
+def _message(role: str, parent: str | None, create_time: int) -> MessageModel:
+    return MessageModel(
+        role=role,
+        content=[TextContentModel(content_type="text", body=f"{role} message " * 50)],
+        model="claude-v3.5-sonnet",
+        children=[],
+        parent=parent,
+        create_time=create_time,
+        feedback=None,
+        used_chunks=None,
+        thinking_log=None,
+    )
+
+
+def build_raw_message_map(turns: int, branches: int) -> tuple[dict, str]:
+    """Raw message map as stored in the table, and the id of its last message.
+    Each turn has `branches` regenerated answers, and the conversation continues
+    from the latest one.
+    """
+    message_map = {"system": _message("system", None, 0)}
+    parent_id = "system"
+    for turn in range(turns):
+        user_msg_id = f"u{turn:06d}"
+        message_map[user_msg_id] = _message("user", parent_id, len(message_map))
+        message_map[parent_id].children.append(user_msg_id)
+        for branch in range(branches):
+            parent_id = f"a{turn:06d}-{branch}"
+            message_map[parent_id] = _message(
+                "assistant", user_msg_id, len(message_map)
+            )
+            message_map[user_msg_id].children.append(parent_id)
+
+    raw = json.loads(
+        json.dumps({k: v.model_dump(by_alias=True) for k, v in message_map.items()})
+    )
+    return raw, parent_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    raw, leaf_id = build_raw_message_map(args.turns, args.branches)
+    # Tree index persisted with the conversation
+    tree_index = MessageTreeIndex.from_message_map(raw).to_dict()
+    adapter = TypeAdapter(dict[str, MessageModel])
+
+    def eager():
+        message_map = adapter.validate_python(raw)
+        node_id: str | None = leaf_id
+        while node_id is not None:
+            node_id = message_map[node_id].parent
+
+    def lazy():
+        message_map = LazyMessageMap(
+            raw, tree_index=MessageTreeIndex.from_dict(tree_index)
+        )
+        for message_id in get_tree_index(message_map).path_to_root(leaf_id):
+            message_map[message_id]
+
+    for name, func in (("eager", eager), ("lazy", lazy)):
+        seconds = timeit.timeit(func, number=args.repeat) / args.repeat
+        print(f"{name:>6}: {seconds * 1000:.2f} ms per load ({len(raw)} messages)")
+
+
+if __name__ == "__main__":
+    main()
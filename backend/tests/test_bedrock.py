@@ -0,0 +1,284 @@
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app import bedrock
+from app.bedrock import (
+    BedrockThrottlingException,
+    ConverseRequestBuilder,
+    calculate_price,
+    get_model_id,
+    invoke_with_failover,
+)
+from app.endpoint_health import EndpointHealth
+from app.repositories.models.conversation import SimpleMessageModel, TextContentModel
+from botocore.exceptions import ClientError
+
+MODEL = "claude-v3.5-sonnet"
+FALLBACK_MODEL = "claude-v3.5-sonnet-v2"
+# Part of the model id shared by its cross-region inference profile
+MODEL_ID_SUFFIX = get_model_id(MODEL).split(".", 1)[1]
+
+
+def _error(code: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, "Converse")
+
+
+class TestInvokeWithFailover(unittest.TestCase):
+    def setUp(self):
+        self.calls: list[dict] = []
+        # Model id to the error raised by its endpoints
+        self.errors: dict[str, ClientError] = {}
+
+        def converse(**kwargs):
+            self.calls.append(kwargs)
+            for model_id, error in self.errors.items():
+                if model_id in kwargs["modelId"]:
+                    raise error
+            return {"output": {}}
+
+        client = MagicMock()
+        client.converse.side_effect = converse
+        health: dict[tuple[str, str], EndpointHealth] = {}
+        patchers = [
+            patch.object(bedrock, "get_bedrock_runtime_client", return_value=client),
+            patch.object(
+                bedrock,
+                "get_endpoint_health",
+                side_effect=lambda region, model_id: health.setdefault(
+                    (region, model_id), EndpointHealth()
+                ),
+            ),
+            patch.object(bedrock, "BEDROCK_FALLBACK_REGIONS", []),
+            patch.object(bedrock, "BEDROCK_FALLBACK_MODELS", {MODEL: [FALLBACK_MODEL]}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.args = {
+            "modelId": get_model_id(MODEL),
+            "messages": [],
+            "inferenceConfig": {"maxTokens": 1000, "temperature": 0.6},
+            "additionalModelRequestFields": {"top_k": 250},
+        }
+
+    def test_fallback_model_gets_args_composed_for_it(self):
+        self.errors[MODEL_ID_SUFFIX] = _error("ThrottlingException")
+        composed_for: list[str] = []
+
+        def compose_args(model):
+            composed_for.append(model)
+            return {
+                "modelId": get_model_id(model),
+                "messages": [],
+                "inferenceConfig": {"maxTokens": 2000},
+            }
+
+        _, endpoint = invoke_with_failover(
+            MODEL, self.args, "converse", compose_args  # type: ignore[arg-type]
+        )
+
+        self.assertEqual(endpoint["model"], FALLBACK_MODEL)
+        self.assertEqual(composed_for, [FALLBACK_MODEL])
+        self.assertEqual(
+            self.calls[-1],
+            {
+                "modelId": get_model_id(FALLBACK_MODEL),
+                "messages": [],
+                "inferenceConfig": {"maxTokens": 2000},
+            },
+        )
+
+    def test_without_composer_fails_over_within_the_model(self):
+        self.errors[""] = _error("ThrottlingException")
+
+        with self.assertRaises(BedrockThrottlingException):
+            invoke_with_failover(MODEL, self.args, "converse")  # type: ignore[arg-type]
+
+        self.assertGreater(len(self.calls), 1)
+        for call in self.calls:
+            self.assertIn(MODEL_ID_SUFFIX, call["modelId"])
+            self.assertEqual(call["additionalModelRequestFields"], {"top_k": 250})
+
+    def test_other_errors_do_not_fail_over(self):
+        self.errors[""] = _error("ValidationException")
+
+        with self.assertRaises(ClientError):
+            invoke_with_failover(
+                MODEL, self.args, "converse", lambda model: self.args  # type: ignore[arg-type]
+            )
+
+        self.assertEqual(len(self.calls), 1)
+
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def _message(role: str, body: str) -> SimpleMessageModel:
+    return SimpleMessageModel(
+        role=role, content=[TextContentModel(content_type="text", body=body)]
+    )
+
+
+class _Tool:
+    def __init__(self, name: str):
+        self.name = name
+
+    def to_converse_spec(self) -> dict:
+        return {"name": self.name}
+
+
+class TestPromptCachePoints(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(bedrock, "ENABLE_BEDROCK_PROMPT_CACHING", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.messages = [
+            _message("user", "question"),
+            _message("assistant", "answer"),
+            _message("user", "follow-up"),
+            _message("assistant", "partial answer"),
+        ]
+
+    def _build(self, model: str):
+        return ConverseRequestBuilder(
+            model=model,  # type: ignore[arg-type]
+            instructions=["Be concise."],
+            tools={"search": _Tool("search")},  # type: ignore[dict-item]
+        ).build(self.messages)
+
+    def test_cache_points_end_stable_prefix(self):
+        args = self._build("claude-v3.7-sonnet")
+
+        self.assertEqual(args["system"], [{"text": "Be concise."}, CACHE_POINT])
+        self.assertEqual(
+            args["toolConfig"]["tools"], [{"toolSpec": {"name": "search"}}, CACHE_POINT]
+        )
+        # The prefix ends at the last user message, not at the message to continue
+        self.assertEqual(
+            [message["content"] for message in args["messages"]],
+            [
+                [{"text": "question"}],
+                [{"text": "answer"}],
+                [{"text": "follow-up"}, CACHE_POINT],
+                [{"text": "partial answer"}],
+            ],
+        )
+
+    def test_tool_specs_are_not_cached_on_nova(self):
+        args = self._build("amazon-nova-pro")
+
+        self.assertEqual(args["system"][-1], CACHE_POINT)
+        self.assertEqual(
+            args["toolConfig"]["tools"], [{"toolSpec": {"name": "search"}}]
+        )
+
+    def test_unsupported_model_has_no_cache_points(self):
+        args = self._build("claude-v3.5-sonnet")
+
+        self.assertNotIn(CACHE_POINT, args["system"])
+        self.assertNotIn(CACHE_POINT, args["toolConfig"]["tools"])
+        for message in args["messages"]:
+            self.assertNotIn(CACHE_POINT, message["content"])
+
+
+class TestConverseRequestBuilder(unittest.TestCase):
+    def setUp(self):
+        self.builder = ConverseRequestBuilder(model=MODEL)  # type: ignore[arg-type]
+        self.converted: list[str] = []
+        convert_message = self.builder._convert_message
+
+        def counting_convert_message(message, grounding_source):
+            self.converted.append(message.content[0].body)
+            return convert_message(message, grounding_source)
+
+        self.builder._convert_message = counting_convert_message  # type: ignore[method-assign]
+        self.messages = [_message("user", "question")]
+
+    def test_only_appended_messages_are_converted(self):
+        self.builder.build(self.messages)
+        self.messages += [_message("assistant", "tool use"), _message("user", "result")]
+
+        args = self.builder.build(self.messages)
+
+        self.assertEqual(self.converted, ["question", "tool use", "result"])
+        self.assertEqual(
+            [message["content"] for message in args["messages"]],
+            [[{"text": "question"}], [{"text": "tool use"}], [{"text": "result"}]],
+        )
+
+    def test_replaced_message_is_converted_again(self):
+        self.builder.build(self.messages)
+
+        self.builder.build([_message("user", "edited")])
+
+        self.assertEqual(self.converted, ["question", "edited"])
+
+    def test_grounding_source_change_converts_all_messages(self):
+        self.builder.build(self.messages)
+
+        self.builder.build(self.messages, grounding_source={"text": {"text": "source"}})
+
+        self.assertEqual(self.converted, ["question", "question"])
+
+    def test_cache_point_is_not_kept_in_converted_messages(self):
+        with patch.object(bedrock, "ENABLE_BEDROCK_PROMPT_CACHING", True):
+            builder = ConverseRequestBuilder(model="claude-v3.7-sonnet")
+        builder.build(self.messages)
+        self.messages += [_message("assistant", "tool use"), _message("user", "result")]
+
+        args = builder.build(self.messages)
+
+        self.assertEqual(
+            [message["content"] for message in args["messages"]],
+            [
+                [{"text": "question"}],
+                [{"text": "tool use"}],
+                [{"text": "result"}, CACHE_POINT],
+            ],
+        )
+
+    def test_static_args_are_not_shared_with_requests(self):
+        args = self.builder.build(self.messages)
+        args["messages"].append({"role": "assistant", "content": []})
+
+        self.assertEqual(len(self.builder.build(self.messages)["messages"]), 1)
+        self.assertEqual(self.builder.static_args["messages"], [])
+
+
+class TestCalculatePrice(unittest.TestCase):
+    def test_cached_tokens_are_priced_by_model(self):
+        price = calculate_price(
+            "claude-v3.7-sonnet",
+            1000,
+            1000,
+            region="ap-northeast-1",
+            cache_read_input_tokens=1000,
+            cache_write_input_tokens=1000,
+        )
+
+        self.assertAlmostEqual(price, 0.003 + 0.015 + 0.0003 + 0.00375)
+
+    def test_cached_tokens_default_to_input_price_ratio(self):
+        with (
+            patch.object(bedrock, "BEDROCK_PROMPT_CACHE_READ_PRICE_RATIO", 0.1),
+            patch.object(bedrock, "BEDROCK_PROMPT_CACHE_WRITE_PRICE_RATIO", 1.25),
+        ):
+            price = calculate_price(
+                "claude-v3.5-sonnet",
+                0,
+                0,
+                region="ap-northeast-1",
+                cache_read_input_tokens=1000,
+                cache_write_input_tokens=1000,
+            )
+
+        self.assertAlmostEqual(price, 0.003 * 0.1 + 0.003 * 1.25)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import sys
+import unittest
+
+sys.path.insert(0, ".")
+
+from app.bot_config import compute_bot_config_hash
+from pydantic import BaseModel
+
+
+class _Bot(BaseModel):
+    """Stands in for `BotModel` with the fields relevant to the hash."""
+
+    id: str
+    instruction: str
+    sync_last_exec_id: str
+    usage_stats: dict
+    last_used_time: float
+    published_api_datetime: int | None = None
+
+
+class TestBotConfigHash(unittest.TestCase):
+    def setUp(self):
+        self.bot = _Bot(
+            id="bot",
+            instruction="Be concise.",
+            sync_last_exec_id="exec-1",
+            usage_stats={"usage_count": 1},
+            last_used_time=0,
+        )
+
+    def test_stable_across_usage_and_publication(self):
+        bot_hash = compute_bot_config_hash(self.bot)  # type: ignore[arg-type]
+        updated = self.bot.model_copy(
+            update={
+                "usage_stats": {"usage_count": 2},
+                "last_used_time": 1,
+                "published_api_datetime": 1,
+            }
+        )
+        self.assertEqual(compute_bot_config_hash(updated), bot_hash)  # type: ignore[arg-type]
+
+    def test_changes_with_configuration(self):
+        bot_hash = compute_bot_config_hash(self.bot)  # type: ignore[arg-type]
+        for update in ({"instruction": "Be verbose."}, {"sync_last_exec_id": "exec-2"}):
+            self.assertNotEqual(
+                compute_bot_config_hash(self.bot.model_copy(update=update)),  # type: ignore[arg-type]
+                bot_hash,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import sys
+import unittest
+from unittest.mock import MagicMock
+
+sys.path.insert(0, ".")
+os.environ.setdefault("WEBSOCKET_SESSION_TABLE_NAME", "websocket-session")
+
+from app.chat_notification import event_payloads
+from app.usecases.chat import ToolResultEvent
+from app.websocket import NotificationSender
+
+
+def _related_document() -> MagicMock:
+    document = MagicMock()
+    document.to_schema.return_value.model_dump.return_value = {"sourceId": "tool@0"}
+    return document
+
+
+class TestEventPayloads(unittest.TestCase):
+    def test_tool_result_notifies_result_and_related_documents(self):
+        payloads = event_payloads(
+            ToolResultEvent(
+                type="tool_result",
+                result={
+                    "tool_use_id": "tool",
+                    "status": "success",
+                    "related_documents": [_related_document()],
+                },
+            )
+        )
+        self.assertEqual(
+            payloads,
+            [
+                {
+                    "status": "AGENT_TOOL_RESULT",
+                    "result": {"toolUseId": "tool", "status": "success"},
+                },
+                {
+                    "status": "AGENT_RELATED_DOCUMENT",
+                    "result": {
+                        "toolUseId": "tool",
+                        "relatedDocument": {"sourceId": "tool@0"},
+                    },
+                },
+            ],
+        )
+
+    def test_websocket_notifies_same_payloads(self):
+        sender = NotificationSender("https://example.com", "connection")
+        sender.on_stream("Hello")
+        sender.on_stop({"stop_reason": "end_turn"})
+
+        notified = []
+        while not sender.commands.empty():
+            notified.append(json.loads(sender.commands.get()["payload"]))
+        self.assertEqual(
+            notified,
+            [
+                *event_payloads({"type": "text", "text": "Hello"}),
+                *event_payloads(
+                    {"type": "stop", "result": {"stop_reason": "end_turn"}}
+                ),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import sys
+import unittest
+
+sys.path.insert(0, ".")
+
+from app.context_packer import _merge_adjacent, pack_search_results
+from app.vector_search import SearchResult
+
+
+def _result(
+    rank: int, content: str, source_link: str, page_number: int | None
+) -> SearchResult:
+    return SearchResult(
+        bot_id="bot",
+        content=content,
+        source_name=source_link,
+        source_link=source_link,
+        rank=rank,
+        metadata={},
+        page_number=page_number,
+    )
+
+
+class TestMergeAdjacent(unittest.TestCase):
+    def test_merges_same_source_on_adjacent_pages(self):
+        merged = _merge_adjacent(
+            [
+                _result(0, "a", "s3://doc.pdf", 1),
+                _result(1, "b", "s3://doc.pdf", 2),
+                _result(2, "c", "s3://doc.pdf", 3),
+            ]
+        )
+        self.assertEqual([r["content"] for r in merged], ["a\nb\nc"])
+        self.assertEqual(merged[0]["rank"], 0)
+
+    def test_keeps_results_without_source_apart(self):
+        merged = _merge_adjacent([_result(0, "a", "", None), _result(1, "b", "", None)])
+        self.assertEqual(len(merged), 2)
+
+    def test_keeps_results_without_page_apart(self):
+        merged = _merge_adjacent(
+            [
+                _result(0, "a", "https://example.com", None),
+                _result(1, "b", "https://example.com", None),
+            ]
+        )
+        self.assertEqual(len(merged), 2)
+
+    def test_keeps_distant_pages_apart(self):
+        merged = _merge_adjacent(
+            [_result(0, "a", "s3://doc.pdf", 1), _result(1, "b", "s3://doc.pdf", 5)]
+        )
+        self.assertEqual(len(merged), 2)
+
+
+class TestPackSearchResults(unittest.TestCase):
+    def test_truncates_on_sentence_within_budget(self):
+        results = [
+            _result(i, "This is a sentence. " * 100, f"s3://doc{i}.pdf", None)
+            for i in range(50)
+        ]
+        packed = pack_search_results(results, "claude-v3.5-sonnet", budget=1000)
+
+        self.assertLess(len(packed), len(results))
+        self.assertTrue(packed[-1]["content"].endswith("."))
+
+
+if __name__ == "__main__":
+    unittest.main()
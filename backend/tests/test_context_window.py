@@ -0,0 +1,141 @@
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, ".")
+
+from app import context_window
+from app.context_window import Turn, fit_to_context_window
+from app.prompt import build_conversation_summary_prompt
+from app.repositories.conversation import ContextSummary
+from app.repositories.models.conversation import SimpleMessageModel, TextContentModel
+
+MODEL = "claude-v3.5-sonnet"
+
+
+def _turn(message_id: str, role: str) -> Turn:
+    return (
+        message_id,
+        [
+            SimpleMessageModel(
+                role=role,
+                content=[TextContentModel(content_type="text", body=message_id)],
+            )
+        ],
+    )
+
+
+class TestFitToContextWindow(unittest.TestCase):
+    def setUp(self):
+        self.turns = [
+            _turn("system", "system"),
+            _turn("u1", "user"),
+            _turn("a1", "assistant"),
+            _turn("u2", "user"),
+            _turn("a2", "assistant"),
+        ]
+        self.token_counts = {"u1": 40, "a1": 40, "u2": 20, "a2": 20}
+        self.summaries: dict[str, ContextSummary] = {}
+
+        patchers = [
+            patch.object(
+                context_window, "CONTEXT_WINDOW_TOKEN_BUDGET", {"default": 100}
+            ),
+            patch.object(context_window, "CONTEXT_WINDOW_RECENT_RATIO", 0.5),
+            patch.object(context_window, "calibrated", lambda tokens, model: tokens),
+            patch.object(context_window, "estimate_text_tokens", return_value=10),
+            patch.object(
+                context_window,
+                "get_token_count",
+                side_effect=lambda message_map, message_id: self.token_counts[
+                    message_id
+                ],
+            ),
+            patch.object(
+                context_window,
+                "find_context_summaries_by_conversation_id",
+                side_effect=lambda user_id, conversation_id: self.summaries,
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.summarize = patch.object(
+            context_window, "_summarize", return_value=("Summary", 0.5)
+        ).start()
+        self.store = patch.object(context_window, "store_context_summary").start()
+        self.addCleanup(patch.stopall)
+
+    def _fit(self):
+        return fit_to_context_window("user", "conversation", self.turns, {}, MODEL)
+
+    def _bodies(self, window) -> list[str]:
+        return [message.content[0].body for message in window["messages"]]
+
+    def test_history_within_budget_is_sent_as_is(self):
+        self.token_counts["u1"] = 20
+
+        window = self._fit()
+
+        # The system node is not sent as a message
+        self.assertEqual(self._bodies(window), ["u1", "a1", "u2", "a2"])
+        self.assertIsNone(window["summary_prompt"])
+        self.summarize.assert_not_called()
+
+    def test_older_turns_are_summarized(self):
+        window = self._fit()
+
+        self.assertEqual(self._bodies(window), ["u2", "a2"])
+        self.assertEqual(
+            window["summary_prompt"], build_conversation_summary_prompt("Summary")
+        )
+        self.assertEqual(window["price"], 0.5)
+        self.assertEqual(self.summarize.call_args.args, ("user", "", self.turns[1:3]))
+        stored = self.store.call_args.kwargs["context_summary"]
+        self.assertEqual(stored["message_id"], "a1")
+        self.assertEqual(stored["summary"], "Summary")
+
+    def test_recent_turns_start_with_user_message(self):
+        # Only `a2` fits into the recent part, which cannot start the messages
+        self.token_counts["u2"] = 40
+
+        window = self._fit()
+
+        self.assertEqual(self._bodies(window), [])
+        # Each summarization request fits into the budget as well
+        self.assertEqual(
+            [call.args[1:] for call in self.summarize.call_args_list],
+            [("", self.turns[1:3]), ("Summary", self.turns[3:5])],
+        )
+        self.assertEqual(
+            self.store.call_args.kwargs["context_summary"]["message_id"], "a2"
+        )
+
+    def test_stored_summary_is_reused(self):
+        self.summaries["a1"] = ContextSummary(
+            message_id="a1", summary="Stored", create_time=0
+        )
+
+        window = self._fit()
+
+        self.assertEqual(self._bodies(window), ["u2", "a2"])
+        self.assertEqual(
+            window["summary_prompt"], build_conversation_summary_prompt("Stored")
+        )
+        self.assertEqual(window["price"], 0.0)
+        self.summarize.assert_not_called()
+        self.store.assert_not_called()
+
+    def test_failed_summarization_sends_whole_history(self):
+        self.summarize.side_effect = RuntimeError("throttled")
+
+        window = self._fit()
+
+        self.assertEqual(self._bodies(window), ["u1", "a1", "u2", "a2"])
+        self.assertIsNone(window["summary_prompt"])
+        self.store.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import sys
+import unittest
+from threading import Thread
+from time import time
+from unittest.mock import patch
+
+sys.path.insert(0, ".")
+
+from app import bedrock, rate_limiter
+from app.config import BedrockRateLimit
+from app.rate_limiter import ModelRateLimiter, _SharedBuckets
+from app.repositories.rate_limit import RateLimitState
+
+LIMIT = BedrockRateLimit(requests_per_minute=60, tokens_per_minute=10000)
+
+
+class TestSettleOnError(unittest.TestCase):
+    def setUp(self):
+        rate_limiter._limiters.clear()
+        self.addCleanup(rate_limiter._limiters.clear)
+        patcher = patch.dict(
+            rate_limiter.BEDROCK_RATE_LIMITS, {"claude-v3.5-sonnet": LIMIT}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reservation_is_returned_when_converse_fails(self):
+        args = {"inferenceConfig": {"maxTokens": 1000}}
+        with patch.object(
+            bedrock, "invoke_with_failover", side_effect=ValueError("invalid")
+        ):
+            with self.assertRaises(ValueError):
+                bedrock.call_converse_api(
+                    args, "claude-v3.5-sonnet", user_id="user", input_tokens=2000
+                )
+
+        limiter = rate_limiter._limiters["claude-v3.5-sonnet"]
+        self.assertAlmostEqual(
+            limiter.buckets.state["token_level"], LIMIT["tokens_per_minute"]
+        )
+
+    def test_reservation_is_settled_with_usage(self):
+        args = {"inferenceConfig": {"maxTokens": 1000}}
+        with patch.object(
+            bedrock,
+            "invoke_with_failover",
+            return_value=({"usage": {"totalTokens": 500}}, None),
+        ):
+            bedrock.call_converse_api(
+                args, "claude-v3.5-sonnet", user_id="user", input_tokens=2000
+            )
+
+        limiter = rate_limiter._limiters["claude-v3.5-sonnet"]
+        self.assertAlmostEqual(
+            limiter.buckets.state["token_level"], LIMIT["tokens_per_minute"] - 500
+        )
+
+
+class TestSharedBuckets(unittest.TestCase):
+    def test_condition_is_released_during_dynamodb_calls(self):
+        limiter = ModelRateLimiter("claude-v3.5-sonnet", LIMIT)
+        limiter.buckets = _SharedBuckets("claude-v3.5-sonnet", LIMIT)
+        held_during_calls: list[bool] = []
+
+        def is_held() -> bool:
+            # The condition is reentrant, so it is tried from another thread
+            acquired: list[bool] = []
+
+            def try_acquire():
+                acquired.append(limiter._condition.acquire(blocking=False))
+                if acquired[0]:
+                    limiter._condition.release()
+
+            thread = Thread(target=try_acquire)
+            thread.start()
+            thread.join()
+            return not acquired[0]
+
+        stored: list[RateLimitState] = []
+
+        def find_rate_limit_state(model):
+            held_during_calls.append(is_held())
+            return stored[-1] if stored else None
+
+        def update_rate_limit_state(model, state, previous_updated_at):
+            held_during_calls.append(is_held())
+            stored.append(state)
+            return True
+
+        with patch.multiple(
+            rate_limiter,
+            find_rate_limit_state=find_rate_limit_state,
+            update_rate_limit_state=update_rate_limit_state,
+        ):
+            limiter.acquire("user", 100).settle(50)
+
+        self.assertEqual(held_during_calls, [False, False, False, False])
+
+
+class _FakeSharedState:
+    """Emulates the conditional write of `update_rate_limit_state`."""
+
+    def __init__(self, state: RateLimitState | None):
+        self.state = state
+        self.before_update: list = []
+
+    def find(self, model):
+        return dict(self.state) if self.state else None
+
+    def update(self, model, state, previous_updated_at):
+        if self.before_update:
+            self.before_update.pop(0)()
+        current = self.state["updated_at"] if self.state else None
+        if current != previous_updated_at:
+            return False
+        self.state = state
+        return True
+
+
+class TestSharedSettlement(unittest.TestCase):
+    def setUp(self):
+        self.buckets = _SharedBuckets("claude-v3.5-sonnet", LIMIT)
+
+    def _patch(self, fake: _FakeSharedState):
+        patcher = patch.multiple(
+            rate_limiter,
+            find_rate_limit_state=fake.find,
+            update_rate_limit_state=fake.update,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_settlement_is_not_lost_by_concurrent_consumption(self):
+        now = time()
+        fake = _FakeSharedState(
+            RateLimitState(request_level=10, token_level=5000, updated_at=now)
+        )
+        self._patch(fake)
+
+        def consume_concurrently():
+            # Another container consumes between the read and the write of the settlement
+            self.assertEqual(self.buckets.try_consume(1000), 0.0)
+
+        fake.before_update.append(consume_concurrently)
+        self.buckets.add_tokens(500)
+
+        # Both are applied, apart from the refill in the meantime
+        self.assertAlmostEqual(fake.state["token_level"], 4500, delta=10)
+        self.assertGreaterEqual(fake.state["updated_at"], now)
+
+    def test_settlement_is_capped(self):
+        fake = _FakeSharedState(
+            RateLimitState(
+                request_level=10,
+                token_level=LIMIT["tokens_per_minute"] - 100,
+                updated_at=time(),
+            )
+        )
+        self._patch(fake)
+
+        self.buckets.add_tokens(1000)
+
+        self.assertEqual(fake.state["token_level"], LIMIT["tokens_per_minute"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app.repositories import bot_stats
+from app.repositories.bot_stats import (
+    PENDING_ROLL_UP_INDEX_NAME,
+    increment_bot_usage_count,
+    roll_up_usage_counts,
+)
+from app.repositories.common import compose_bot_stats_pk
+from botocore.exceptions import ClientError
+
+
+def _shard(owner_user_id: str, bot_id: str, usage_count: int) -> dict:
+    pk = compose_bot_stats_pk(owner_user_id, bot_id)
+    return {
+        "PK": pk,
+        "SK": "STATS#SHARD#0",
+        "UsageCount": usage_count,
+        "PendingRollUp": pk,
+    }
+
+
+class TestBotStats(unittest.TestCase):
+    def setUp(self):
+        self.table = MagicMock()
+        self.client = MagicMock()
+        for name, value in (
+            ("get_bot_table_client", self.table),
+            ("get_dynamodb_client", self.client),
+        ):
+            patcher = patch.object(bot_stats, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_increment_marks_only_own_shard_pending(self):
+        increment_bot_usage_count("owner", "bot", 1)
+
+        self.table.update_item.assert_called_once()
+        kwargs = self.table.update_item.call_args.kwargs
+        self.assertEqual(kwargs["Key"]["PK"], "BOT_STATS#owner#bot")
+        self.assertEqual(
+            kwargs["ExpressionAttributeValues"][":pk"], "BOT_STATS#owner#bot"
+        )
+
+    def test_copies_of_a_bot_are_rolled_up_to_their_owners(self):
+        self.table.scan.return_value = {
+            "Items": [_shard("owner1", "bot", 2), _shard("owner2", "bot", 3)]
+        }
+
+        roll_up_usage_counts()
+
+        self.table.scan.assert_called_once_with(IndexName=PENDING_ROLL_UP_INDEX_NAME)
+        rolled_up = {
+            call.kwargs["TransactItems"][0]["Update"]["Key"]["PK"]: call.kwargs[
+                "TransactItems"
+            ][0]["Update"]["ExpressionAttributeValues"][":val"]
+            for call in self.client.transact_write_items.call_args_list
+        }
+        self.assertEqual(rolled_up, {"owner1": 2, "owner2": 3})
+
+    def test_pending_mark_is_removed_only_from_emptied_shards(self):
+        self.table.scan.return_value = {"Items": [_shard("owner", "bot", 2)]}
+
+        roll_up_usage_counts()
+
+        kwargs = self.table.update_item.call_args.kwargs
+        self.assertEqual(kwargs["UpdateExpression"], "REMOVE PendingRollUp")
+        self.assertEqual(kwargs["ConditionExpression"], "UsageCount = :zero")
+
+    def test_cancelled_roll_up_keeps_pending_mark(self):
+        self.table.scan.return_value = {"Items": [_shard("owner", "bot", 2)]}
+        self.client.transact_write_items.side_effect = ClientError(
+            {
+                "Error": {"Code": "TransactionCanceledException"},
+                "CancellationReasons": [
+                    {"Code": "None"},
+                    {"Code": "TransactionConflict"},
+                ],
+            },
+            "TransactWriteItems",
+        )
+
+        roll_up_usage_counts()
+
+        self.table.update_item.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
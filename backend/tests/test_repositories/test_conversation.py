@@ -0,0 +1,361 @@
+import json
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app.repositories import conversation as conversation_repository
+from app.repositories.common import RecordNotFoundError
+from app.repositories.conversation import (
+    LazyMessageMap,
+    _resolve_instruction,
+    change_conversation_title,
+    get_token_count,
+    get_tree_index,
+    store_conversation,
+)
+from app.repositories.instruction import compute_instruction_hash
+from app.repositories.message_tree import MessageTreeIndex
+from app.repositories.models.conversation import (
+    ConversationModel,
+    MessageModel,
+    TextContentModel,
+)
+from botocore.exceptions import ClientError
+
+
+def _message(role: str, parent: str | None, children: list[str], body: str = ""):
+    return MessageModel(
+        role=role,
+        content=[TextContentModel(content_type="text", body=body)],
+        model="claude-v3.5-sonnet",
+        children=children,
+        parent=parent,
+        create_time=1627984879.9,
+        feedback=None,
+        used_chunks=None,
+        thinking_log=None,
+    )
+
+
+def _raw_message_map(turns: int, body: str = "hello") -> dict:
+    message_map = {"system": _message("system", None, [])}
+    parent_id = "system"
+    for i in range(turns):
+        message_id = f"m{i}"
+        message_map[message_id] = _message("user", parent_id, [], body)
+        message_map[parent_id].children.append(message_id)
+        parent_id = message_id
+
+    return {k: v.model_dump(by_alias=True) for k, v in message_map.items()}
+
+
+class _FakeConversationTable:
+    """Applies the writes of a conversation item as DynamoDB does."""
+
+    def __init__(self):
+        self.item: dict | None = None
+
+    def _check(self, condition: bool):
+        if not condition:
+            raise ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "Write"
+            )
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeValues):
+        # attribute_not_exists(PK) OR Title = :title
+        self._check(
+            self.item is None
+            or self.item["Title"] == ExpressionAttributeValues[":title"]
+        )
+        self.item = dict(Item)
+        return {}
+
+    def get_item(self, Key, ProjectionExpression, ConsistentRead):
+        return {"Item": {"Title": self.item["Title"]}}
+
+    def update_item(self, ExpressionAttributeValues, **kwargs):
+        # change_conversation_title
+        self._check(
+            self.item is not None
+            and (
+                ":expected" not in ExpressionAttributeValues
+                or self.item["Title"] == ExpressionAttributeValues[":expected"]
+            )
+        )
+        self.item["Title"] = ExpressionAttributeValues[":t"]
+        return {}
+
+
+def _conversation(
+    message_map, title: str = "Test conversation", bot_id: str | None = None
+) -> ConversationModel:
+    return ConversationModel.model_construct(
+        id="conversation",
+        create_time=1627984879.9,
+        title=title,
+        total_price=0,
+        message_map=message_map,
+        last_message_id="",
+        bot_id=bot_id,
+        should_continue=False,
+    )
+
+
+class TestStoreConversationItemSize(unittest.TestCase):
+    def setUp(self):
+        self.table = MagicMock()
+        patchers = [
+            patch.object(
+                conversation_repository,
+                "get_conversation_table_client",
+                return_value=self.table,
+            ),
+            patch.object(conversation_repository, "s3_client"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _stored_item(self) -> dict:
+        return self.table.put_item.call_args.kwargs["Item"]
+
+    def _sizes(self, message_map: LazyMessageMap) -> tuple[int, int]:
+        """Sizes of the message map, and of the tree index with the token counts."""
+        message_map_size = len(json.dumps(message_map.dump()).encode("utf-8"))
+        index_size = len(
+            json.dumps(get_tree_index(message_map).to_dict()).encode("utf-8")
+        ) + len(
+            json.dumps(
+                {
+                    message_id: get_token_count(message_map, message_id)
+                    for message_id in message_map
+                }
+            ).encode("utf-8")
+        )
+        return message_map_size, index_size
+
+    def test_small_conversation_is_stored_in_item(self):
+        message_map = LazyMessageMap(_raw_message_map(3))
+        store_conversation("user", _conversation(message_map))
+
+        item = self._stored_item()
+        self.assertFalse(item["IsLargeMessage"])
+        self.assertIn("TreeIndex", item)
+        self.assertEqual(len(json.loads(item["MessageMap"])), 4)
+
+    def test_index_counts_toward_threshold(self):
+        message_map = LazyMessageMap(_raw_message_map(20))
+        message_map_size, index_size = self._sizes(message_map)
+
+        # The message map alone fits, but not with the index
+        store_conversation(
+            "user",
+            _conversation(message_map),
+            threshold=message_map_size + index_size - 1,
+        )
+        item = self._stored_item()
+        self.assertTrue(item["IsLargeMessage"])
+        self.assertEqual(list(json.loads(item["MessageMap"]).keys()), ["system"])
+        self.assertIn("TreeIndex", item)
+        self.assertIn("TokenCounts", item)
+
+    def test_all_fit_at_threshold(self):
+        message_map = LazyMessageMap(_raw_message_map(20))
+        message_map_size, index_size = self._sizes(message_map)
+
+        store_conversation(
+            "user",
+            _conversation(message_map),
+            threshold=message_map_size + index_size,
+        )
+        self.assertFalse(self._stored_item()["IsLargeMessage"])
+
+    def test_oversized_index_is_not_stored(self):
+        message_map = LazyMessageMap(_raw_message_map(20))
+        tree_index_size = len(
+            json.dumps(get_tree_index(message_map).to_dict()).encode("utf-8")
+        )
+
+        store_conversation(
+            "user", _conversation(message_map), threshold=tree_index_size
+        )
+        item = self._stored_item()
+        self.assertIn("TreeIndex", item)
+        self.assertNotIn("TokenCounts", item)
+        self.assertTrue(item["IsLargeMessage"])
+
+        store_conversation(
+            "user", _conversation(message_map), threshold=tree_index_size - 1
+        )
+        item = self._stored_item()
+        self.assertNotIn("TreeIndex", item)
+        self.assertTrue(item["IsLargeMessage"])
+
+
+class TestPersistedTreeIndex(unittest.TestCase):
+    def test_index_of_other_ids_is_rebuilt(self):
+        raw = _raw_message_map(3)
+        # Same length, but covers different messages
+        stale = MessageTreeIndex.from_message_map({f"x{k}": v for k, v in raw.items()})
+        message_map = LazyMessageMap(raw, tree_index=stale)
+
+        self.assertEqual(get_tree_index(message_map).ids, list(raw.keys()))
+        self.assertEqual(
+            get_tree_index(message_map).path_to_root("m2"),
+            ["m2", "m1", "m0", "system"],
+        )
+
+    def test_index_covering_loaded_ids_is_reused(self):
+        raw = _raw_message_map(3)
+        persisted = MessageTreeIndex.from_message_map(raw)
+        message_map = LazyMessageMap(raw, tree_index=persisted)
+
+        self.assertIs(get_tree_index(message_map), persisted)
+
+    @patch.object(conversation_repository, "s3_client")
+    @patch.object(conversation_repository, "get_conversation_table_client")
+    def test_in_place_edit_is_persisted(self, get_table, _):
+        raw = _raw_message_map(2)
+        message_map = LazyMessageMap(
+            raw, tree_index=MessageTreeIndex.from_message_map(raw)
+        )
+        # Detach the last message without replacing its parent in the map
+        message_map["m0"].children.remove("m1")
+
+        store_conversation("user", _conversation(message_map))
+        item = get_table.return_value.put_item.call_args.kwargs["Item"]
+        stored = MessageTreeIndex.from_dict(json.loads(item["TreeIndex"]))
+        self.assertEqual(stored.children_of("m0"), [])
+
+
+class TestStoredInstruction(unittest.TestCase):
+    def setUp(self):
+        self.table = MagicMock()
+        self.store_instruction = MagicMock()
+        self.find_instruction_by_hash = MagicMock(return_value="Be concise.")
+        patchers = [
+            patch.object(
+                conversation_repository,
+                "get_conversation_table_client",
+                return_value=self.table,
+            ),
+            patch.object(conversation_repository, "s3_client"),
+            patch.multiple(
+                conversation_repository,
+                store_instruction=self.store_instruction,
+                find_instruction_by_hash=self.find_instruction_by_hash,
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.instruction_ref = {
+            "BotId": "bot",
+            "Hash": compute_instruction_hash("Be concise."),
+        }
+
+    def _loaded_message_map(self) -> LazyMessageMap:
+        raw = _raw_message_map(1)
+        raw["instruction"] = _message("instruction", None, []).model_dump(by_alias=True)
+        message_map = LazyMessageMap(raw)
+        _resolve_instruction(message_map, self.instruction_ref)
+        return message_map
+
+    def _stored_item(self) -> dict:
+        return self.table.put_item.call_args.kwargs["Item"]
+
+    def test_loaded_instruction_is_not_written_again(self):
+        message_map = self._loaded_message_map()
+        self.assertEqual(message_map["instruction"].content[0].body, "Be concise.")
+
+        store_conversation("user", _conversation(message_map, bot_id="bot"))
+
+        self.store_instruction.assert_not_called()
+        self.assertEqual(self._stored_item()["InstructionRef"], self.instruction_ref)
+
+    def test_changed_instruction_is_written(self):
+        message_map = self._loaded_message_map()
+        message_map["instruction"] = _message("instruction", None, [], "Be verbose.")
+
+        store_conversation("user", _conversation(message_map, bot_id="bot"))
+
+        self.store_instruction.assert_called_once_with("bot", "Be verbose.")
+        self.assertEqual(
+            self._stored_item()["InstructionRef"]["Hash"],
+            compute_instruction_hash("Be verbose."),
+        )
+
+    def test_instruction_of_new_conversation_is_written(self):
+        message_map = {
+            "system": _message("system", None, []),
+            "instruction": _message("instruction", None, [], "Be concise."),
+        }
+
+        store_conversation("user", _conversation(message_map, bot_id="bot"))
+
+        self.store_instruction.assert_called_once_with("bot", "Be concise.")
+
+    def test_missing_instruction_is_not_loaded_as_empty(self):
+        self.find_instruction_by_hash.side_effect = RecordNotFoundError()
+
+        with self.assertRaises(RecordNotFoundError):
+            self._loaded_message_map()
+
+
+class TestTitleRacingStore(unittest.TestCase):
+    def setUp(self):
+        self.table = _FakeConversationTable()
+        patchers = [
+            patch.object(
+                conversation_repository,
+                "get_conversation_table_client",
+                return_value=self.table,
+            ),
+            patch.object(conversation_repository, "s3_client"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_generated_title_is_kept_by_later_store(self):
+        loaded = _conversation(
+            LazyMessageMap(_raw_message_map(1)), title="New conversation"
+        )
+        store_conversation("user", loaded)
+        self.assertEqual(self.table.item["Title"], "New conversation")
+
+        # Generated in background after the first store
+        change_conversation_title(
+            "user",
+            "conversation",
+            "Generated title",
+            expected_title="New conversation",
+        )
+        # Stored again from the conversation loaded before the title was generated
+        store_conversation("user", loaded)
+
+        self.assertEqual(self.table.item["Title"], "Generated title")
+
+    def test_generated_title_does_not_overwrite_renamed_title(self):
+        store_conversation(
+            "user",
+            _conversation(
+                LazyMessageMap(_raw_message_map(1)), title="New conversation"
+            ),
+        )
+        change_conversation_title("user", "conversation", "Renamed by user")
+
+        with self.assertRaises(RecordNotFoundError):
+            change_conversation_title(
+                "user",
+                "conversation",
+                "Generated title",
+                expected_title="New conversation",
+            )
+        self.assertEqual(self.table.item["Title"], "Renamed by user")
+
+
+if __name__ == "__main__":
+    unittest.main()
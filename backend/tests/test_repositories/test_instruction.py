@@ -0,0 +1,58 @@
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app.repositories import instruction as instruction_repository
+from app.repositories.common import RecordNotFoundError
+from app.repositories.instruction import (
+    compute_instruction_hash,
+    find_instruction_by_hash,
+    store_instruction,
+)
+from botocore.exceptions import ClientError
+
+
+class TestInstructionStore(unittest.TestCase):
+    def setUp(self):
+        self.table = MagicMock()
+        patcher = patch.object(
+            instruction_repository, "get_bot_table_client", return_value=self.table
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        find_instruction_by_hash.cache_clear()
+
+    def test_instruction_is_written_once_per_content(self):
+        self.table.put_item.side_effect = [
+            {},
+            ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem"
+            ),
+        ]
+
+        first = store_instruction("bot", "Be concise.")
+        self.assertEqual(store_instruction("bot", "Be concise."), first)
+        self.assertEqual(
+            self.table.put_item.call_args.kwargs["ConditionExpression"],
+            "attribute_not_exists(PK)",
+        )
+
+    def test_instruction_is_found_by_hash(self):
+        self.table.get_item.return_value = {"Item": {"Instruction": "Be concise."}}
+
+        self.assertEqual(
+            find_instruction_by_hash("bot", compute_instruction_hash("Be concise.")),
+            "Be concise.",
+        )
+
+    def test_missing_instruction_raises(self):
+        self.table.get_item.return_value = {}
+
+        with self.assertRaises(RecordNotFoundError):
+            find_instruction_by_hash("bot", compute_instruction_hash("Be concise."))
+
+
+if __name__ == "__main__":
+    unittest.main()
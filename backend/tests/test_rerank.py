@@ -0,0 +1,67 @@
+import sys
+import unittest
+
+sys.path.insert(0, ".")
+
+from app.rerank import bm25_scores, find_near_duplicates, rerank, tokenize
+
+
+class TestTokenize(unittest.TestCase):
+    def test_words_are_normalized(self):
+        self.assertEqual(
+            tokenize("Amazon Ｂｅｄｒｏｃｋ, API!"), ["amazon", "bedrock", "api"]
+        )
+
+    def test_cjk_is_split_into_bigrams(self):
+        self.assertEqual(tokenize("東京都"), ["東京", "京都"])
+
+
+class TestFindNearDuplicates(unittest.TestCase):
+    def test_later_duplicate_is_found(self):
+        text = "The quick brown fox jumps over the lazy dog near the river bank"
+        texts = [text, "Completely different content about something else", text + "."]
+
+        self.assertEqual(find_near_duplicates(texts), {2})
+
+    def test_distinct_texts_are_kept(self):
+        texts = [
+            "Bedrock knowledge bases store documents for retrieval",
+            "DynamoDB tables keep conversations of the users",
+        ]
+
+        self.assertEqual(find_near_duplicates(texts), set())
+
+
+class TestRerank(unittest.TestCase):
+    def test_bm25_scores_matching_text_higher(self):
+        scores = bm25_scores(
+            "refund policy",
+            ["Our refund policy allows returns", "Shipping takes three days"],
+        )
+
+        self.assertGreater(scores[0], scores[1])
+        self.assertEqual(scores[1], 0)
+
+    def test_lexical_match_is_promoted(self):
+        texts = [
+            "Pricing of the service depends on the region",
+            "The service is available in several regions",
+            "Refund requests are accepted within thirty days",
+        ]
+
+        reranked = rerank("refund", ["a", "b", "c"], texts, top_k=3)
+
+        # `c` is promoted over `b`, but not over the top retrieval result
+        self.assertEqual(reranked, ["a", "c", "b"])
+
+    def test_duplicates_are_removed_before_top_k(self):
+        text = "Refund requests are accepted within thirty days of the purchase"
+        texts = [text, text, "Shipping takes three days", "Pricing depends on region"]
+
+        reranked = rerank("refund", ["a", "b", "c", "d"], texts, top_k=2)
+
+        self.assertEqual(reranked, ["a", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.insert(0, ".")
+
+from app.repositories.models.conversation import (
+    ConversationModel,
+    MessageModel,
+    RelatedDocumentModel,
+    SimpleMessageModel,
+    TextContentModel,
+)
+from app.response_cache import CachedResponse
+from app.usecases import chat as chat_usecase
+
+
+def _cached_response() -> CachedResponse:
+    return CachedResponse(
+        message_id="original",
+        content=[TextContentModel(content_type="text", body="Answer [^0]")],
+        thinking_log=[
+            SimpleMessageModel(
+                role="assistant",
+                content=[TextContentModel(content_type="text", body="Searching")],
+            )
+        ],
+        related_documents=[
+            # From the knowledge base, bound to the assistant message
+            RelatedDocumentModel(content=None, source_id="original@0"),
+            # From a tool use
+            RelatedDocumentModel(content=None, source_id="tooluse_1@0"),
+        ],
+    )
+
+
+class TestAnswerFromCache(unittest.TestCase):
+    def setUp(self):
+        self.conversation = ConversationModel(
+            id="conversation",
+            create_time=0,
+            title="New conversation",
+            total_price=0,
+            message_map={
+                "user_msg": MessageModel(
+                    role="user",
+                    content=[TextContentModel(content_type="text", body="Question")],
+                    model="claude-v3.5-sonnet",
+                    children=[],
+                    parent=None,
+                    create_time=0,
+                )
+            },
+            last_message_id="user_msg",
+        )
+        patcher = patch.object(chat_usecase, "_finish_chat")
+        self.finish_chat = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _answer(self, cached: CachedResponse):
+        return chat_usecase._answer_from_cache(
+            user=SimpleNamespace(id="user"),
+            chat_input=SimpleNamespace(
+                message=SimpleNamespace(model="claude-v3.5-sonnet")
+            ),
+            user_msg_id="user_msg",
+            conversation=self.conversation,
+            bot=None,
+            cached=cached,
+            on_stream=None,
+            on_stop=None,
+            background_tasks=[],
+            title_tasks=None,
+        )
+
+    def test_citations_are_bound_to_the_new_message(self):
+        conversation, _ = self._answer(_cached_response())
+
+        related_documents = self.finish_chat.call_args.kwargs["related_documents"]
+        self.assertEqual(
+            [document.source_id for document in related_documents],
+            [f"{conversation.last_message_id}@0", "tooluse_1@0"],
+        )
+
+    def test_cached_response_is_not_shared(self):
+        cached = _cached_response()
+        _, message = self._answer(cached)
+
+        message.thinking_log[0].content[0].body = "Changed"
+        message.content[0].body = "Changed"
+        self.assertEqual(cached["thinking_log"][0].content[0].body, "Searching")
+        self.assertEqual(cached["content"][0].body, "Answer [^0]")
+        self.assertEqual(cached["related_documents"][0].source_id, "original@0")
+
+
+if __name__ == "__main__":
+    unittest.main()
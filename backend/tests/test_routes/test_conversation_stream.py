@@ -0,0 +1,104 @@
+import asyncio
+import json
+import sys
+import unittest
+
+sys.path.insert(0, ".")
+
+from app.rate_limiter import RateLimitExceededError
+from app.routes.conversation import _stream_chat_events
+
+
+class _Events:
+    """Chat events of `chat_stream`, raising the error after them if given."""
+
+    def __init__(self, events: list[dict], error: Exception | None = None):
+        self.closed = False
+        self.iterator = self._iterate(events, error)
+
+    async def _iterate(self, events: list[dict], error: Exception | None):
+        try:
+            for event in events:
+                yield event
+            if error is not None:
+                raise error
+        finally:
+            self.closed = True
+
+
+def _parse(frames: list[str]) -> list[dict]:
+    payloads = []
+    for frame in frames:
+        # One `data` line per event, terminated by a blank line
+        assert frame.startswith("data: ") and frame.endswith("\n\n"), frame
+        assert "\n" not in frame[: -len("\n\n")], frame
+        payloads.append(json.loads(frame[len("data: ") : -len("\n\n")]))
+
+    return payloads
+
+
+async def _stream(events: _Events):
+    """Server-sent events as the route streams them, after the first event."""
+    first_event = await anext(events.iterator)
+    return _stream_chat_events(first_event, events.iterator)  # type: ignore[arg-type]
+
+
+async def _collect(events: _Events) -> list[str]:
+    return [frame async for frame in await _stream(events)]
+
+
+class TestStreamChatEvents(unittest.TestCase):
+    def test_events_are_framed_in_order(self):
+        events = _Events(
+            [
+                {"type": "text", "text": "Hello"},
+                {"type": "text", "text": "line 1\nline 2"},
+                {"type": "stop", "result": {"stop_reason": "end_turn"}},
+            ]
+        )
+
+        frames = asyncio.run(_collect(events))
+
+        self.assertEqual(
+            _parse(frames),
+            [
+                {"status": "STREAMING", "completion": "Hello"},
+                {"status": "STREAMING", "completion": "line 1\nline 2"},
+                {
+                    "status": "STREAMING_END",
+                    "completion": "",
+                    "stop_reason": "end_turn",
+                },
+            ],
+        )
+        self.assertTrue(events.closed)
+
+    def test_rate_limit_error_is_sent_as_event(self):
+        events = _Events(
+            [{"type": "text", "text": "Hello"}],
+            RateLimitExceededError("Too many requests", retry_after=1.2),
+        )
+
+        frames = asyncio.run(_collect(events))
+
+        self.assertEqual(
+            _parse(frames)[-1],
+            {"status": "ERROR", "reason": "Too many requests", "retryAfter": 2},
+        )
+        self.assertTrue(events.closed)
+
+    def test_events_are_closed_when_client_disconnects(self):
+        events = _Events([{"type": "text", "text": "more"}] * 3)
+
+        async def disconnect_after_first_frame():
+            stream = await _stream(events)
+            await anext(stream)
+            await stream.aclose()
+
+        asyncio.run(disconnect_after_first_frame())
+
+        self.assertTrue(events.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
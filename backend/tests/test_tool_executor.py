@@ -0,0 +1,108 @@
+import sys
+import time
+import unittest
+from threading import Event, Timer
+from unittest.mock import MagicMock
+
+sys.path.insert(0, ".")
+
+from app.agents.tools.agent_tool import ToolRunResult
+from app.repositories.models.conversation import RelatedDocumentModel
+from app.tool_executor import ToolExecutor, _tool_result_cache
+
+
+class _CountingTool:
+    def __init__(self):
+        self.calls = 0
+
+    def run(self, tool_use_id, input, model, bot) -> ToolRunResult:
+        self.calls += 1
+        return ToolRunResult(
+            tool_use_id=tool_use_id,
+            status="success",
+            related_documents=[
+                RelatedDocumentModel(content=None, source_id=f"{tool_use_id}@0")
+            ],
+        )
+
+
+class _SlowTool:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def run(self, tool_use_id, input, model, bot) -> ToolRunResult:
+        time.sleep(self.seconds)
+        return ToolRunResult(
+            tool_use_id=tool_use_id, status="success", related_documents=[]
+        )
+
+
+def _tool_use(tool_use_id: str, name: str, query: str = "query"):
+    content = MagicMock()
+    content.body.tool_use_id = tool_use_id
+    content.body.name = name
+    content.body.input = {"query": query}
+    return content
+
+
+class TestToolExecutorCancel(unittest.TestCase):
+    def test_cancelled_by_caller_event(self):
+        cancelled = Event()
+        executor = ToolExecutor(
+            tools={"slow": _SlowTool(5)},
+            model="claude-v3.5-sonnet",
+            bot=None,
+            cancelled=cancelled,
+        )
+        Timer(0.1, cancelled.set).start()
+
+        started = time.monotonic()
+        results = executor.run([_tool_use("1", "slow"), _tool_use("2", "slow")])
+        executor.close()
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([result["status"] for result in results], ["error", "error"])
+
+    def test_submit_after_cancel_does_not_start(self):
+        executor = ToolExecutor(
+            tools={"slow": _SlowTool(5)}, model="claude-v3.5-sonnet", bot=None
+        )
+        executor.cancel()
+        executor.submit("1", "slow", {})
+
+        self.assertEqual(executor._submitted, {})
+        executor.close()
+
+
+class TestToolResultCache(unittest.TestCase):
+    def setUp(self):
+        _tool_result_cache.clear()
+
+    def _run(self, tool, name: str, tool_use_id: str) -> ToolRunResult:
+        executor = ToolExecutor(
+            tools={name: tool}, model="claude-v3.5-sonnet", bot=None
+        )
+        try:
+            return executor.run([_tool_use(tool_use_id, name)])[0]
+        finally:
+            executor.close()
+
+    def test_tools_are_not_cached_by_default(self):
+        tool = _CountingTool()
+        self._run(tool, "internet_search", "1")
+        self._run(tool, "internet_search", "1")
+
+        self.assertEqual(tool.calls, 2)
+
+    def test_opted_in_tool_is_cached_and_rebound(self):
+        tool = _CountingTool()
+        self._run(tool, "knowledge_base_tool", "1")
+        result = self._run(tool, "knowledge_base_tool", "2")
+
+        self.assertEqual(tool.calls, 1)
+        self.assertEqual(result["tool_use_id"], "2")
+        self.assertEqual(result["related_documents"][0].source_id, "2@0")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,384 @@
+import asyncio
+import sys
+import unittest
+from threading import Event
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app.repositories.common import RecordNotFoundError
+from app.repositories.conversation import LazyMessageMap
+from app.repositories.models.conversation import (
+    ConversationModel,
+    MessageModel,
+    RelatedDocumentModel,
+    TextContentModel,
+)
+from app.usecases import chat as chat_usecase
+
+
+def _message(
+    role: str, parent: str | None, children: list[str], create_time: float = 0
+) -> MessageModel:
+    return MessageModel(
+        role=role,
+        content=[TextContentModel(content_type="text", body=role)],
+        model="claude-v3.5-sonnet",
+        children=children,
+        parent=parent,
+        create_time=create_time,
+    )
+
+
+def _fetched_conversation(edited: bool = True) -> ConversationModel:
+    """Conversation as loaded from the table. If `edited`, the user message `u2` has been
+    edited into `u2b`, which is the active branch.
+    """
+    messages = {
+        "system": _message("system", None, ["instruction"], 0),
+        "instruction": _message("instruction", "system", ["u1"], 0),
+        "u1": _message("user", "instruction", ["a1"], 1),
+        "a1": _message("assistant", "u1", ["u2"], 2),
+        "u2": _message("user", "a1", ["a2"], 3),
+        "a2": _message("assistant", "u2", [], 4),
+    }
+    if edited:
+        messages["a1"].children.append("u2b")
+        messages["u2b"] = _message("user", "a1", ["a2b"], 5)
+        messages["a2b"] = _message("assistant", "u2b", [], 6)
+
+    return ConversationModel.model_construct(
+        id="conversation",
+        create_time=0,
+        title="Titled",
+        total_price=0,
+        message_map=LazyMessageMap(
+            {k: v.model_dump(by_alias=True) for k, v in messages.items()}
+        ),
+        last_message_id="a2b" if edited else "a2",
+        bot_id=None,
+        should_continue=False,
+    )
+
+
+class _FetchConversationTest(unittest.TestCase):
+    def setUp(self):
+        self.conversation = _fetched_conversation()
+        patchers = [
+            patch.object(
+                chat_usecase,
+                "find_conversation_by_id",
+                side_effect=lambda user_id, conversation_id: self.conversation,
+            ),
+            # Output schemas are plain objects here, to check the returned links
+            patch.object(
+                chat_usecase,
+                "_message_output_from_model",
+                side_effect=lambda message: SimpleNamespace(
+                    parent=message.parent, children=list(message.children)
+                ),
+            ),
+            patch.object(chat_usecase, "Conversation", SimpleNamespace),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestFetchConversationDelta(_FetchConversationTest):
+    def _delta(self, since_message_id: str) -> dict:
+        return chat_usecase.fetch_conversation_delta(
+            "user", "conversation", since_message_id
+        ).message_map
+
+    def test_messages_after_cursor_with_changed_parent(self):
+        delta = self._delta("a2")
+
+        self.assertEqual(set(delta), {"a1", "u2b", "a2b"})
+        self.assertEqual(delta["a1"].children, ["u2", "u2b"])
+        # Messages before the cursor are filtered without validating them.
+        # The instruction is read to hide it.
+        self.assertEqual(
+            [
+                message_id
+                for message_id, item in self.conversation.message_map._items.items()
+                if isinstance(item, dict)
+            ],
+            ["system", "u1", "u2", "a2"],
+        )
+
+    def test_cursor_advances_to_last_message(self):
+        self.conversation = _fetched_conversation(edited=False)
+        self.assertEqual(set(self._delta("u2")), {"u2", "a2"})
+
+        # The user edits `u2`, and the client asks from the last message it has
+        self.conversation = _fetched_conversation()
+        self.assertEqual(set(self._delta("a2")), {"a1", "u2b", "a2b"})
+        self.assertEqual(self._delta("a2b"), {})
+
+    def test_instruction_is_omitted(self):
+        delta = self._delta("system")
+
+        self.assertNotIn("instruction", delta)
+        self.assertEqual(delta["system"].children, ["u1"])
+        self.assertEqual(delta["u1"].parent, "system")
+
+    def test_unknown_cursor_returns_whole_conversation(self):
+        delta = self._delta("unknown")
+
+        self.assertEqual(set(delta), {"system", "u1", "a1", "u2", "a2", "u2b", "a2b"})
+
+
+class TestFetchConversationBranch(_FetchConversationTest):
+    def test_active_branch_only(self):
+        message_map = chat_usecase.fetch_conversation(
+            "user", "conversation", active_branch_only=True
+        ).message_map
+
+        self.assertEqual(set(message_map), {"system", "u1", "a1", "u2b", "a2b"})
+        # The abandoned branch is reachable by the children of its parent
+        self.assertEqual(message_map["a1"].children, ["u2", "u2b"])
+
+    def test_whole_conversation_by_default(self):
+        message_map = chat_usecase.fetch_conversation(
+            "user", "conversation"
+        ).message_map
+
+        self.assertEqual(
+            set(message_map), {"system", "u1", "a1", "u2", "a2", "u2b", "a2b"}
+        )
+
+    def test_sibling_branch_is_loaded_down_to_leaf(self):
+        output = chat_usecase.fetch_conversation_branch("user", "conversation", "u2")
+
+        self.assertEqual(set(output.message_map), {"u2", "a2"})
+        self.assertEqual(output.last_message_id, "a2")
+
+    def test_branch_follows_latest_child(self):
+        output = chat_usecase.fetch_conversation_branch("user", "conversation", "u1")
+
+        self.assertEqual(set(output.message_map), {"u1", "a1", "u2b", "a2b"})
+        self.assertEqual(output.message_map["u1"].parent, "system")
+
+    def test_unknown_message_is_not_found(self):
+        with self.assertRaises(RecordNotFoundError):
+            chat_usecase.fetch_conversation_branch("user", "conversation", "unknown")
+
+
+class TestPrepareConversation(unittest.TestCase):
+    def setUp(self):
+        self.bot_fetch_started = Event()
+        self.bot = SimpleNamespace(instruction="Be concise.")
+
+        def fetch_bot(user, bot_id):
+            self.bot_fetch_started.set()
+            return False, self.bot
+
+        def find_conversation_by_id(user_id, conversation_id):
+            # The bot is loaded while the conversation is being fetched
+            self.assertTrue(self.bot_fetch_started.wait(timeout=5))
+            raise RecordNotFoundError()
+
+        patchers = [
+            patch.object(chat_usecase, "fetch_bot", side_effect=fetch_bot),
+            patch.object(
+                chat_usecase,
+                "find_conversation_by_id",
+                side_effect=find_conversation_by_id,
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.chat_input = SimpleNamespace(
+            conversation_id="conversation",
+            bot_id="shared_bot",
+            continue_generate=False,
+            message=SimpleNamespace(
+                role="user",
+                content=[TextContentModel(content_type="text", body="Hello")],
+                model="claude-v3.5-sonnet",
+                parent_message_id=None,
+                message_id="user_msg",
+            ),
+        )
+
+    def test_new_conversation_with_shared_bot(self):
+        background_tasks: list = []
+        with patch.object(chat_usecase, "_ensure_alias") as ensure_alias:
+            user_msg_id, conversation, bot = chat_usecase.prepare_conversation(
+                SimpleNamespace(id="user"), self.chat_input, background_tasks
+            )
+            chat_usecase.wait_background_tasks(background_tasks)
+
+        self.assertIs(bot, self.bot)
+        self.assertEqual(user_msg_id, "user_msg")
+        self.assertEqual(conversation.message_map["user_msg"].parent, "instruction")
+        self.assertEqual(
+            conversation.message_map["instruction"].content[0].body, "Be concise."
+        )
+        # Alias creation is left to the caller to wait for
+        self.assertEqual(len(background_tasks), 1)
+        ensure_alias.assert_called_once()
+
+    def test_alias_is_created_only_if_missing(self):
+        with (
+            patch.object(
+                chat_usecase, "alias_exists", side_effect=RecordNotFoundError()
+            ),
+            patch.object(chat_usecase, "store_alias") as store_alias,
+            patch.object(chat_usecase, "BotAliasModel") as bot_alias_model,
+        ):
+            chat_usecase._ensure_alias(
+                SimpleNamespace(id="user"), "shared_bot", self.bot  # type: ignore[arg-type]
+            )
+
+        bot_alias_model.from_bot_for_initial_alias.assert_called_once_with(self.bot)
+        store_alias.assert_called_once_with(
+            "user", bot_alias_model.from_bot_for_initial_alias.return_value
+        )
+
+    def test_failed_background_task_is_not_raised(self):
+        def fail():
+            raise RuntimeError("failed")
+
+        task = chat_usecase._executor.submit(fail)
+
+        with self.assertLogs(chat_usecase.logger, "ERROR"):
+            chat_usecase.wait_background_tasks([task])
+
+
+class TestFinishChat(unittest.TestCase):
+    def test_related_documents_are_stored_before_stop(self):
+        calls = MagicMock()
+        conversation = ConversationModel(
+            id="conversation",
+            create_time=0,
+            title="Titled",
+            total_price=0,
+            message_map={
+                "system": _message("system", None, ["user_msg"]),
+                "user_msg": _message("user", "system", ["assistant_msg"]),
+                "assistant_msg": _message("assistant", "user_msg", []),
+            },
+            last_message_id="assistant_msg",
+        )
+        related_documents = [RelatedDocumentModel(source_id="assistant_msg@0")]
+        with (
+            patch.object(chat_usecase, "store_conversation", calls.store_conversation),
+            patch.object(
+                chat_usecase, "store_related_documents", calls.store_related_documents
+            ),
+        ):
+            chat_usecase._finish_chat(
+                user=SimpleNamespace(id="user"),
+                user_msg_id="user_msg",
+                conversation=conversation,
+                bot=None,
+                related_documents=related_documents,
+                result={"stop_reason": "end_turn"},
+                on_stop=calls.on_stop,
+                background_tasks=[],
+            )
+
+        self.assertEqual(
+            [name for name, _, _ in calls.mock_calls if "." not in name],
+            ["store_conversation", "store_related_documents", "on_stop"],
+        )
+        self.assertEqual(
+            calls.store_related_documents.call_args.kwargs["related_documents"],
+            related_documents,
+        )
+
+
+class TestChatStream(unittest.TestCase):
+    def setUp(self):
+        self.finished = Event()
+        self.chat_kwargs: dict = {}
+        self.error: Exception | None = None
+
+        def chat(**kwargs):
+            self.chat_kwargs = kwargs
+            try:
+                for text in ["Hel", "lo"]:
+                    kwargs["on_stream"](text)
+                kwargs["on_reasoning"]("thinking")
+                if self.error is not None:
+                    raise self.error
+                kwargs["on_stop"]({"stop_reason": "end_turn"})
+            finally:
+                self.finished.set()
+
+        patcher = patch.object(chat_usecase, "chat", side_effect=chat)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _stream(self):
+        return chat_usecase.chat_stream(
+            SimpleNamespace(id="user"),  # type: ignore[arg-type]
+            SimpleNamespace(conversation_id="conversation"),  # type: ignore[arg-type]
+        )
+
+    def test_events_are_yielded_in_order(self):
+        async def collect():
+            return [event async for event in self._stream()]
+
+        events = asyncio.run(collect())
+
+        self.assertEqual(
+            events,
+            [
+                {"type": "text", "text": "Hel"},
+                {"type": "text", "text": "lo"},
+                {"type": "reasoning", "text": "thinking"},
+                {"type": "stop", "result": {"stop_reason": "end_turn"}},
+            ],
+        )
+
+    def test_error_of_chat_is_raised_after_events(self):
+        self.error = ValueError("invalid")
+        events: list = []
+
+        async def collect():
+            async for event in self._stream():
+                events.append(event)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(collect())
+
+        self.assertEqual(
+            [event["type"] for event in events], ["text", "text", "reasoning"]
+        )
+
+    def test_closing_stream_cancels_chat(self):
+        cancelled_errors: list[Exception] = []
+
+        def endless_chat(**kwargs):
+            try:
+                while True:
+                    kwargs["on_stream"]("text")
+            except chat_usecase.ChatStreamCancelledError as e:
+                cancelled_errors.append(e)
+                raise
+            finally:
+                self.finished.set()
+
+        async def close_after_first_event():
+            stream = self._stream()
+            self.assertEqual(await anext(stream), {"type": "text", "text": "text"})
+            await stream.aclose()
+
+        with (
+            patch.object(chat_usecase, "chat", side_effect=endless_chat),
+            patch.object(chat_usecase, "CHAT_STREAM_MAX_BUFFERED_EVENTS", 1),
+        ):
+            asyncio.run(close_after_first_event())
+            self.assertTrue(self.finished.wait(timeout=5))
+
+        self.assertEqual(len(cancelled_errors), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app import vector_search
+from app.cache import TTLCache
+from app.vector_search import _retrieve, invalidate_retrieval_cache
+
+
+class TestRetrievalCache(unittest.TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.retrieve.side_effect = lambda **kwargs: {
+            "retrievalResults": [
+                {"content": {"text": kwargs["retrievalQuery"]["text"]}},
+            ]
+        }
+        patchers = [
+            patch.object(vector_search, "agent_client", self.client),
+            patch.object(
+                vector_search,
+                "_retrieval_cache",
+                TTLCache(max_size=10, default_ttl=60),
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _retrieve(self, query: str, knowledge_version: str | None = "exec-1"):
+        return _retrieve(
+            knowledge_base_id="kb",
+            knowledge_version=knowledge_version,
+            search_type="HYBRID",
+            limit=10,
+            query=query,
+        )
+
+    def test_normalized_query_is_read_from_cache(self):
+        first = self._retrieve("What is  Bedrock?")
+        second = self._retrieve("what is bedrock?")
+
+        self.assertEqual(second, first)
+        self.assertEqual(self.client.retrieve.call_count, 1)
+
+    def test_results_are_not_cached_without_knowledge_version(self):
+        self._retrieve("What is Bedrock?", knowledge_version=None)
+        self._retrieve("What is Bedrock?", knowledge_version=None)
+
+        self.assertEqual(self.client.retrieve.call_count, 2)
+
+    def test_new_knowledge_version_is_retrieved_again(self):
+        self._retrieve("What is Bedrock?", knowledge_version="exec-1")
+        self._retrieve("What is Bedrock?", knowledge_version="exec-2")
+
+        self.assertEqual(self.client.retrieve.call_count, 2)
+
+    def test_invalidated_knowledge_base_is_retrieved_again(self):
+        self._retrieve("What is Bedrock?")
+        _retrieve(
+            knowledge_base_id="other",
+            knowledge_version="exec-1",
+            search_type="HYBRID",
+            limit=10,
+            query="What is Bedrock?",
+        )
+
+        self.assertEqual(invalidate_retrieval_cache("kb"), 1)
+        self._retrieve("What is Bedrock?")
+
+        self.assertEqual(self.client.retrieve.call_count, 3)
+        self.assertEqual(len(vector_search._retrieval_cache), 2)
+
+    def test_near_duplicate_query_is_read_from_cache(self):
+        with patch.object(
+            vector_search, "KNOWLEDGE_BASE_RETRIEVAL_CACHE_NEAR_DUPLICATE", True
+        ):
+            self._retrieve("pricing of bedrock")
+            self._retrieve("Bedrock pricing, of bedrock!")
+
+        self.assertEqual(self.client.retrieve.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, ".")
+
+from app import write_behind
+from app.write_behind import (
+    BotStatsWrite,
+    LastUsedTimeWrite,
+    TitleWrite,
+    WriteBehindBuffer,
+    apply_writes,
+    coalesce,
+    handler,
+)
+
+
+def _record(message_id: str, write) -> dict:
+    return {"messageId": message_id, "body": json.dumps(write)}
+
+
+def _stats(bot_id: str, increment: int) -> BotStatsWrite:
+    return BotStatsWrite(
+        type="bot_stats", owner_user_id="owner", bot_id=bot_id, increment=increment
+    )
+
+
+class TestCoalesce(unittest.TestCase):
+    def test_sums_stats_and_keeps_latest_last_used_time(self):
+        writes = coalesce(
+            [
+                _stats("bot1", 1),
+                _stats("bot1", 2),
+                LastUsedTimeWrite(
+                    type="last_used_time",
+                    user_id="user",
+                    bot_id="bot1",
+                    is_alias=False,
+                    time=1,
+                ),
+                LastUsedTimeWrite(
+                    type="last_used_time",
+                    user_id="user",
+                    bot_id="bot1",
+                    is_alias=False,
+                    time=2,
+                ),
+            ]
+        )
+        by_type = {write["type"]: write for write in writes}
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(by_type["last_used_time"]["time"], 2)
+        self.assertEqual(by_type["bot_stats"]["increment"], 3)
+
+
+class TestHandler(unittest.TestCase):
+    def test_reports_only_messages_of_failed_writes(self):
+        applied: list[tuple[str, int]] = []
+
+        def update_bot_stats(owner_user_id, bot_id, increment):
+            if bot_id == "bot2":
+                raise Exception("throttled")
+            applied.append((bot_id, increment))
+
+        event = {
+            "Records": [
+                _record("m1", _stats("bot1", 1)),
+                _record("m2", _stats("bot2", 1)),
+                _record("m3", _stats("bot2", 1)),
+            ]
+        }
+        with patch.object(write_behind, "update_bot_stats", update_bot_stats):
+            response = handler(event, None)
+
+        self.assertEqual(applied, [("bot1", 1)])
+        self.assertEqual(
+            response["batchItemFailures"],
+            [{"itemIdentifier": "m2"}, {"itemIdentifier": "m3"}],
+        )
+
+
+class TestFlush(unittest.TestCase):
+    def test_title_is_returned_separately_without_queue(self):
+        buffer = WriteBehindBuffer()
+        title = TitleWrite(
+            type="title",
+            user_id="user",
+            conversation_id="conversation",
+            transcript="User: Hello",
+        )
+        buffer.writes = [_stats("bot1", 1), title]
+        executor = MagicMock()
+        with (
+            patch.object(write_behind, "WRITE_BEHIND_QUEUE_URL", ""),
+            patch.object(write_behind, "_executor", executor),
+        ):
+            flush_task, title_task = buffer.flush()
+
+        titles, writes = executor.submit.call_args_list
+        self.assertEqual(titles.args, (apply_writes, [title]))
+        self.assertEqual(writes.args, (buffer._flush, [_stats("bot1", 1)]))
+        self.assertIs(flush_task, executor.submit.return_value)
+        self.assertIs(title_task, executor.submit.return_value)
+
+
+if __name__ == "__main__":
+    unittest.main()